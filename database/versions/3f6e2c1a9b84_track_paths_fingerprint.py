@@ -0,0 +1,27 @@
+"""
+track_paths fingerprint
+
+Revision ID: 3f6e2c1a9b84
+Revises: bbd46a7b357f
+Create Date: 2026-10-18 10:12:31.402118
+"""
+
+revision = '3f6e2c1a9b84'
+down_revision = 'bbd46a7b357f'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('track_paths', sa.Column('size', sa.BigInteger))
+    op.add_column('track_paths', sa.Column('mtime', sa.BigInteger))
+    op.add_column('track_paths', sa.Column('inode', sa.BigInteger))
+    op.add_column('track_paths', sa.Column('device', sa.BigInteger))
+
+
+def downgrade():
+    op.drop_column('track_paths', 'size')
+    op.drop_column('track_paths', 'mtime')
+    op.drop_column('track_paths', 'inode')
+    op.drop_column('track_paths', 'device')
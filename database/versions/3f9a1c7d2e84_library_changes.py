@@ -0,0 +1,29 @@
+"""
+library_changes
+
+Revision ID: 3f9a1c7d2e84
+Revises: 5b7e0d93c6f1
+Create Date: 2026-10-18 18:12:47.204531
+"""
+
+revision = '3f9a1c7d2e84'
+down_revision = '5b7e0d93c6f1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'library_changes',
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('entity', sa.String(16)),
+        sa.Column('entity_id', sa.Integer),
+        sa.Column('operation', sa.String(8)),
+        sa.Column('created', sa.DateTime),
+        mysql_charset='utf8', mysql_engine='InnoDB'
+    )
+
+
+def downgrade():
+    op.drop_table('library_changes')
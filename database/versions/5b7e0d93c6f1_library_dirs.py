@@ -0,0 +1,29 @@
+"""
+library_dirs
+
+Revision ID: 5b7e0d93c6f1
+Revises: 8c1d4e7f2a05
+Create Date: 2026-10-18 16:41:09.530217
+"""
+
+revision = '5b7e0d93c6f1'
+down_revision = '8c1d4e7f2a05'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'library_dirs',
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('path', sa.BLOB),
+        sa.Column('mtime', sa.BigInteger),
+        sa.Column('links', sa.Integer),
+        sa.Column('subdirs', sa.BLOB),
+        mysql_charset='utf8', mysql_engine='InnoDB'
+    )
+
+
+def downgrade():
+    op.drop_table('library_dirs')
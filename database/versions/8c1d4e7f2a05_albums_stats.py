@@ -0,0 +1,75 @@
+"""
+albums aggregated stats columns
+
+Revision ID: 8c1d4e7f2a05
+Revises: 3f6e2c1a9b84
+Create Date: 2026-10-18 14:02:47.118354
+"""
+
+revision = '8c1d4e7f2a05'
+down_revision = '3f6e2c1a9b84'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql.expression import table, column
+
+
+tracks = table('tracks',
+    column('id', sa.Integer),
+    column('album_id', sa.Integer),
+    column('artist_id', sa.Integer),
+    column('duration', sa.Integer),
+    column('disc', sa.String),
+    column('format', sa.String),
+    column('bitrate', sa.Integer),
+    column('invalid', sa.String),
+)
+
+
+albums = table('albums',
+    column('id', sa.Integer),
+    column('artist_count', sa.Integer),
+    column('format', sa.String),
+    column('disc_count', sa.Integer),
+    column('track_count', sa.Integer),
+    column('duration', sa.Integer),
+    column('low_quality', sa.Boolean),
+    column('invalid', sa.String),
+)
+
+
+def aggregate(value):
+    return sa.select([value]).where(tracks.c.album_id == albums.c.id).as_scalar()
+
+
+def upgrade():
+    op.add_column('albums', sa.Column('artist_count', sa.Integer, nullable=False, server_default='0'))
+    op.add_column('albums', sa.Column('format', sa.String(128)))
+    op.add_column('albums', sa.Column('disc_count', sa.Integer, nullable=False, server_default='0'))
+    op.add_column('albums', sa.Column('track_count', sa.Integer, nullable=False, server_default='0'))
+    op.add_column('albums', sa.Column('duration', sa.Integer))
+    op.add_column('albums', sa.Column('low_quality', sa.Boolean, nullable=False, server_default=sa.false()))
+    op.add_column('albums', sa.Column('invalid', sa.String(255)))
+
+    low_quality = sa.or_(sa.and_(tracks.c.format == "audio/mp3", tracks.c.bitrate < 165000),
+                         sa.and_(tracks.c.format == "audio/ogg", tracks.c.bitrate < 110000))
+
+    # migrate data
+    op.execute(albums.update().values({
+               'artist_count': aggregate(sa.func.count(sa.distinct(tracks.c.artist_id))),
+               'format': aggregate(sa.func.max(tracks.c.format)),
+               'disc_count': aggregate(sa.func.count(sa.distinct(tracks.c.disc))),
+               'track_count': aggregate(sa.func.count(tracks.c.id)),
+               'duration': aggregate(sa.func.sum(tracks.c.duration)),
+               'low_quality': sa.exists().where(sa.and_(tracks.c.album_id == albums.c.id, low_quality)),
+               'invalid': aggregate(sa.func.group_concat(sa.distinct(tracks.c.invalid)))}))
+
+
+def downgrade():
+    op.drop_column('albums', 'artist_count')
+    op.drop_column('albums', 'format')
+    op.drop_column('albums', 'disc_count')
+    op.drop_column('albums', 'track_count')
+    op.drop_column('albums', 'duration')
+    op.drop_column('albums', 'low_quality')
+    op.drop_column('albums', 'invalid')
@@ -18,6 +18,7 @@
  */
 
 import $ from 'jquery';
+import ws from 'opmuse/ws';
 import messages from 'opmuse/messages';
 import ajaxify from 'opmuse/ajaxify';
 import reloader from 'opmuse/reloader';
@@ -77,6 +78,13 @@ function init() {
     }
 }
 
+// imports are fetched and added in the background
+ws.on('library.ingest.progress', function(name, written, parsed) {
+    if ($('#torrents_deluge').length > 0) {
+        reloader.load([".torrents_import"]);
+    }
+});
+
 $('#main').on('ajaxifyInit', function(event) {
     init();
 });
@@ -18,6 +18,7 @@
  */
 
 import $ from 'jquery';
+import ws from 'opmuse/ws';
 import ajaxify from 'opmuse/ajaxify';
 import Bloodhound from 'corejs-typeahead';
 import loadjQueryPlugin from 'corejs-typeahead';
@@ -34,6 +35,12 @@ class Upload {
 
         that.parallelUploads = 4;
         that.activeUploads = 0;
+
+        // files are uploaded in chunks so an interrupted upload can continue
+        // where it was instead of starting over
+        that.chunkSize = 1024 * 1024 * 8;
+        that.retries = 5;
+
         that.archives = ['application/zip', 'application/rar', 'application/x-rar'];
         that.audio = ['application/x-flac', 'audio/flac', 'audio/mp3', 'audio/x-ms-wma',
             'audio/mp4a-latm', 'audio/ogg', 'audio/x-ape', 'audio/x-musepack', 'audio/wav',
@@ -47,6 +54,56 @@ class Upload {
             that.internalInit();
         });
 
+        // archives are extracted and added in the background
+        ws.on('library.ingest.progress', function(name, written, parsed) {
+            var messages = $('#upload .uploaded .messages');
+
+            var message = messages.find('.ingest-progress').filter(function() {
+                return $(this).data('name') === name;
+            });
+
+            if (message.length === 0) {
+                message = $('<li class="list-group-item text-info message ingest-progress">').data('name', name);
+                messages.append(message);
+            }
+
+            message.html(sprintf('<strong>%s</strong>: %d files extracted, %d read.', $('<div>').text(name).html(),
+                written, parsed));
+        });
+
+        ws.on('library.upload.done', function(session, name, messages) {
+            if (session != that.session) {
+                return;
+            }
+
+            $('#upload .uploaded .messages .ingest-progress').filter(function() {
+                return $(this).data('name') === name;
+            }).remove();
+
+            for (var index in messages) {
+                $('#upload .uploaded .messages').append(
+                    $('<li class="list-group-item message">').addClass('text-' + messages[index][0])
+                        .html(messages[index][1])
+                );
+            }
+
+            $.ajax(sprintf('%s?session=%d', $('#fileupload').data('url-result'), that.session), {
+                success: function(data, textStatus, xhr) {
+                    var resultDom = $(data);
+
+                    ajaxify.load(resultDom);
+
+                    var tracks = $('#upload .uploaded .tracks');
+
+                    tracks.contents().remove();
+
+                    tracks.append(
+                        resultDom.find('.tracks-hierarchy')
+                    );
+                }
+            });
+        });
+
         this.totalSize = 0;
         this.totalLoaded = 0;
 
@@ -84,6 +141,8 @@ class Upload {
         $('#fileupload').fileupload({
             singleFileUploads: false,
             multipart: false,
+            maxChunkSize: that.chunkSize,
+            type: 'PUT',
             add: function(event, data) {
                 var files = [];
 
@@ -301,61 +360,83 @@ class Upload {
                 done = true;
             }
 
-            (function(file, done) {
-                $('#fileupload').fileupload('send', {
-                        files: file.file,
-                        url: url,
-                        fileDom: file.dom
-                    })
-                    .done(function(result, textStatus, jqXHR) {
-                        that.activeUploads--;
+            that.upload(file, url, done, that.retries);
+        }
+    }
+    upload(file, url, done, retries) {
+        var that = this;
 
-                        $(file.dom).remove();
+        var offsetUrl = sprintf('%s?session=%d&filename=%s', $('#fileupload').data('url-offset'),
+            that.session, encodeURIComponent(file.file.name));
 
-                        var resultDom = $(result);
+        // continue from what the backend already got, if anything
+        $.getJSON(offsetUrl).always(function(data) {
+            var uploadedBytes = typeof data !== 'undefined' && data !== null &&
+                typeof data.size !== 'undefined' ? data.size : 0;
 
-                        ajaxify.load(resultDom);
+            $('#fileupload').fileupload('send', {
+                    files: file.file,
+                    url: url,
+                    fileDom: file.dom,
+                    uploadedBytes: uploadedBytes
+                })
+                .done(function(result, textStatus, jqXHR) {
+                    that.activeUploads--;
 
-                        var tracks = $('#upload .uploaded .tracks');
+                    $(file.dom).remove();
 
-                        tracks.contents().remove();
+                    var resultDom = $(result);
 
-                        tracks.append(
-                            resultDom.find('.tracks-hierarchy')
-                        );
+                    ajaxify.load(resultDom);
 
-                        $('#upload .uploaded .messages').append(
-                            resultDom.find('.message')
-                        );
+                    var tracks = $('#upload .uploaded .tracks');
 
-                        if (done) {
-                            that.done();
-                        } else {
-                            that.send();
-                        }
-                    }).fail(function(jqXHR, textStatus, errorThrown) {
-                        that.activeUploads--;
+                    tracks.contents().remove();
 
-                        $(file.dom).addClass('danger').find('.progress-bar')
-                            .removeClass('progress-bar-success').addClass('progress-bar-danger');
+                    tracks.append(
+                        resultDom.find('.tracks-hierarchy')
+                    );
 
-                        $(file.dom).popover({
-                            html: true,
-                            trigger: 'hover',
-                            placement: 'bottom',
-                            container: '#upload',
-                            title: sprintf('Error occured while uploading <strong>%s</strong>.', file.file.name),
-                            content: $(jqXHR.responseText).find('#content').contents()
-                        });
+                    $('#upload .uploaded .messages').append(
+                        resultDom.find('.message')
+                    );
 
-                        if (done) {
-                            that.done();
-                        } else {
-                            that.send();
-                        }
+                    if (done) {
+                        that.done();
+                    } else {
+                        that.send();
+                    }
+                }).fail(function(jqXHR, textStatus, errorThrown) {
+                    // connection problems, try to resume the upload
+                    if (jqXHR.status === 0 && retries > 0) {
+                        setTimeout(function() {
+                            that.upload(file, url, done, retries - 1);
+                        }, 3000);
+
+                        return;
+                    }
+
+                    that.activeUploads--;
+
+                    $(file.dom).addClass('danger').find('.progress-bar')
+                        .removeClass('progress-bar-success').addClass('progress-bar-danger');
+
+                    $(file.dom).popover({
+                        html: true,
+                        trigger: 'hover',
+                        placement: 'bottom',
+                        container: '#upload',
+                        title: sprintf('Error occured while uploading <strong>%s</strong>.', file.file.name),
+                        content: $(jqXHR.responseText).find('#content').contents()
                     });
-            })(file, done);
-        }
+
+                    if (done) {
+                        that.done();
+                    } else {
+                        that.send();
+                    }
+                });
+        });
     }
 }
 
@@ -26,7 +26,8 @@ from croniter import croniter
 from functools import total_ordering
 from multiprocessing import cpu_count
 from cherrypy.process.plugins import SimplePlugin
-from opmuse.database import get_session, database_data
+from sqlalchemy import text
+from opmuse.database import get_session, get_database, database_data
 from opmuse.utils import get_pretty_errors, mail_pretty_errors
 
 
@@ -318,6 +319,34 @@ class BackgroundTaskCron:
         raise NotImplementedError()
 
 
+class SqliteMaintenanceCron(BackgroundTaskCron):
+    """
+    Updates the query planner's statistics, rebuilds the database file and
+    truncates the WAL, which otherwise only grows while there's always a
+    reader.
+    """
+
+    def priority(self):
+        return -10
+
+    def expression(self):
+        config = cherrypy.tree.apps[''].config['opmuse']
+        return config.get('database.sqlite.maintenance', '0 4 * * *')
+
+    def run(self):
+        engine = get_database().get_bind()
+
+        start_time = time.time()
+
+        with engine.connect() as connection:
+            connection.execute(text('ANALYZE'))
+            connection.execute(text('VACUUM'))
+            busy, wal_pages, checkpointed = connection.execute(text('PRAGMA wal_checkpoint(TRUNCATE)')).first()
+
+        log('Sqlite maintenance done in %.2fs, checkpointed %d of %d WAL pages%s.' %
+            (time.time() - start_time, checkpointed, wal_pages, ' (busy)' if busy else ''))
+
+
 class BackgroundTaskTool(cherrypy.Tool):
     def __init__(self):
         cherrypy.Tool.__init__(self, 'on_start_resource',
@@ -22,18 +22,19 @@ import locale
 import sys
 from opmuse.database_events import DatabaseEventsTool
 from os.path import join, abspath, dirname, exists
-from opmuse.library import LibraryPlugin, LibraryWatchdogPlugin, LibraryTool
-from opmuse.database import SqlAlchemyPlugin, SqlAlchemyTool
+from opmuse.library import LibraryPlugin, LibraryWatchdogPlugin, LibraryTool, TrackFuturesCron, LibraryChangesCron
+from opmuse.database import SqlAlchemyPlugin, SqlAlchemyTool, get_database_type
 from opmuse.security import SessionQueryStringTool, AuthenticatedTool
 from opmuse.transcoding import FFMPEGTranscoderSubprocessTool
 from opmuse.jinja import Jinja, JinjaEnvTool, JinjaPlugin, JinjaAuthenticatedTool
 from opmuse.search import WhooshPlugin
 from opmuse.utils import error_handler_tool, multi_headers_tool, get_staticdir
 from opmuse.ws import WebSocketPlugin, WebSocketHandler, WebSocketTool
-from opmuse.bgtask import BackgroundTaskPlugin, BackgroundTaskCronPlugin, BackgroundTaskTool
+from opmuse.bgtask import BackgroundTaskPlugin, BackgroundTaskCronPlugin, BackgroundTaskTool, SqliteMaintenanceCron
 from opmuse.cache import CachePlugin
 from opmuse.sessions import SqlalchemySession
 from opmuse.deluge import DelugeBackgroundTaskCron
+from opmuse.ingest import ingest
 
 
 def configure(config_file=None, environment=None):
@@ -52,6 +53,7 @@ def configure(config_file=None, environment=None):
     cherrypy.tools.database_events = DatabaseEventsTool()
 
     from opmuse.controllers.main import Root
+    from opmuse.controllers.library import LibraryUpload
 
     if config_file is None:
         config_file = join(abspath(dirname(__file__)), '..', 'config', 'opmuse.ini')
@@ -227,6 +229,14 @@ def configure(config_file=None, environment=None):
     cherrypy.engine.bgtaskcron.subscribe()
 
     cherrypy.engine.bgtaskcron.add_cron(DelugeBackgroundTaskCron())
+    cherrypy.engine.bgtaskcron.add_cron(TrackFuturesCron())
+    cherrypy.engine.bgtaskcron.add_cron(LibraryChangesCron())
+
+    cherrypy.engine.subscribe('start', LibraryUpload.remove_temp_dirs)
+    cherrypy.engine.subscribe('stop', ingest.stop)
+
+    if get_database_type() == 'sqlite':
+        cherrypy.engine.bgtaskcron.add_cron(SqliteMaintenanceCron())
 
     return app
 
@@ -27,7 +27,7 @@ from opmuse.database import get_database
 from opmuse.security import User, Role, hash_password
 from opmuse.remotes import remotes
 from opmuse.utils import HTTPRedirect
-from opmuse.library import library_dao, Track
+from opmuse.library import library_dao, Track, entity_cache
 from opmuse.cache import cache
 
 
@@ -180,6 +180,16 @@ class Admin:
         formats = (get_database().query(Track.format, func.sum(Track.duration),
                                         func.sum(Track.size), func.count(Track.format)).group_by(Track.format).all())
 
+        checkpoint = cherrypy.request.library.checkpoint
+
+        if checkpoint is not None:
+            checkpoint = {
+                'completed': len(checkpoint.completed),
+                'resumed': checkpoint.resumed,
+                'walk': None if checkpoint.walk is None else
+                os.path.relpath(checkpoint.walk, checkpoint.library_path).decode('utf8', 'replace'),
+            }
+
         stats = {
             'tracks': library_dao.get_track_count(),
             'invalid': library_dao.get_invalid_track_count(),
@@ -190,14 +200,17 @@ class Admin:
             'size': library_dao.get_track_size(),
             'scanning': cherrypy.request.library.scanning,
             'processed': cherrypy.request.library.processed,
-            'files_found': cherrypy.request.library.files_found
+            'files_found': cherrypy.request.library.files_found,
+            'checkpoint': checkpoint
         }
 
         return {
             'cache_size': cache.storage.size(),
+            'entity_cache': entity_cache,
             'disk': disk,
             'stats': stats,
-            'formats': formats
+            'formats': formats,
+            'pools': cherrypy.engine.database.pool_stats()
         }
 
     @cherrypy.expose
@@ -17,11 +17,11 @@
 
 import datetime
 import cherrypy
-from sqlalchemy.orm import joinedload, undefer
+from sqlalchemy.orm import joinedload
 from sqlalchemy import func
 from opmuse.library import Album, Track, library_dao
 from opmuse.security import User, security_dao
-from opmuse.database import get_database
+from opmuse.database import get_database, read_only
 from opmuse.remotes import remotes
 from opmuse.queues import queue_dao
 from opmuse.search import search
@@ -173,11 +173,11 @@ class Dashboard:
 
         return recently_listeneds
 
+    @read_only
     def get_new_albums(self, limit, offset):
         return (get_database()
                 .query(Album)
                 .options(joinedload(Album.tracks))
-                .options(undefer(Album.artist_count))
                 .join(Track, Album.id == Track.album_id)
                 .group_by(Album.id)
                 .order_by(func.max(Track.created).desc())
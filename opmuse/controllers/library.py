@@ -19,27 +19,34 @@ import os
 import time
 import datetime
 import math
-import rarfile
 import shutil
 import tempfile
+import hashlib
+import threading
 import cherrypy
 import re
 from collections import OrderedDict
+from contextlib import contextmanager
 from urllib.parse import unquote
-from zipfile import ZipFile
-from rarfile import RarFile
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm import joinedload
 from sqlalchemy import func, distinct, and_
 from sqlalchemy.sql import text
 from opmuse.database import get_database
 from opmuse.library import (library_dao, TrackPath, TrackStructureParser, Album,
-                            Track, Artist, UserAndAlbum, Library as LibraryService)
+                            Track, Artist, UserAndAlbum, Library as LibraryService, track_futures,
+                            library_changes)
 from opmuse.utils import HTTPRedirect
 from opmuse.search import search
 from opmuse.cache import cache
 from opmuse.remotes import remotes
 from opmuse.security import security_dao
+from opmuse.ingest import ingest
+from opmuse.ws import ws
+
+
+def log(msg, traceback=False):
+    cherrypy.log(msg, context='controllers.library', traceback=traceback)
 
 
 class LibraryEdit:
@@ -191,6 +198,18 @@ class LibraryRemove:
 class LibraryUpload:
     CACHE_KEY = "UPLOAD_TRACKS_%d_%s"
 
+    # size of the pieces uploads are read and written in
+    BUFFER_SIZE = 1024 * 1024
+
+    # chunked uploads not finished in this many seconds are removed
+    PART_MAX_AGE = 3600 * 24
+
+    CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+    # part path => [lock, number of requests using it]
+    _part_locks = {}
+    _part_locks_lock = threading.Lock()
+
     @cherrypy.expose
     @cherrypy.tools.jinja(filename='library/upload.html')
     @cherrypy.tools.authenticated(needs_auth=True, roles=['admin'])
@@ -206,8 +225,30 @@ class LibraryUpload:
 
         cache.set(cache_key, all_tracks)
 
+        LibraryUpload._remove_old_parts()
+
+        track_futures.expire()
+
         return b''
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.authenticated(needs_auth=True, roles=['admin'])
+    def offset(self, filename, session=None):
+        """
+        Returns how many bytes of a chunked upload that has been received, so
+        an interrupted upload can continue from there.
+        """
+
+        part_path = LibraryUpload._get_part_path(session, filename)
+
+        if os.path.exists(part_path):
+            size = os.path.getsize(part_path)
+        else:
+            size = 0
+
+        return {'size': size}
+
     @cherrypy.expose
     @cherrypy.tools.jinja(filename='library/upload_add.html')
     @cherrypy.tools.authenticated(needs_auth=True, roles=['admin'])
@@ -239,132 +280,193 @@ class LibraryUpload:
         ext = os.path.splitext(filename)[1].lower()[1:]
         basename = os.path.splitext(filename)[0]
 
-        cache_path = os.path.join(cherrypy.config['opmuse'].get('cache.path'), 'upload')
+        content_range = cherrypy.request.headers.get('content-range')
 
-        if not os.path.exists(cache_path):
-            os.mkdir(cache_path)
+        # this is a chunk of a larger file, the file is only processed when
+        # the last chunk has been received
+        if content_range is not None:
+            part_path = LibraryUpload._write_chunk(session, filename, content_range)
 
-        tempdir = tempfile.mkdtemp(dir=cache_path)
+            if part_path is None:
+                return {'hierarchy': None, 'messages': []}
+
+        tempdir = tempfile.mkdtemp(dir=LibraryUpload._get_upload_path())
 
         path = os.path.join(tempdir, filename)
 
         paths = []
 
-        rarfile.PATH_SEP = '/'
-
         messages = []
 
-        with open(path, 'wb') as fileobj:
-            fileobj.write(cherrypy.request.rfile.read())
+        if content_range is not None:
+            shutil.move(part_path, path)
+        else:
+            with open(path, 'wb') as fileobj:
+                LibraryUpload._write_body(fileobj)
 
         # this file is a regular file that belongs to an audio_file
         if audio_file is not None:
-            track = None
-            tries = 0
+            future = track_futures.get(audio_file.encode('utf8'))
 
-            # try and sleep until we get the track.. this will almost always
-            # be needed because of the async upload.
-            while track is None and tries < 10:
-                track = library_dao.get_track_by_filename(audio_file.encode('utf8'))
-                tries += 1
+            if future.done():
+                messages += LibraryUpload._move_sidecar(future, path, audio_file, filename)
+            else:
+                # its track hasn't been added yet, move it in the background
+                # when it has been
+                user_id = cherrypy.request.user.id
 
-                if track is None:
-                    time.sleep(3)
+                def added(future, path=path, tempdir=tempdir):
+                    cherrypy.engine.bgtask.put(LibraryUpload._add_sidecar, 30, future, path, tempdir,
+                                               audio_file, filename, user_id, session)
 
-            if track is None:
-                messages.append(('warning', ("<strong>%s</strong>: Skipping <strong>%s</strong>, timeout trying to " +
-                                "find its track.") % (audio_file, filename)))
-            else:
-                track_structure = TrackStructureParser(track)
-                track_path = track_structure.get_path(absolute=True)
-                relative_track_path = track_structure.get_path(absolute=False).decode('utf8', 'replace')
+                future.add_done_callback(added)
 
-                new_path = os.path.join(track_path, filename.encode('utf8'))
+                messages.append(('info', "<strong>%s</strong>: <strong>%s</strong> will be added when its track is." %
+                                (audio_file, filename)))
 
-                if os.path.exists(new_path):
-                    messages.append(('warning', ("<strong>%s</strong>: Skipping <strong>%s</strong>, already exists " +
-                                    "in <strong>%s</strong>.") % (audio_file, filename, relative_track_path)))
-                else:
-                    shutil.move(path.encode('utf8'), new_path)
-                    messages.append(('info', ("<strong>%s</strong>: Uploaded <strong>%s</strong> to " +
-                                    "<strong>%s</strong>.") % (audio_file, filename, relative_track_path)))
+                tempdir = None
 
-        elif ext == "zip":
-            # set artist name fallback to zip's name so if it's missing artist tags
-            # it's easily distinguishable and editable so it can be fixed after upload.
+        elif ext == "zip" or ext == "rar":
+            # set artist name fallback to archive's name so if it's missing
+            # artist tags it's easily distinguishable and editable so it can be
+            # fixed after upload.
             artist_name_fallback = basename
 
-            try:
-                zip = ZipFile(path)
+            # the archive is extracted and added by a background task, which
+            # also removes tempdir, its progress is sent over ws
+            cherrypy.engine.bgtask.put(LibraryUpload._ingest_archive, 30, path, tempdir, archive_password,
+                                       artist_name_fallback, cherrypy.request.user.id, session)
 
-                if archive_password is not None:
-                    zip.setpassword(archive_password.encode())
+            messages.append(('info', "<strong>%s</strong>: Extracting and adding in the background." % filename))
 
-                zip.extractall(tempdir)
+            tempdir = None
 
-                os.remove(path)
+        # this is a plain audio file
+        else:
+            paths.append(path.encode('utf8'))
 
-                for name in zip.namelist():
-                    namepath = os.path.join(tempdir, name)
+        for path in paths:
+            # update modified time to now, we don't want the time from the
+            # uploader's machine
+            os.utime(path, None)
 
-                    # ignore hidden files, e.g. OSX archive weirdness and such
-                    if name.startswith(".") or os.path.split(name)[0] == "__MACOSX":
-                        shutil.rmtree(namepath)
-                        continue
+        if len(paths) > 0:
+            tracks, add_files_messages = library_dao.add_files(paths, move=True, remove_dirs=False,
+                                                               artist_name_fallback=artist_name_fallback,
+                                                               user=cherrypy.request.user)
+            messages += add_files_messages
+        else:
+            tracks = []
 
-                    paths.append(namepath.encode('utf8'))
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
 
-            except Exception as error:
-                messages.append(('danger', "<strong>%s</strong>: %s" % (os.path.basename(path), error)))
+        LibraryUpload._add_tracks(all_tracks, tracks)
 
-        elif ext == "rar":
-            # look at corresponding ext == zip comment...
-            artist_name_fallback = basename
+        hierarchy = Library._produce_track_hierarchy(library_dao.get_tracks_by_ids(all_tracks))
 
-            try:
-                rar = RarFile(path)
+        return {'hierarchy': hierarchy, 'messages': messages}
 
-                if archive_password is None and rar.needs_password():
-                    messages.append(('danger', "<strong>%s</strong>: Needs password but none provided." %
-                                    os.path.basename(path)))
-                else:
-                    if archive_password is not None:
-                        rar.setpassword(archive_password)
+    @cherrypy.expose
+    @cherrypy.tools.jinja(filename='library/upload_add.html')
+    @cherrypy.tools.authenticated(needs_auth=True, roles=['admin'])
+    def result(self, session=None):
+        """
+        Returns all tracks added in session, e.g. after a background task added
+        tracks from an archive.
+        """
 
-                    rar.extractall(tempdir)
+        cache_key = LibraryUpload.CACHE_KEY % (cherrypy.request.user.id, session)
 
-                    os.remove(path)
+        if not cache.has(cache_key):
+            raise cherrypy.HTTPError(status=409)
 
-                    for name in rar.namelist():
-                        namepath = os.path.join(tempdir, name)
+        hierarchy = Library._produce_track_hierarchy(library_dao.get_tracks_by_ids(cache.get(cache_key)))
 
-                        if name.startswith("."):
-                            shutil.rmtree(namepath)
-                            continue
+        return {'hierarchy': hierarchy, 'messages': []}
 
-                        paths.append(namepath.encode('utf8'))
+    @staticmethod
+    def _ingest_archive(path, tempdir, archive_password, artist_name_fallback, user_id, session):
+        user = security_dao.get_user(user_id)
+        ws_user = ws.get_ws_user(user.id, user.login)
 
-            except Exception as error:
-                messages.append(('danger', "<strong>%s</strong>: %s" % (os.path.basename(path), error)))
+        filename = os.path.basename(path)
 
-        # this is a plain audio file
-        else:
-            paths.append(path.encode('utf8'))
+        try:
+            files = ingest.extract(path, tempdir, archive_password)
 
-        for path in paths:
-            # update modified time to now, we don't want the time from the zip
-            # archive or whatever
-            os.utime(path, None)
+            tracks, messages = ingest.add(filename, files, move=True, remove_dirs=False,
+                                          artist_name_fallback=artist_name_fallback, user=user, ws_user=ws_user)
+        except Exception as error:
+            log("Failed to add %s." % filename, traceback=True)
 
-        if len(paths) > 0:
-            tracks, add_files_messages = library_dao.add_files(paths, move=True, remove_dirs=False,
-                                                               artist_name_fallback=artist_name_fallback,
-                                                               user=cherrypy.request.user)
-            messages += add_files_messages
-        else:
             tracks = []
+            messages = [('danger', "<strong>%s</strong>: %s" % (filename, error))]
+        finally:
+            shutil.rmtree(tempdir)
+
+        cache_key = LibraryUpload.CACHE_KEY % (user.id, session)
+
+        if cache.has(cache_key):
+            LibraryUpload._add_tracks(cache.get(cache_key), tracks)
+
+        ws.emit('library.upload.done', session, filename, messages, ws_user=ws_user)
+
+    @staticmethod
+    def _add_sidecar(future, path, tempdir, audio_file, filename, user_id, session):
+        user = security_dao.get_user(user_id)
+
+        try:
+            messages = LibraryUpload._move_sidecar(future, path, audio_file, filename)
+        finally:
+            shutil.rmtree(tempdir)
+
+        ws.emit('library.upload.done', session, filename, messages, ws_user=ws.get_ws_user(user.id, user.login))
+
+    @staticmethod
+    def _move_sidecar(future, path, audio_file, filename):
+        """
+        Moves a non-track file into the dir of the track its future resolved
+        to. Returns messages.
+        """
+
+        messages = []
+
+        if future.exception() is not None:
+            messages.append(('warning', ("<strong>%s</strong>: Skipping <strong>%s</strong>, timeout trying to " +
+                            "find its track.") % (audio_file, filename)))
+
+            return messages
 
-        shutil.rmtree(tempdir)
+        track = library_dao.get_track(future.result())
+
+        if track is None:
+            messages.append(('warning', "<strong>%s</strong>: Skipping <strong>%s</strong>, its track is gone." %
+                            (audio_file, filename)))
+
+            return messages
+
+        track_structure = TrackStructureParser(track)
+        track_path = track_structure.get_path(absolute=True)
+        relative_track_path = track_structure.get_path(absolute=False).decode('utf8', 'replace')
+
+        new_path = os.path.join(track_path, filename.encode('utf8'))
+
+        if os.path.exists(new_path):
+            messages.append(('warning', ("<strong>%s</strong>: Skipping <strong>%s</strong>, already exists " +
+                            "in <strong>%s</strong>.") % (audio_file, filename, relative_track_path)))
+        else:
+            shutil.move(path.encode('utf8'), new_path)
+            messages.append(('info', ("<strong>%s</strong>: Uploaded <strong>%s</strong> to " +
+                            "<strong>%s</strong>.") % (audio_file, filename, relative_track_path)))
+
+        return messages
+
+    @staticmethod
+    def _add_tracks(all_tracks, tracks):
+        """
+        Adds ids of tracks to the session's tracks and fetches their remotes.
+        """
 
         for track in tracks:
             all_tracks.append(track.id)
@@ -377,9 +479,150 @@ class LibraryUpload:
 
             remotes.update_track(track)
 
-        hierarchy = Library._produce_track_hierarchy(library_dao.get_tracks_by_ids(all_tracks))
+    @staticmethod
+    def _write_chunk(session, filename, content_range):
+        """
+        Writes a chunk of an upload at the offset given by its Content-Range
+        header. Returns the path of the file when all chunks has been received,
+        otherwise None.
+        """
 
-        return {'hierarchy': hierarchy, 'messages': messages}
+        match = LibraryUpload.CONTENT_RANGE_RE.match(content_range)
+
+        if match is None:
+            raise cherrypy.HTTPError(status=400)
+
+        start, end, total = (int(group) for group in match.groups())
+
+        if end < start or end >= total:
+            raise cherrypy.HTTPError(status=400)
+
+        part_path = LibraryUpload._get_part_path(session, filename)
+
+        # a retried chunk can arrive while the first attempt is still being
+        # written, they'd overwrite each other's data
+        with LibraryUpload._lock_part(part_path):
+            if os.path.exists(part_path):
+                size = os.path.getsize(part_path)
+            else:
+                size = 0
+
+            # we can only continue from what we already got
+            if start > size:
+                raise cherrypy.HTTPError(status=416)
+
+            with open(part_path, 'r+b' if size > 0 else 'wb') as fileobj:
+                fileobj.seek(start)
+                fileobj.truncate()
+
+                LibraryUpload._write_body(fileobj)
+
+                size = fileobj.tell()
+
+                # the body didn't match the range, throw it away so the
+                # client continues from before this chunk
+                if size - 1 != end:
+                    fileobj.truncate(start)
+
+                    raise cherrypy.HTTPError(status=400)
+
+        # tells the client how much we've got, like in a 308 resume response
+        cherrypy.response.headers['Range'] = 'bytes=0-%d' % (size - 1)
+
+        if size < total:
+            return None
+
+        return part_path
+
+    @staticmethod
+    @contextmanager
+    def _lock_part(part_path):
+        """
+        Holds a lock for part_path so only one chunk is written to it at a
+        time, the lock is removed when no request is using it.
+        """
+
+        with LibraryUpload._part_locks_lock:
+            if part_path not in LibraryUpload._part_locks:
+                LibraryUpload._part_locks[part_path] = [threading.Lock(), 0]
+
+            part_lock = LibraryUpload._part_locks[part_path]
+            part_lock[1] += 1
+
+        try:
+            with part_lock[0]:
+                yield
+        finally:
+            with LibraryUpload._part_locks_lock:
+                part_lock[1] -= 1
+
+                if part_lock[1] == 0:
+                    del LibraryUpload._part_locks[part_path]
+
+    @staticmethod
+    def _write_body(fileobj):
+        """
+        Writes the request body to fileobj a piece at a time so uploads never
+        are kept in memory.
+        """
+
+        while True:
+            data = cherrypy.request.rfile.read(LibraryUpload.BUFFER_SIZE)
+
+            if len(data) == 0:
+                break
+
+            fileobj.write(data)
+
+    @staticmethod
+    def _get_upload_path():
+        upload_path = os.path.join(cherrypy.config['opmuse'].get('cache.path'), 'upload')
+
+        if not os.path.exists(upload_path):
+            os.mkdir(upload_path)
+
+        return upload_path
+
+    @staticmethod
+    def _get_part_path(session, filename):
+        """
+        Returns path of where chunks of filename are written to until all of
+        them has been received.
+        """
+
+        key = '%d_%s_%s' % (cherrypy.request.user.id, session, filename)
+
+        return os.path.join(LibraryUpload._get_upload_path(),
+                            '%s.part' % hashlib.sha1(key.encode('utf8')).hexdigest())
+
+    @staticmethod
+    def remove_temp_dirs():
+        """
+        Removes the dirs uploads are written to before they're added, called
+        on startup when nothing is waiting for them anymore, e.g. non-track
+        files whose track hadn't been added yet. Chunked uploads are kept so
+        they can continue.
+        """
+
+        upload_path = LibraryUpload._get_upload_path()
+
+        for name in os.listdir(upload_path):
+            path = os.path.join(upload_path, name)
+
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    @staticmethod
+    def _remove_old_parts():
+        upload_path = LibraryUpload._get_upload_path()
+
+        now = time.time()
+
+        for name in os.listdir(upload_path):
+            path = os.path.join(upload_path, name)
+
+            if name.endswith('.part') and now - os.path.getmtime(path) > LibraryUpload.PART_MAX_AGE:
+                os.remove(path)
 
 
 class Library:
@@ -387,6 +630,50 @@ class Library:
     edit = LibraryEdit()
     remove = LibraryRemove()
 
+    # max changes returned by changes()
+    CHANGES_LIMIT = 1000
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.etags()
+    @cherrypy.tools.authenticated(needs_auth=True)
+    def changes(self, since=None):
+        """
+        Returns the library's generation and what changed after generation
+        since, if given. There's more when the last change's id is less than
+        the generation. The ETag is the generation.
+
+        If changes after since has been trimmed the response is 410 and clients
+        have to reload everything.
+        """
+
+        generation = library_changes.get_generation()
+
+        cherrypy.response.headers['ETag'] = '"%d"' % generation
+
+        if since is None:
+            changes = []
+        else:
+            try:
+                since = int(since)
+            except ValueError:
+                raise cherrypy.HTTPError(400, 'since must be an integer')
+
+            if since < library_changes.get_oldest() - 1:
+                raise cherrypy.HTTPError(410, 'Changes after %d has been trimmed' % since)
+
+            changes = library_changes.get_changes(since, Library.CHANGES_LIMIT, generation)
+
+        return {
+            'generation': generation,
+            'changes': [{
+                'id': change.id,
+                'entity': change.entity,
+                'entity_id': change.entity_id,
+                'operation': change.operation
+            } for change in changes]
+        }
+
     @cherrypy.expose
     @cherrypy.tools.authenticated(needs_auth=True)
     @cherrypy.tools.jinja(filename='library/track.html')
@@ -16,11 +16,10 @@
 # along with opmuse.  If not, see <http://www.gnu.org/licenses/>.
 
 import cherrypy
-import os
 from sqlalchemy import or_
 from opmuse.utils import HTTPRedirect
 from opmuse.deluge import deluge_dao, deluge, Torrent, DelugeBackgroundTaskCron
-from opmuse.library import library_dao
+from opmuse.ingest import ingest
 from opmuse.bgtask import NonUniqueQueueError
 from opmuse.database import get_database
 from opmuse.cache import cache
@@ -38,15 +37,11 @@ class Deluge:
 
         try:
             deluge.connect()
-            torrent_files = deluge.import_torrent(torrent_id)
 
-            for torrent_file in torrent_files:
-                # update modified time to now, we don't want the one from deluge
-                os.utime(torrent_file, None)
+            name = deluge_dao.get_torrent_name(torrent_id)
 
-            tracks, messages = library_dao.add_files(
-                torrent_files, move=True, remove_dirs=True
-            )
+            # files are parsed while the rest of them are being fetched
+            tracks, messages = ingest.add(name, deluge.import_torrent(torrent_id), move=True, remove_dirs=True)
 
             deluge_dao.update_import_status('imported', None, torrent_id)
         except Exception as e:
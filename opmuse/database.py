@@ -17,12 +17,18 @@
 
 import cherrypy
 import re
+import sqlite3
 import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from multiprocessing import cpu_count
 from urllib.parse import urlparse
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.pool import NullPool
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
+from sqlalchemy.sql.expression import Select, UpdateBase
+from sqlalchemy.pool import NullPool, QueuePool
 
 Base = declarative_base()
 Base.__table_args__ = ({'mysql_charset': 'utf8', 'mysql_engine': 'InnoDB'}, )
@@ -45,14 +51,246 @@ def get_database_type():
     return re.sub(r'(\+[^+]+)?$', '', urlparse(url).scheme)
 
 
-def get_engine(no_database=False):
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that keeps track of how many connections has been checked out
+    and how long they had to wait for one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+
+        self.checkouts = 0
+        self.wait_total = 0
+        self.wait_max = 0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.time()
+
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            wait = time.time() - start
+
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+
+def get_pool_config(role):
+    """
+    Returns pool settings for role, database.pool.<role> merged with defaults.
+    The web pool is sized after server.thread_pool and the bgtask pool after
+    the number of bgtask threads.
+    """
+
     config = cherrypy.tree.apps[''].config['opmuse']
-    url = config['database.url']
+
+    if role == 'web':
+        size = cherrypy.config.get('server.thread_pool', 10)
+    elif role == 'bgtask':
+        size = cpu_count() * 2
+    else:
+        size = 2
+
+    pool_config = {
+        'size': size,
+        'max_overflow': size,
+        'timeout': 30,
+        'recycle': 3600,
+        'pre_ping': True
+    }
+
+    pool_config.update(config.get('database.pool.%s' % role, {}))
+
+    return pool_config
+
+
+def log(msg, traceback=False):
+    cherrypy.log(msg, context='database', traceback=traceback)
+
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    # negative means KiB instead of pages
+    'cache_size': -64 * 1024,
+    'busy_timeout': 30000
+}
+"""
+Pragmas set on each sqlite connection, WAL lets readers go on while there's a
+writer.
+"""
+
+sqlite_writer_lock = threading.Lock()
+"""
+Held by the sqlite connection that has a write transaction open, so there's
+only one writer at a time and the others queue up here instead of failing with
+"database is locked".
+"""
+
+
+class SqliteWriterConnection(sqlite3.Connection):
+    """
+    sqlite3 connection that takes sqlite_writer_lock on its first write and
+    holds it until the transaction is over.
+    """
+
+    # seconds to wait for sqlite_writer_lock, set from the busy_timeout pragma
+    # the connection was opened with by set_sqlite_pragmas()
+    writer_timeout = SQLITE_PRAGMAS['busy_timeout'] / 1000
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.writer = False
+
+    def cursor(self, factory=None):
+        return sqlite3.Connection.cursor(self, SqliteWriterCursor if factory is None else factory)
+
+    def commit(self):
+        try:
+            sqlite3.Connection.commit(self)
+        finally:
+            self.release_writer()
+
+    def rollback(self):
+        try:
+            sqlite3.Connection.rollback(self)
+        finally:
+            self.release_writer()
+
+    def close(self):
+        try:
+            sqlite3.Connection.close(self)
+        finally:
+            self.release_writer()
+
+    def acquire_writer(self, sql):
+        if self.writer or re.match(r'\s*(SELECT|PRAGMA)\b', sql, re.IGNORECASE):
+            return
+
+        if not sqlite_writer_lock.acquire(timeout=self.writer_timeout):
+            # e.g. when a thread writes with two sessions at the same time,
+            # leave it to sqlite's busy_timeout instead of waiting forever
+            log('Timed out waiting for the sqlite writer lock, writing anyway.')
+            return
+
+        self.writer = True
+
+    def release_writer(self):
+        # statements outside of a transaction, e.g. DDL or VACUUM, are done
+        # as soon as they've executed
+        if self.writer and not self.in_transaction:
+            self.writer = False
+            sqlite_writer_lock.release()
+
+
+class SqliteWriterCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        self.connection.acquire_writer(sql)
+
+        try:
+            return sqlite3.Cursor.execute(self, sql, *args)
+        finally:
+            self.connection.release_writer()
+
+    def executemany(self, sql, *args):
+        self.connection.acquire_writer(sql)
+
+        try:
+            return sqlite3.Cursor.executemany(self, sql, *args)
+        finally:
+            self.connection.release_writer()
+
+
+def get_sqlite_config():
+    """
+    Returns pragmas from database.sqlite.pragmas merged with SQLITE_PRAGMAS and
+    if writes should go through sqlite_writer_lock.
+    """
+
+    config = cherrypy.tree.apps[''].config['opmuse']
+
+    pragmas = dict(SQLITE_PRAGMAS)
+    pragmas.update(config.get('database.sqlite.pragmas', {}))
+
+    return pragmas, config.get('database.sqlite.single_writer', True)
+
+
+def set_sqlite_pragmas(engine, pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+        cursor.close()
+
+        # waiting on the lock longer than sqlite would wait on the database
+        # just moves where "database is locked" comes from
+        if isinstance(dbapi_connection, SqliteWriterConnection) and 'busy_timeout' in pragmas:
+            dbapi_connection.writer_timeout = int(pragmas['busy_timeout']) / 1000
+
+    event.listen(engine, 'connect', connect)
+
+
+def get_engine(no_database=False, role=None, replica=False):
+    """
+    role
+        what the engine's connections are used for, "web", "bgtask" or
+        "scanner". Each role gets its own pool of connections, without a role
+        there's no pooling.
+
+    replica
+        connect to database.replica.url instead of database.url
+    """
+
+    config = cherrypy.tree.apps[''].config['opmuse']
+    url = config['database.replica.url' if replica else 'database.url']
 
     if no_database:
         url = re.sub(r'/[^/]+$', '', url)
 
-    return create_engine(url, echo=False, poolclass=NullPool, isolation_level="READ UNCOMMITTED")
+    kwargs = {}
+    connect_args = {}
+
+    sqlite = get_database_type() == 'sqlite'
+
+    if sqlite:
+        pragmas, single_writer = get_sqlite_config()
+
+        if single_writer:
+            connect_args['factory'] = SqliteWriterConnection
+
+    if role is None:
+        kwargs['poolclass'] = NullPool
+    else:
+        pool_config = get_pool_config(role)
+
+        # pooled connections are used by more than the thread that opened them
+        if sqlite:
+            connect_args['check_same_thread'] = False
+
+        kwargs.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': pool_config['size'],
+            'max_overflow': pool_config['max_overflow'],
+            'pool_timeout': pool_config['timeout'],
+            'pool_recycle': pool_config['recycle'],
+            'pool_pre_ping': pool_config['pre_ping'],
+            'logging_name': role
+        })
+
+    engine = create_engine(url, echo=False, isolation_level="READ UNCOMMITTED",
+                           connect_args=connect_args, **kwargs)
+
+    if sqlite:
+        set_sqlite_pragmas(engine, pragmas)
+
+    return engine
 
 
 def get_database_name():
@@ -73,57 +311,232 @@ def get_raw_session(create_all=False):
     return sessionmaker(bind=engine)()
 
 
-def get_session():
+def has_replica():
+    return cherrypy.tree.apps[''].config['opmuse'].get('database.replica.url') is not None
+
+
+class RoutingSession(Session):
+    """
+    Session that sends selects to the replica, if there is one, when it's been
+    told to with info['replica'] or inside read_only(). Everything else, and
+    everything after the session's first write so it reads its own writes,
+    goes to the primary.
+    """
+
+    def __init__(self, replica=None, **kwargs):
+        Session.__init__(self, **kwargs)
+        self.replica = replica
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            self.info['primary'] = True
+        elif (self.replica is not None and not self._flushing and isinstance(clause, Select) and
+                not self.info.get('primary', False) and self.info.get('on_primary', 0) == 0 and
+                (self.info.get('replica', False) or self.info.get('read_only', 0) > 0)):
+            return self.replica
+
+        return Session.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info['primary'] = True
+
+
+def read_only(func):
+    """
+    Decorator for DAO methods that only read, lets their queries go to the
+    replica unless the current session has already written something.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        database = get_database()
+
+        if database is None:
+            return func(*args, **kwargs)
+
+        database.info['read_only'] = database.info.get('read_only', 0) + 1
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            database.info['read_only'] -= 1
+
+    return wrapper
+
+
+def get_replica(database):
+    """
+    Returns the replica database's selects might be sent to, or None.
+    """
+
+    if isinstance(database, scoped_session):
+        database = database()
+
+    return getattr(database, 'replica', None)
+
+
+@contextmanager
+def on_primary():
+    """
+    Sends the current session's queries inside the with block to the primary,
+    e.g. when what's read is kept after the session is done with it.
+    """
+
+    database = get_database()
+
+    if database is None:
+        yield
+        return
+
+    database.info['on_primary'] = database.info.get('on_primary', 0) + 1
+
+    try:
+        yield
+    finally:
+        database.info['on_primary'] -= 1
+
+
+def get_session(role='bgtask'):
+    """
+    Returns a session for use outside of requests, e.g. in background threads.
+
+    role
+        which pool the session's connections comes from, see get_engine()
+    """
+
     session = scoped_session(sessionmaker(autoflush=True,
-                                          autocommit=False))
-    cherrypy.engine.publish('bind', session)
+                                          autocommit=False,
+                                          class_=RoutingSession))
+    cherrypy.engine.publish('bind', session, role)
 
     return session
 
 
 class SqlAlchemyPlugin(cherrypy.process.plugins.SimplePlugin):
+    ROLES = ('web', 'bgtask', 'scanner')
+
+    REPLICA_ROLES = ('web', 'bgtask')
+    """
+    Roles whose sessions can read from the replica, the scanner always wants
+    to see what it just wrote.
+    """
 
     def __init__(self, bus):
         cherrypy.process.plugins.SimplePlugin.__init__(self, bus)
-        self.engine = None
+        self.engines = None
+        self._lock = threading.Lock()
         self.bus.subscribe("bind", self.bind)
 
     def start(self):
-        self.engine = get_engine()
+        self.engines = {}
 
     start.priority = 100
 
-    def bind(self, session):
+    def bind(self, session, role='web'):
         # this occurs in unit tests when the cherrypy plugin start event thingie
         # hasn't been triggered...
-        if self.engine is None:
+        if self.engines is None:
             engine = get_engine()
+            replica = None
         else:
-            engine = self.engine
+            with self._lock:
+                if role not in self.engines:
+                    self.engines[role] = get_engine(role=role)
+
+                engine = self.engines[role]
+
+                replica = None
+
+                if role in SqlAlchemyPlugin.REPLICA_ROLES and has_replica():
+                    replica_role = '%s_replica' % role
+
+                    if replica_role not in self.engines:
+                        self.engines[replica_role] = get_engine(role=role, replica=True)
+
+                    replica = self.engines[replica_role]
 
-        session.configure(bind=engine)
+        session.configure(bind=engine, replica=replica)
+
+    def pool_stats(self):
+        """
+        Returns a list of dicts with usage of each role's pool.
+        """
+
+        stats = []
+
+        roles = SqlAlchemyPlugin.ROLES + tuple('%s_replica' % role for role in SqlAlchemyPlugin.REPLICA_ROLES)
+
+        for role in roles:
+            if self.engines is None or role not in self.engines:
+                continue
+
+            pool = self.engines[role].pool
+
+            stats.append({
+                'role': role,
+                'size': pool.size(),
+                'in_use': pool.checkedout(),
+                'idle': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+                'max_overflow': pool._max_overflow,
+                'checkouts': pool.checkouts,
+                'wait_avg': pool.wait_total / pool.checkouts if pool.checkouts > 0 else 0,
+                'wait_max': pool.wait_max
+            })
+
+        return stats
 
     def stop(self):
-        if self.engine is not None:
-            self.engine.dispose()
-            self.engine = None
+        if self.engines is not None:
+            for engine in self.engines.values():
+                engine.dispose()
+
+            self.engines = None
 
 
 class SqlAlchemyTool(cherrypy.Tool):
+    PRIMARY_COOKIE = 'opmuse_primary'
+    """
+    Set after a request that wrote something, so the next few requests read
+    from the primary, e.g. the page a form redirects to.
+    """
+
     def __init__(self):
         cherrypy.Tool.__init__(self, 'on_start_resource',
                                self.bind_session, priority=10)
 
         self.session = scoped_session(sessionmaker(autoflush=True,
                                                    autocommit=False,
-                                                   expire_on_commit=False))
+                                                   expire_on_commit=False,
+                                                   class_=RoutingSession))
 
     def _setup(self):
         cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('before_finalize',
+                                      self.set_primary_cookie,
+                                      priority=80)
         cherrypy.request.hooks.attach('on_end_request',
                                       self.commit_transaction,
                                       priority=80)
 
+    def set_primary_cookie(self):
+        if cherrypy.request.database is None or not has_replica():
+            return
+
+        session = cherrypy.request.database
+
+        if (session.info.get('primary', False) or len(session.new) > 0 or
+                len(session.dirty) > 0 or len(session.deleted) > 0):
+            config = cherrypy.tree.apps[''].config['opmuse']
+
+            cookie = cherrypy.response.cookie
+            cookie[SqlAlchemyTool.PRIMARY_COOKIE] = '1'
+            cookie[SqlAlchemyTool.PRIMARY_COOKIE]['path'] = '/'
+            cookie[SqlAlchemyTool.PRIMARY_COOKIE]['max-age'] = config.get('database.replica.sticky', 5)
+            cookie[SqlAlchemyTool.PRIMARY_COOKIE]['httponly'] = True
+
     def commit_transaction(self):
         cherrypy.request.database = None
 
@@ -136,6 +549,17 @@ class SqlAlchemyTool(cherrypy.Tool):
             self.session.remove()
             cherrypy.engine.publish('database_commit_transaction')
 
-    def bind_session(self):
-        cherrypy.engine.publish('bind', self.session)
+    def bind_session(self, replica=False):
+        """
+        replica
+            send all selects of the request to the replica, if there is one and
+            the request isn't right after a write. set with
+            tools.database.replica for handlers that only read, GET requests
+            can't be trusted with it as e.g. the queue is changed over GET.
+            otherwise only read_only() DAO methods use the replica.
+        """
+
+        cherrypy.engine.publish('bind', self.session, 'web')
         cherrypy.request.database = self.session
+
+        self.session.info['replica'] = replica and SqlAlchemyTool.PRIMARY_COOKIE not in cherrypy.request.cookie
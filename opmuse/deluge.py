@@ -144,6 +144,11 @@ class Deluge:
         get_database().commit()
 
     def import_torrent(self, torrent_id):
+        """
+        Fetches a torrent's files with rsync, yielding the path of each file as
+        soon as rsync is done with it.
+        """
+
         config = cherrypy.tree.apps[''].config['opmuse']
         ssh_host = config['deluge.ssh_host']
 
@@ -155,26 +160,45 @@ class Deluge:
 
         filelist_fd, filelist_path = tempfile.mkstemp()
 
-        files = []
-
         tempdir = self._mkdtemp().encode()
 
         with os.fdopen(filelist_fd, 'bw') as f:
             for file in torrent[b'files']:
                 path = os.path.join(torrent[b'save_path'], file[b'path'])
                 f.write(path + b"\n")
-                files.append(os.path.join(tempdir, path[1:]))
+
+        process = None
+
+        # stderr goes to a file, if it was a pipe too rsync could block on it
+        # while we're blocking on stdout
+        stderr = tempfile.TemporaryFile()
 
         try:
             debug('rsync torrent %s from %s' % (torrent_id, ssh_host))
-            output = subprocess.check_output([
+
+            # have rsync print each file it's done with, relative to tempdir
+            process = subprocess.Popen([
                 'rsync',
                 '-a',
                 '-e', 'ssh -oBatchMode=yes -oVisualHostKey=no',
+                '--out-format=%n',
                 '--files-from=%s' % filelist_path,
                 '%s:/' % ssh_host,
                 tempdir
-            ], stderr=subprocess.STDOUT)
+            ], stdout=subprocess.PIPE, stderr=stderr)
+
+            for line in process.stdout:
+                name = line.rstrip(b"\n")
+
+                # implied dirs are printed too
+                if name.endswith(b"/"):
+                    continue
+
+                yield os.path.join(tempdir, name)
+
+            if process.wait() != 0:
+                stderr.seek(0)
+                raise CalledProcessError(process.returncode, 'rsync', stderr.read())
         except CalledProcessError as error:
             log('Failed to rsync', traceback=True)
             shutil.rmtree(tempdir)
@@ -184,12 +208,19 @@ class Deluge:
             shutil.rmtree(tempdir)
             raise
         finally:
+            # e.g. the generator was closed before rsync was done
+            if process is not None:
+                if process.poll() is None:
+                    process.kill()
+
+                process.wait()
+                process.stdout.close()
+
+            stderr.close()
             os.remove(filelist_path)
 
         debug('done rsyncing torrent %s' % torrent_id)
 
-        return files
-
 
 deluge = Deluge()
 
@@ -229,5 +260,10 @@ class DelugeDao:
     def get_torrents(self):
         return get_database().query(Torrent).order_by(Torrent.added.desc()).all()
 
+    def get_torrent_name(self, torrent_id):
+        torrent = get_database().query(Torrent).filter(Torrent.torrent_id == torrent_id).first()
+
+        return torrent.name if torrent is not None else torrent_id
+
 
 deluge_dao = DelugeDao()
@@ -0,0 +1,219 @@
+# Copyright 2012-2015 Mattias Fliesberg
+#
+# This file is part of opmuse.
+#
+# opmuse is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# opmuse is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with opmuse.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import logging
+import multiprocessing
+import threading
+import cherrypy
+import rarfile
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import cpu_count
+from zipfile import ZipFile
+from rarfile import RarFile
+from opmuse.library import Library, LibraryProcess, library_dao, parse_file, hash_cache
+from opmuse.ws import ws
+
+
+def debug(msg):
+    cherrypy.log.error(msg, context='ingest', severity=logging.DEBUG)
+
+
+def log(msg, traceback=False):
+    cherrypy.log(msg, context='ingest', traceback=traceback)
+
+
+class Ingest:
+    """
+    Adds files to the library as they're written, e.g. extracted from an
+    archive or fetched by rsync. Each supported file is hashed and its tags
+    parsed in a process pool as soon as it's there, while the next one is being
+    written, and the results are handed to add_files() so it doesn't read them
+    again.
+    """
+
+    # seconds between progress events
+    PROGRESS_INTERVAL = 1
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def stop(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self):
+        """
+        Returns the process pool shared by all adds, started on first use.
+        """
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=cpu_count(),
+                                                     mp_context=multiprocessing.get_context('forkserver'))
+
+            return self._executor
+
+    def add(self, name, files, move=True, remove_dirs=True, artist_name_fallback=None, user=None, ws_user=None):
+        """
+        Returns tracks and messages of added files, like add_files().
+
+        name
+            what's being added, used in progress events and messages
+
+        files
+            iterable of file paths, consumed while the files are parsed
+
+        ws_user
+            who to send library.ingest.progress events to, everyone if None
+        """
+
+        paths = []
+        written = 0
+        parsed = 0
+
+        lock = threading.Lock()
+
+        emitted = 0
+
+        def emit(force=False):
+            nonlocal emitted
+
+            now = time.time()
+
+            if not force and now - emitted < Ingest.PROGRESS_INTERVAL:
+                return
+
+            emitted = now
+
+            Ingest._emit(ws_user, 'library.ingest.progress', name, written, parsed)
+
+        def done(future):
+            nonlocal parsed
+
+            with lock:
+                parsed += 1
+
+        futures = []
+
+        executor = self._get_executor()
+        hash_mode = LibraryProcess.get_hash_mode()
+
+        for path in files:
+            # update modified time to now, we don't want the time from the
+            # archive or whatever
+            os.utime(path, None)
+
+            paths.append(path)
+
+            if os.path.splitext(path)[1].lower()[1:] in Library.SUPPORTED:
+                future = executor.submit(parse_file, path, hash_cache.path, hash_mode)
+                future.add_done_callback(done)
+                futures.append(future)
+
+            written += 1
+
+            emit()
+
+        wait(futures)
+
+        results = {}
+
+        for future in futures:
+            try:
+                filename, stat, hash, metadata = future.result()
+            except Exception:
+                # add_files() will have another go at it and report it
+                log('Failed parsing file.', traceback=True)
+                continue
+
+            results[filename] = stat, hash, metadata
+
+        parsed = len(futures)
+
+        emit(True)
+
+        if len(paths) == 0:
+            return [], []
+
+        tracks, messages = library_dao.add_files(paths, move=move, remove_dirs=remove_dirs,
+                                                 artist_name_fallback=artist_name_fallback, user=user,
+                                                 parsed=results)
+
+        debug('Added %d tracks from %d files of %s.' % (len(tracks), len(paths), name))
+
+        return tracks, messages
+
+    def extract(self, path, dest, password=None):
+        """
+        Extracts a zip or rar archive one member at a time, yielding the path
+        of each extracted file as soon as it's written. Hidden files, e.g. OSX
+        archive weirdness, are skipped.
+        """
+
+        ext = os.path.splitext(path)[1].lower()[1:]
+
+        if ext == "zip":
+            archive = ZipFile(path)
+
+            if password is not None:
+                archive.setpassword(password.encode())
+        elif ext == "rar":
+            rarfile.PATH_SEP = '/'
+
+            archive = RarFile(path)
+
+            if password is None and archive.needs_password():
+                raise ValueError("Needs password but none provided.")
+
+            if password is not None:
+                archive.setpassword(password)
+        else:
+            raise ValueError("Unsupported archive.")
+
+        with archive:
+            for info in archive.infolist():
+                is_dir = info.isdir() if ext == "rar" else info.is_dir()
+
+                if is_dir or Ingest._is_hidden(info.filename):
+                    continue
+
+                extracted = archive.extract(info, dest)
+
+                # rarfile doesn't tell us where it put it
+                if extracted is None:
+                    extracted = os.path.join(dest, info.filename)
+
+                yield extracted.encode('utf8')
+
+    @staticmethod
+    def _is_hidden(name):
+        return any(part.startswith(".") or part == "__MACOSX" for part in name.split('/'))
+
+    @staticmethod
+    def _emit(ws_user, event, *args):
+        if ws_user is None:
+            ws.emit_all(event, *args)
+        else:
+            ws.emit(event, *args, ws_user=ws_user)
+
+
+ingest = Ingest()
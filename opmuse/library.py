@@ -19,14 +19,20 @@ import cherrypy
 import re
 import os
 import base64
-import io
 import datetime
-import math
 import shutil
 import time
 import random
 import logging
 import contextlib
+import collections
+import queue
+import threading
+import multiprocessing
+import sqlite3
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from cherrypy.process.plugins import SimplePlugin
@@ -34,18 +40,21 @@ from zc.lockfile import LockFile, LockError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.exc import IntegrityError, ProgrammingError
 from sqlalchemy import (Column, Integer, BigInteger, String, ForeignKey, VARBINARY, BINARY, BLOB,
-                        DateTime, Boolean, func, TypeDecorator, Index, distinct, select)
+                        DateTime, Boolean, func, TypeDecorator, Index, distinct, select, or_, and_,
+                        false, exists, event, inspect)
 from sqlalchemy.dialects import mysql
-from sqlalchemy.orm import relationship, deferred, validates, column_property
-from sqlalchemy.orm.session import Session
+from sqlalchemy.orm import relationship, deferred, validates, column_property, joinedload
+from sqlalchemy.orm.session import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql import text
 from multiprocessing import cpu_count
 from threading import Thread
 from unidecode import unidecode
-from opmuse.database import Base, get_session, get_database_type, get_database, database_data
+from opmuse.database import Base, get_session, get_database, database_data, read_only, on_primary, get_replica
 from opmuse.search import search
-from opmuse.utils import memoize
+from opmuse.bgtask import BackgroundTaskCron
+from opmuse.utils import memoize, chunks
 from opmuse.security import User
 import mutagen.mp3
 import mutagen.oggvorbis
@@ -61,7 +70,11 @@ __all__ = ['FileMetadata', 'library_dao', 'ApeParser', 'TrackStructureParser', '
            'StringBinaryType', 'LibraryDao', 'mutagen', 'IntegrityError', 'MpcParser', 'StructureParser',
            'LibraryProcess', 'reader', 'TagParser', 'Library', 'Id3Parser', 'WmaParser', 'Album', 'LibraryTool',
            'TagReader', 'FsParser', 'Mp4Parser', 'MutagenParser', 'MetadataStructureParser', 'TrackPath',
-           'FlacParser', 'Track', 'LibraryPlugin']
+           'FlacParser', 'Track', 'LibraryPlugin', 'parse_file', 'FileCache',
+           'hash_cache', 'audio_hash_cache', 'metadata_cache', 'ScanCheckpoint', 'LibraryDir',
+           'TrackFutures', 'track_futures', 'EntityCache', 'entity_cache', 'LibraryChange',
+           'LibraryChanges', 'library_changes', 'LibraryUpdate',
+           'TrackFuturesCron', 'LibraryChangesCron']
 
 
 def log(msg, traceback=False):
@@ -224,6 +237,11 @@ class Track(Base):
 
         return False
 
+    @low_quality.expression
+    def low_quality(cls):
+        return or_(and_(cls.format == "audio/mp3", cls.bitrate < 165000),
+                   and_(cls.format == "audio/ogg", cls.bitrate < 110000))
+
     @hybrid_property
     def exists(self):
         for path in self.paths:
@@ -320,25 +338,18 @@ class Album(Base):
     tracks = relationship("Track", order_by="Track.disc, Track.number, Track.name")
     user_and_albums = relationship("UserAndAlbum", cascade='delete, delete-orphan')
 
-    artist_count = column_property(select([func.count(distinct(Artist.id))])
-                                   .select_from(Artist.__table__.join(Track.__table__))
-                                   .where(Track.album_id == id), deferred=True)
-
-    # TODO func.max() makes no sense for Track.format... maybe we should put
+    # aggregated values updated from tracks by LibraryDao.update_aggregates()
+    artist_count = Column(Integer, nullable=False, default=0, server_default='0')
+    # TODO max() makes no sense for Track.format... maybe we should put
     #      format in a table so we can fetch the most used format in said album
     #      here instead.
-    format = column_property(select([func.max(Track.format)])
-                             .where(Track.album_id == id).correlate_except(Track), deferred=True)
-
-    disc_count = column_property(select([func.count(distinct(Track.disc))])
-                                 .where(Track.album_id == id)
-                                 .correlate_except(Track), deferred=True)
-
-    track_count = column_property(select([func.count(Track.id)])
-                                  .where(Track.album_id == id).correlate_except(Track), deferred=True)
-
-    duration = column_property(select([func.sum(Track.duration)])
-                               .where(Track.album_id == id).correlate_except(Track), deferred=True)
+    format = Column(String(128))
+    disc_count = Column(Integer, nullable=False, default=0, server_default='0')
+    track_count = Column(Integer, nullable=False, default=0, server_default='0')
+    duration = Column(Integer)
+    low_quality = Column(Boolean, nullable=False, default=False, server_default=false())
+    # comma separated list of the tracks' invalid values
+    _invalid = Column('invalid', String(255))
 
     # used for updating updated
     _updated = column_property(select([func.max(Track.updated)])
@@ -375,28 +386,12 @@ class Album(Base):
     def is_va(self):
         return self.artist_count > 1
 
-    @hybrid_property
-    def low_quality(self):
-        if len(self.tracks) == 0:
-            return False
-
-        return sum(int(track.low_quality) for track in self.tracks) > 0
-
     @hybrid_property
     def invalid(self):
-        if len(self.tracks) == 0:
+        if self._invalid is None:
             return None
 
-        invalids = set([])
-
-        for track in self.tracks:
-            if track.invalid is not None:
-                invalids.add(track.invalid)
-
-        if len(invalids) == 0:
-            return None
-        else:
-            return list(invalids)
+        return self._invalid.split(',')
 
     @hybrid_property
     def created_user(self):
@@ -467,11 +462,25 @@ class TrackPath(Base):
     dir = Column(BLOB)
     track_id = Column(Integer, ForeignKey('tracks.id', name='fk_track_paths_track_id'))
 
+    # stat values from when the path was last scanned, used for skipping
+    # unchanged files when rescanning the library
+    size = Column(BigInteger)
+    mtime = Column(BigInteger)
+    inode = Column(BigInteger)
+    device = Column(BigInteger)
+
     track = relationship("Track")
 
     def __init__(self, path):
         self.path = path
 
+    @staticmethod
+    def get_fingerprint(stat):
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev
+
+    def set_fingerprint(self, stat):
+        self.size, self.mtime, self.inode, self.device = TrackPath.get_fingerprint(stat)
+
     @validates('path')
     def _set_path(self, key, value):
         self.dir = os.path.dirname(value)
@@ -508,6 +517,44 @@ class TrackPath(Base):
         return datetime.datetime.fromtimestamp(stat.st_mtime)
 
 
+class LibraryDir(Base):
+    """
+    A dir in the library as it was when it was last scanned.
+    """
+
+    __tablename__ = 'library_dirs'
+
+    SEPARATOR = b'\0'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    path = Column(BLOB)
+    mtime = Column(BigInteger)
+    links = Column(Integer)
+    _subdirs = Column('subdirs', BLOB)
+
+    @hybrid_property
+    def subdirs(self):
+        if not self._subdirs:
+            return []
+
+        return self._subdirs.split(LibraryDir.SEPARATOR)
+
+
+class LibraryChange(Base):
+    """
+    A track, album or artist that was added, updated or deleted. The id of the
+    latest change is the library's generation.
+    """
+
+    __tablename__ = 'library_changes'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String(16))
+    entity_id = Column(Integer)
+    operation = Column(String(8))
+    created = Column(DateTime)
+
+
 class FileMetadata:
 
     def __init__(self, *args):
@@ -736,8 +783,26 @@ class FsParser(TagParser):
     move) the covers will get moved/uploaded to the relevant folder *after* all
     tracks have been moved or in the case of upload we will have a bit of
     asynchronicity at work.
+
+    Directory listings and cover matches are cached per directory, the cache is
+    invalidated when the directory's mtime changes (e.g. when a cover is added).
+    """
+
+    COVER_MATCH = [
+        re.compile(rb'.*(cover|front|folder).*\.(jpg|png|gif)$', flags=re.IGNORECASE),
+        re.compile(rb'.*\.(jpg|png|gif)$', flags=re.IGNORECASE)
+    ]
+
+    DIR_CACHE_SIZE = 64
+    """
+    How many directories to keep listings and cover matches for, tracks are
+    mostly parsed one directory at a time so this doesn't need to be big.
     """
 
+    def __init__(self):
+        self._dirs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
     def parse(self, filename, metadata):
         stat = os.stat(filename)
         updated = datetime.datetime.fromtimestamp(stat.st_mtime)
@@ -745,60 +810,100 @@ class FsParser(TagParser):
 
         track_dir = os.path.dirname(filename)
 
-        track_dir_files = []
-
-        for file in os.listdir(track_dir):
-            # ignore media files
-            if Library.is_supported(file):
-                continue
-
-            track_dir_files.append(os.path.join(track_dir, file))
+        album_cover_path = None
+        artist_cover_path = None
 
-        album_cover_match = []
+        album_slug = None
 
         if metadata is not None and metadata.album_name is not None:
             album_slug = LibraryProcess.slugify(metadata.album_name)[1]
-            album_cover_match.append(
-                (r'.*%s.*\.(jpg|png|gif)$' % re.escape(album_slug)).encode("utf8")
-            )
 
-        album_cover_match += [
-            r'.*(cover|front|folder).*\.(jpg|png|gif)$'.encode("utf8"),
-            r'.*\.(jpg|png|gif)$'.encode("utf8")
-        ]
-
-        album_cover_path = self.match_in_dir(album_cover_match, track_dir_files)
-
-        artist_cover_path = None
+        album_cover_path = self.match_cover(track_dir, album_slug, FsParser.COVER_MATCH)
 
         if metadata is not None and metadata.artist_name is not None:
             artist_slug = LibraryProcess.slugify(metadata.artist_name)[1]
 
-            artist_cover_match = [
-                (r'.*%s.*\.(jpg|png|gif)$' % re.escape(artist_slug)).encode("utf8")
-            ]
-
-            artist_cover_path = self.match_in_dir(artist_cover_match, track_dir_files)
+            artist_cover_path = self.match_cover(track_dir, artist_slug)
 
         return FileMetadata(None, None, None, None, None, updated, None, None,
                             None, None, album_cover_path, artist_cover_path,
                             None, size, None, None, None)
 
-    @staticmethod
-    def match_in_dir(match_files, files):
-        match = None
+    def match_cover(self, track_dir, slug, fallback_match=None):
+        """
+        Returns the first file in track_dir matching slug or any of the
+        fallback_match patterns, or None.
+        """
 
-        for match_file in match_files:
-            for file in files:
-                if re.match(match_file, os.path.basename(file), flags=re.IGNORECASE):
-                    match = file
-                    break
+        if fallback_match is None:
+            fallback_match = []
 
-            if match is not None:
-                break
+        files, matches = self._get_dir(track_dir)
+
+        key = (slug, len(fallback_match))
+
+        if key in matches:
+            return matches[key]
+
+        match_files = []
+
+        if slug is not None:
+            match_files.append(
+                re.compile((r'.*%s.*\.(jpg|png|gif)$' % re.escape(slug)).encode("utf8"), flags=re.IGNORECASE)
+            )
+
+        match = FsParser.match_in_dir(match_files + fallback_match, files)
+
+        matches[key] = match
 
         return match
 
+    def _get_dir(self, track_dir):
+        """
+        Returns a list of (filename, path) for all non-media files in track_dir
+        and a dict of cover matches, listing the directory if it changed since
+        it was last listed.
+        """
+
+        mtime = os.stat(track_dir).st_mtime_ns
+
+        with self._lock:
+            if track_dir in self._dirs:
+                cached = self._dirs[track_dir]
+
+                if cached[0] == mtime:
+                    self._dirs.move_to_end(track_dir)
+                    return cached[1], cached[2]
+
+        files = []
+
+        for file in os.listdir(track_dir):
+            # ignore media files
+            if Library.is_supported(file):
+                continue
+
+            files.append((file, os.path.join(track_dir, file)))
+
+        matches = {}
+
+        with self._lock:
+            self._dirs[track_dir] = (mtime, files, matches)
+            self._dirs.move_to_end(track_dir)
+
+            while len(self._dirs) > FsParser.DIR_CACHE_SIZE:
+                self._dirs.popitem(last=False)
+
+        return files, matches
+
+    @staticmethod
+    def match_in_dir(match_files, files):
+        for match_file in match_files:
+            for file, path in files:
+                if match_file.match(file):
+                    return path
+
+        return None
+
     def supported_extensions(self):
         return None
 
@@ -818,18 +923,62 @@ class TagReader:
         ]
         self._parsers = []
 
+        self.fs_parser = FsParser()
+        self._fs_parsers = [self.fs_parser]
+
         self._parsers.extend(self._mutagen_parsers)
-        self._parsers.append(FsParser())
+        self._parsers.extend(self._fs_parsers)
+
+    METADATA_CACHE_VERSION = 1
+    """
+    Bump this when the mutagen parsers change what they return, to ignore
+    metadata cached by older versions.
+    """
 
     def parse_mutagen(self, filename):
-        return self.parse(filename, self._mutagen_parsers)
+        return self._parse_cached(filename, os.stat(filename))
 
-    def parse(self, filename, parsers=None):
-        metadata = None
+    def parse(self, filename, parsers=None, stat=None):
+        """
+        When parsing with all parsers what the mutagen parsers return is
+        cached in metadata_cache. FsParser always runs as it depends on what
+        else is in the file's dir.
+
+        stat
+            the file's stat if it's already known
+        """
 
         if parsers is None:
-            parsers = self._parsers
+            if stat is None:
+                stat = os.stat(filename)
+
+            metadata = self._parse_cached(filename, stat)
+
+            return self._parse(filename, self._fs_parsers, metadata)
+
+        return self._parse(filename, parsers)
+
+    def _parse_cached(self, filename, stat):
+        value = metadata_cache.get(stat)
+
+        if value is not None:
+            try:
+                version, metadatas = pickle.loads(value)
+            except Exception:
+                version = None
+
+            if version == TagReader.METADATA_CACHE_VERSION:
+                return FileMetadata(*metadatas)
+
+        metadata = self._parse(filename, self._mutagen_parsers)
+
+        if metadata is not None:
+            metadata_cache.set(stat, pickle.dumps((TagReader.METADATA_CACHE_VERSION, metadata.metadatas),
+                                                  pickle.HIGHEST_PROTOCOL))
 
+        return metadata
+
+    def _parse(self, filename, parsers, metadata=None):
         for parser in parsers:
             if not parser.is_supported(filename):
                 continue
@@ -1013,20 +1162,229 @@ class MetadataStructureParser(StructureParser):
             }
 
 
+class ScanCheckpoint:
+    """
+    Progress of a library scan, saved in cache.path so a scan that was
+    stopped, or didn't finish for some other reason, can resume where it was
+    instead of starting over.
+
+    Progress is tracked per dir, a dir is completed when all of its files
+    that needed processing have been committed by the writer.
+    """
+
+    SAVE_INTERVAL = 10
+    """
+    How often, in seconds, progress is saved while scanning.
+    """
+
+    MAX_AGE = 24 * 60 * 60
+    """
+    Seconds after which a checkpoint is too old to resume from, when
+    library.checkpoint.max_age isn't set.
+    """
+
+    def __init__(self, library_path, path=None):
+        """
+        path
+            file to save the checkpoint in, defaults to library_scan.json in
+            cache.path. if None and there's no cache.path nothing is saved.
+        """
+
+        if path is None:
+            config = cherrypy.config.get('opmuse')
+
+            if config is not None and config.get('cache.path') is not None:
+                path = os.path.join(config.get('cache.path'), 'library_scan.json')
+
+        self.path = path
+        self.library_path = library_path
+
+        # dirs that doesn't need to be scanned again
+        self.completed = set()
+        # number of completed dirs loaded from a previous scan
+        self.resumed = 0
+        # last dir found
+        self.walk = None
+        self.updated = None
+
+        # dir => number of files left to process
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._saved = time.time()
+        self._resumed_updated = None
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            log('Failed loading scan checkpoint %s.' % self.path, traceback=True)
+            return
+
+        if checkpoint.get('library_path') != os.fsdecode(self.library_path):
+            return
+
+        config = cherrypy.config.get('opmuse')
+        max_age = ScanCheckpoint.MAX_AGE
+
+        if config is not None:
+            max_age = config.get('library.checkpoint.max_age', max_age)
+
+        if time.time() - checkpoint['updated'] > max_age:
+            log('Ignoring scan checkpoint %s, it is older than %d seconds.' % (self.path, max_age))
+            return
+
+        self.completed = set(os.fsencode(dir) for dir in checkpoint['completed'])
+        self.resumed = len(self.completed)
+        self.updated = self._resumed_updated = checkpoint['updated']
+
+        log('Resuming library update, %d dirs were completed by a previous scan.' % self.resumed)
+
+    def is_completed(self, dir, mtime=None):
+        """
+        mtime
+            of the dir in ns, a dir that was changed after the checkpoint it
+            was completed in was saved needs to be scanned again.
+        """
+
+        if dir not in self.completed:
+            return False
+
+        if (mtime is not None and self._resumed_updated is not None and
+                mtime / 1e9 > self._resumed_updated):
+            return False
+
+        return True
+
+    def found(self, dir, count):
+        """
+        Called when a dir has been listed with how many of its files are
+        going to be processed.
+        """
+
+        with self._lock:
+            self.walk = dir
+
+            if count == 0:
+                self.completed.add(dir)
+            else:
+                self._pending[dir] = count
+
+    def processed(self, filenames):
+        """
+        Called when files have been processed and committed.
+        """
+
+        with self._lock:
+            for filename in filenames:
+                dir = os.path.dirname(filename)
+
+                if dir not in self._pending:
+                    continue
+
+                self._pending[dir] -= 1
+
+                if self._pending[dir] == 0:
+                    del self._pending[dir]
+                    self.completed.add(dir)
+
+        if time.time() - self._saved >= ScanCheckpoint.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            self.updated = time.time()
+
+            checkpoint = {
+                'library_path': os.fsdecode(self.library_path),
+                'walk': None if self.walk is None else os.fsdecode(self.walk),
+                'completed': [os.fsdecode(dir) for dir in self.completed],
+                'updated': self.updated,
+            }
+
+        tmp_path = '%s.tmp' % self.path
+
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(checkpoint, f)
+
+            os.replace(tmp_path, self.path)
+        except OSError:
+            log('Failed saving scan checkpoint %s.' % self.path, traceback=True)
+
+        self._saved = time.time()
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class Library:
 
     # TODO figure out from TagParsers?
     SUPPORTED = [b"mp3", b"ogg", b"flac", b"wma", b"m4p", b"mp4", b"m4a",
                  b"ape", b"mpc", b"wav", b"mp2"]
 
-    def __init__(self, path, use_opmuse_txt):
+    BATCH_SIZE = 100
+    """
+    How many files the scanner processes in each transaction.
+    """
+
+    DEVICE_CONCURRENCY = 2
+    """
+    How many files the scanner reads at the same time from each device, by
+    default.
+    """
+
+    DELETE_CHUNK_SIZE = 500
+    """
+    How many ids to put in each "IN" clause when deleting in bulk, sqlite has
+    a limit of 999 variables per statement.
+    """
+
+    def __init__(self, path, use_opmuse_txt, incremental=True, workers=None, prune_dirs=False,
+                 device_concurrency=None):
+        """
+        incremental
+            skip files whose size, mtime, inode and device hasn't changed
+            since they were last scanned.
+
+        prune_dirs
+            when incremental, don't list dirs whose mtime and link count
+            hasn't changed since they were last scanned. note that a file
+            modified in place doesn't change its dir's mtime, so it's only
+            picked up by the watchdog, hence it's off by default.
+
+        workers
+            number of processes that parses files, defaults to the number of cpus.
+
+        device_concurrency
+            how many files to read at the same time from each device (st_dev),
+            either a number or a dict with paths as keys, e.g. mount points,
+            and numbers as values. defaults to DEVICE_CONCURRENCY. each device
+            is also walked by its own thread.
+        """
+
         self.scanning = False
         self.running = None
         self.files_found = None
+        self.files_unchanged = None
         self.processed = None
         self.path = path
         self.use_opmuse_txt = use_opmuse_txt
+        self.incremental = incremental
+        self.prune_dirs = prune_dirs
+        self.workers = workers if workers is not None else cpu_count()
+        self.device_concurrency = device_concurrency if device_concurrency is not None else Library.DEVICE_CONCURRENCY
         self.threads = []
+        self.checkpoint = None
+        self._lock = threading.Lock()
 
     @staticmethod
     def pretty_format(format):
@@ -1057,8 +1415,7 @@ class Library:
         self.processed = 0
 
         try:
-            self._database_type = get_database_type()
-            self._database = get_session()
+            self._database = get_session('scanner')
 
             # always treat paths as bytes to avoid encoding issues we don't
             # care about
@@ -1068,126 +1425,439 @@ class Library:
 
             log("Starting library update.")
 
-            old_files = 0
+            self.checkpoint = ScanCheckpoint(path)
+            self.checkpoint.load()
 
-            # remove paths that doesn't exist anymore
-            for track in self._database.query(Track).all():
-                for track_path in track.paths:
-                    # remove path if it has "moved" outside of library path or it
-                    # doesn't exist anymore. it might have been moved in which case
-                    # it will be found by the LibraryProcess and re-added to the Track
-                    if track_path.path.find(path) != 0 or not os.path.exists(track_path.path):
-                        self._database.delete(track_path)
-                        self._database.commit()
-                        old_files += 1
+            track_paths, fingerprints = self._get_track_paths()
+
+            self.files_found = 0
+            self.files_unchanged = 0
 
-            if old_files > 0:
-                log("%d old files removed from database." % old_files)
+            if self.incremental and self.prune_dirs:
+                dirs = self._get_dirs()
+            else:
+                dirs = {}
 
-            files_found = 0
+            # paths of files already in the library by dir, for unchanged dirs
+            dir_paths = collections.defaultdict(list)
 
-            queue = []
+            if len(dirs) > 0:
+                for track_path in track_paths.keys():
+                    dir_paths[os.path.dirname(track_path)].append(track_path)
 
-            for path, dirnames, filenames in os.walk(path):
-                for filename in filenames:
-                    if Library.is_supported(filename):
+            found = set()
+            walked = {}
 
-                        files_found += 1
+            # how many files that can be parsed or waiting to be written at
+            # the same time, so we don't fill up memory if the writer is slow
+            pending = threading.BoundedSemaphore(self.workers * 4)
+            results = queue.Queue()
 
-                        filename = os.path.join(path, filename)
+            # there's only one thread writing to the database, it gets the
+            # already parsed files from the process pool
+            writer = Thread(target=LibraryProcess, name="LibraryProcess_0",
+                            args=(self.use_opmuse_txt, self._parsed(results, pending), None, 0, None, self),
+                            kwargs={'batch_size': Library.BATCH_SIZE})
+            writer.start()
 
-                        queue.append(filename)
+            self.threads.append(writer)
 
-            self.files_found = files_found
+            default_concurrency, device_concurrency = self._get_device_concurrency()
 
-            log("%d files found." % files_found)
+            hash_mode = LibraryProcess.get_hash_mode()
 
-            # sqlite doesn't support threaded writes so just run one thread if
-            # that's what we have
-            if self._database_type == 'sqlite':
-                thread_num = 1
-            else:
-                thread_num = math.ceil(cpu_count() / 2)
-                thread_num = thread_num if thread_num > 2 else 2
+            # how many files that can be parsed at the same time by device
+            device_limits = {}
+            walkers = []
+
+            try:
+                with ProcessPoolExecutor(max_workers=self.workers,
+                                         mp_context=multiprocessing.get_context('forkserver')) as executor:
+                    def submit(filename, device):
+                        """
+                        Submits filename for parsing, blocks while its device or
+                        the writer is busy. Returns False if we were stopped.
+                        """
+
+                        with self._lock:
+                            if device not in device_limits:
+                                device_limits[device] = threading.BoundedSemaphore(
+                                    device_concurrency.get(device, default_concurrency)
+                                )
+
+                            device_limit = device_limits[device]
+
+                        while self.running and not device_limit.acquire(timeout=1):
+                            pass
+
+                        if not self.running:
+                            return False
+
+                        while self.running and not pending.acquire(timeout=1):
+                            # nothing will release pending if the writer died
+                            if not writer.is_alive():
+                                log('Library writer died, stopping library update.')
+                                self.running = False
+
+                        if not self.running:
+                            device_limit.release()
+                            return False
+
+                        def parsed(future):
+                            device_limit.release()
+
+                            try:
+                                results.put(future.result())
+                            except:
+                                pending.release()
+                                log('Failed parsing file.', traceback=True)
+
+                        executor.submit(parse_file, filename, hash_cache.path,
+                                        hash_mode).add_done_callback(parsed)
 
-            queue_len = len(queue)
-            chunk_size = math.ceil(queue_len / thread_num)
+                        return True
 
-            to_process = []
+                    def discover(path, device):
+                        """
+                        Starts walking path, which is on device, in a new thread.
+                        """
 
-            no = 0
+                        thread = Thread(target=self._discover, name="LibraryDiscovery_%d" % len(walkers),
+                                        args=(path, device, fingerprints, found, dir_paths, dirs, walked,
+                                              submit, discover))
 
-            for index, filename in enumerate(queue):
-                to_process.append(filename)
+                        walkers.append(thread)
+                        self.threads.append(thread)
 
-                if index > 0 and index % chunk_size == 0 or index == queue_len - 1:
-                    p = Thread(target=LibraryProcess, name="LibraryProcess_%d" % no,
-                               args=(self.use_opmuse_txt, to_process, None, no, None, self))
-                    p.start()
+                        thread.start()
 
-                    self.threads.append(p)
+                    discover(path, None)
 
-                    to_process = []
-                    no += 1
+                    # walkers start new walkers before they're done so we're
+                    # done when there's no walkers left
+                    while len(walkers) > 0:
+                        walkers.pop(0).join()
+            finally:
+                # the writer is done when it gets this, even if we failed
+                results.put(None)
 
             for thread in self.threads:
                 thread.join()
 
             self.threads = []
 
+            log("%d files found, %d unchanged since last scan." % (self.files_found, self.files_unchanged))
+
+            # remove paths that doesn't exist anymore, e.g. paths that have "moved"
+            # outside of library path or that wasn't found in it. it might have
+            # been moved in which case it will be found by the LibraryProcess and
+            # re-added to the Track.
+            #
+            # if we were stopped we don't know what files exists so we leave them.
             if self.running:
-                for track in self._database.query(Track).all():
-                    # remove tracks without any paths (e.g. removed since previous search)
-                    #
-                    # because if the file moved it will be found by the hash and just have
-                    # the new path readded as opposed to when it was completely removed
-                    # from the library path
-                    if len(track.paths) == 0:
-                        library_dao.delete_track(track, self._database)
+                old_track_path_ids = []
+
+                for track_path in track_paths.keys() - found:
+                    old_track_path_ids.extend(track_paths[track_path])
+
+                for ids in chunks(old_track_path_ids, Library.DELETE_CHUNK_SIZE):
+                    track_ids = [id for id, in self._database.query(TrackPath.track_id)
+                                 .filter(TrackPath.id.in_(ids)).distinct()]
+
+                    (self._database.query(TrackPath).filter(TrackPath.id.in_(ids))
+                     .delete(synchronize_session=False))
+
+                    library_changes.record(self._database, Track, track_ids, 'update')
+
+                self._database.commit()
+
+                if len(old_track_path_ids) > 0:
+                    log("%d old files removed from database." % len(old_track_path_ids))
+
+                self._save_dirs(walked)
+
+            if self.running:
+                # remove tracks without any paths (e.g. removed since previous search)
+                #
+                # because if the file moved it will be found by the hash and just have
+                # the new path readded as opposed to when it was completely removed
+                # from the library path
+                orphans = (self._database.query(Track.id)
+                           .filter(~Track.paths.any())
+                           .all())
+
+                library_dao.delete_tracks_by_ids([id for id, in orphans], self._database)
+
+                if len(orphans) > 0:
+                    log("%d tracks without files removed from database." % len(orphans))
 
             self._database.commit()
             self._database.remove()
 
             if self.running:
+                self.checkpoint.remove()
                 msg = "Done updating library, in {0} seconds."
             else:
+                self.checkpoint.save()
                 msg = "Stopped updating library"
 
             log(msg.format(round(time.time() - start_time)))
         except:
             log('Failed to update library.', traceback=True)
+
+            if self.checkpoint is not None:
+                self.checkpoint.save()
+
             raise
         finally:
             self.scanning = False
             self.running = False
 
-    def stop(self):
-        if self.running:
-            log("Stop updating library.")
+    def add_processed(self, filenames):
+        """
+        Called by the writer when files have been processed and committed.
+        """
 
-            self.running = False
+        with self._lock:
+            self.processed += len(filenames)
 
-            for thread in self.threads:
-                thread.join()
+        if self.checkpoint is not None:
+            self.checkpoint.processed(filenames)
 
-    @staticmethod
-    def is_supported(filename):
-        if filename is None:
-            return False
+    def _discover(self, path, device, fingerprints, found, dir_paths, dirs, walked, submit, discover):
+        """
+        Walks the part of the library that's on device and submits files that
+        needs processing as they're found. Dirs on other devices are handed
+        over to discover() so they're walked in parallel. If device is None
+        it's the device of path.
 
-        return os.path.splitext(filename)[1].lower()[1:] in Library.SUPPORTED
+        dir_paths
+            paths of files already in the library by dir, for unchanged dirs
 
+        dirs
+            LibraryDirs by path from the previous scan, dirs whose mtime and
+            link count hasn't changed since then aren't listed again.
 
-class OpmuseTxt:
-    """
-    Class for processing opmuse.txt files.
+        walked
+            gets the mtime, link count and sub dirs of all dirs walked
+        """
 
-    Because the opmuse.txt files are stored in a track's folder there will most likely
-    be one opmuse.txt for several files. This of course depends on your fs structure
-    though. Right now there's no real "priority" to which track actually gets to write
-    its data to this file, or some other summarization or whatever, whatever file in
-    whatever thread to acquire the lock first will be the authority.
-    """
+        try:
+            stack = [path]
+
+            while len(stack) > 0:
+                if not self.running:
+                    break
+
+                path = stack.pop()
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                if device is None:
+                    device = stat.st_dev
+
+                # a mount point, let another thread deal with it
+                if stat.st_dev != device:
+                    discover(path, stat.st_dev)
+                    continue
+
+                library_dir = dirs.get(path)
+
+                # nothing has been added, removed or renamed in this dir so
+                # we know what files and dirs it has without listing it
+                if (library_dir is not None and library_dir.mtime == stat.st_mtime_ns and
+                        library_dir.links == stat.st_nlink):
+                    walked[path] = (stat.st_mtime_ns, stat.st_nlink, library_dir.subdirs)
+
+                    found.update(dir_paths[path])
+
+                    count = len(dir_paths[path])
+
+                    self._count(found=count, unchanged=count, processed=count)
+
+                    self.checkpoint.found(path, 0)
+
+                    stack.extend(os.path.join(path, subdir) for subdir in reversed(library_dir.subdirs))
+
+                    continue
+
+                filenames = []
+                subdirs = []
+
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            # like os.walk() we don't follow symlinks to dirs
+                            if entry.is_dir() and not entry.is_symlink():
+                                subdirs.append(entry.name)
+                            elif Library.is_supported(entry.name):
+                                filenames.append(entry.path)
+                except OSError:
+                    continue
+
+                subdirs.sort()
+                filenames.sort()
+
+                walked[path] = (stat.st_mtime_ns, stat.st_nlink, subdirs)
+
+                stack.extend(os.path.join(path, subdir) for subdir in reversed(subdirs))
+
+                found.update(filenames)
+
+                # completed by a previous scan that was stopped, its files
+                # still need to be found so they aren't removed though.
+                if self.checkpoint.is_completed(path, stat.st_mtime_ns):
+                    self._count(found=len(filenames), processed=len(filenames))
+                    continue
+
+                queued = []
+
+                for filename in filenames:
+                    if filename in fingerprints:
+                        try:
+                            fingerprint = TrackPath.get_fingerprint(os.stat(filename))
+                        except OSError:
+                            fingerprint = None
+
+                        # the file hasn't changed since it was last scanned so
+                        # there's no need to hash, parse or store it again
+                        if fingerprint in fingerprints[filename]:
+                            continue
+
+                    queued.append(filename)
+
+                unchanged = len(filenames) - len(queued)
+
+                self._count(found=len(filenames), unchanged=unchanged, processed=unchanged)
+
+                self.checkpoint.found(path, len(queued))
+
+                for filename in queued:
+                    if not submit(filename, device):
+                        break
+        except:
+            log('Failed looking for files.', traceback=True)
+            self.running = False
+
+    def _count(self, found=0, unchanged=0, processed=0):
+        with self._lock:
+            self.files_found += found
+            self.files_unchanged += unchanged
+            self.processed += processed
+
+    def _get_device_concurrency(self):
+        """
+        Returns default concurrency and concurrency by device from
+        device_concurrency.
+        """
+
+        if not isinstance(self.device_concurrency, dict):
+            return self.device_concurrency, {}
+
+        device_concurrency = {}
+
+        for path, concurrency in self.device_concurrency.items():
+            try:
+                device_concurrency[os.stat(path).st_dev] = concurrency
+            except OSError:
+                log('Failed looking up device of %s.' % path, traceback=True)
+
+        return Library.DEVICE_CONCURRENCY, device_concurrency
+
+    def _get_dirs(self):
+        """
+        Returns LibraryDirs from the previous scan by path.
+        """
+
+        return dict((library_dir.path, library_dir) for library_dir in self._database.query(LibraryDir))
+
+    def _save_dirs(self, walked):
+        """
+        Replaces stored LibraryDirs with the dirs walked that has been completed,
+        dirs where files failed are left out so they're listed again next time.
+        """
+
+        self._database.query(LibraryDir).delete(synchronize_session=False)
+
+        rows = [{
+            'path': path,
+            'mtime': mtime,
+            'links': links,
+            'subdirs': LibraryDir.SEPARATOR.join(subdirs)
+        } for path, (mtime, links, subdirs) in walked.items() if self.checkpoint.is_completed(path)]
+
+        for chunk in chunks(rows, Library.DELETE_CHUNK_SIZE):
+            self._database.execute(LibraryDir.__table__.insert(), chunk)
+
+        self._database.commit()
+
+    @staticmethod
+    def _parsed(results, pending):
+        """
+        Yields parsed files from results until there's a None.
+        """
+
+        while True:
+            result = results.get()
+
+            if result is None:
+                break
+
+            pending.release()
+
+            yield result
+
+    def _get_track_paths(self):
+        """
+        Returns track path ids by path and, if incremental, the stored fingerprints
+        of all scanned track paths by path.
+        """
+
+        track_paths = {}
+        fingerprints = {}
+
+        query = (self._database.query(TrackPath.id, TrackPath.path, Track.scanned, TrackPath.size,
+                                      TrackPath.mtime, TrackPath.inode, TrackPath.device)
+                 .outerjoin(Track, Track.id == TrackPath.track_id))
+
+        for id, path, scanned, size, mtime, inode, device in query:
+            track_paths.setdefault(path, []).append(id)
+
+            if self.incremental and scanned and mtime is not None:
+                fingerprints.setdefault(path, set()).add((size, mtime, inode, device))
+
+        return track_paths, fingerprints
+
+    def stop(self):
+        if self.running:
+            log("Stop updating library.")
+
+            self.running = False
+
+            for thread in self.threads:
+                thread.join()
+
+    @staticmethod
+    def is_supported(filename):
+        if filename is None:
+            return False
+
+        return os.path.splitext(filename)[1].lower()[1:] in Library.SUPPORTED
+
+
+class OpmuseTxt:
+    """
+    Class for processing opmuse.txt files.
+
+    Because the opmuse.txt files are stored in a track's folder there will most likely
+    be one opmuse.txt for several files. This of course depends on your fs structure
+    though. Right now there's no real "priority" to which track actually gets to write
+    its data to this file, or some other summarization or whatever, whatever file in
+    whatever thread to acquire the lock first will be the authority.
+    """
 
     TRIES = 20
     """
@@ -1288,13 +1958,15 @@ class OpmuseTxt:
 
 class LibraryProcess:
     def __init__(self, use_opmuse_txt, queue, database=None, no=-1,
-                 tracks=None, library=None, user=None, artist_name_fallback=None):
+                 tracks=None, library=None, user=None, artist_name_fallback=None,
+                 batch_size=1):
         """
         use_opmuse_txt
             whether a opmuse.txt file should be created in tracks dir or not.
 
         queue
-            list of file paths to process
+            list of file paths to process or an iterable of files already
+            parsed by parse_file()
 
         database
             database connection to use, if None we'll create a new connection
@@ -1313,22 +1985,25 @@ class LibraryProcess:
 
         artist_name_fallback
             If we can't find an artist name in the metadata use this for artist name
-        """
 
-        self.no = no
-        self.user = user
-        self.use_opmuse_txt = use_opmuse_txt
+        batch_size
+            how many files to process in each transaction, when larger than 1
+            artists and albums are also kept in maps by name instead of relying
+            on IntegrityErrors to detect existing ones.
+        """
 
-        queue_len = len(queue)
+        self._init(use_opmuse_txt, database, no, user, batch_size)
 
-        log('Process %d about to process %d files.' % (self.no, queue_len))
+        # when fed from the scanner pipeline the queue is an iterator so we
+        # don't know how many files there are beforehand
+        queue_len = len(queue) if isinstance(queue, list) else None
 
-        if database is None:
-            self._database = get_session()
+        if queue_len is not None:
+            log('Process %d about to process %d files.' % (self.no, queue_len))
         else:
-            self._database = database
+            log('Process %d about to process files.' % self.no)
 
-        count = 1
+        count = 0
         processed = 0
         start = time.time()
 
@@ -1337,149 +2012,215 @@ class LibraryProcess:
         artist_ids = set()
         album_ids = set()
 
-        for filename in queue:
+        batch = []
+
+        for item in queue:
             if library is not None and library.running is False:
                 stopped = True
 
-            try:
-                track = self.process(filename, artist_name_fallback)
-            except:
-                log('Failed processing %s' % filename.decode('utf8', 'replace'), traceback=True)
-                continue
-
-            if tracks is not None:
-                tracks.append(track)
-
-            if track.artist_id is not None:
-                artist_ids.add(track.artist_id)
-
-            if track.album_id is not None:
-                album_ids.add(track.album_id)
+            # items are either file paths or files already parsed by parse_file()
+            if isinstance(item, tuple):
+                batch.append((item[0], item[1:]))
+            else:
+                batch.append((item, None))
 
-            # update aggregated values every 1000 tracks, to avoid these
-            # queries becoming huge and more evenly distributing the load of 'em
-            if count == 1000 or processed + 1 == queue_len or stopped:
-                tries = 10
+            if len(batch) < self.batch_size and not stopped:
+                continue
 
-                for artist in self._database.query(Artist).filter(Artist.id.in_(artist_ids)).all():
-                    # try 10 times when we get a deadlock and then give up
-                    for i in range(0, tries):
-                        try:
-                            # update aggregated artist.updated value based on artist._updated
-                            artist.updated = artist._updated
-                            artist.created = artist._created
+            tracks_saved, saved = self._process_batch(batch, artist_name_fallback)
 
-                            self._database.commit()
-                            break
-                        except ProgrammingError:
-                            if i == tries - 1:
-                                log("Failed updating artist aggregated values.", traceback=True)
-                                break
+            for track in tracks_saved:
+                if tracks is not None:
+                    tracks.append(track)
 
-                            self._database.rollback()
-                            time.sleep(.1)
+                if track.artist_id is not None:
+                    artist_ids.add(track.artist_id)
 
-                artist_ids.clear()
+                if track.album_id is not None:
+                    album_ids.add(track.album_id)
 
-                for album in self._database.query(Album).filter(Album.id.in_(album_ids)).all():
-                    # try 10 times when we get a deadlock and then give up
-                    for i in range(0, tries):
-                        try:
-                            # update aggregated album.updated value based on album._updated
-                            album.updated = album._updated
-                            album.created = album._created
+            count += len(batch)
+            processed += len(batch)
 
-                            self._database.commit()
-                            break
-                        except ProgrammingError:
-                            if i == tries - 1:
-                                log("Failed updating album aggregated values.", traceback=True)
-                                break
+            if library is not None:
+                library.add_processed(saved)
 
-                            self._database.rollback()
-                            time.sleep(.1)
+            batch = []
 
-                album_ids.clear()
+            # update aggregated values every 1000 tracks, to avoid these
+            # queries becoming huge and more evenly distributing the load of 'em
+            if count >= 1000 or stopped:
+                self.update_aggregates(artist_ids, album_ids)
 
                 log('Process %d processed %d files in %d seconds.' %
                     (self.no, count, time.time() - start))
                 start = time.time()
                 count = 0
 
-            count += 1
-            processed += 1
-
-            if library is not None:
-                library.processed += 1
+            # keep memory usage down when processing lots of files
+            if self.batch_size > 1:
+                self._database.expunge_all()
 
             if stopped:
                 break
 
+        if len(batch) > 0:
+            tracks_saved, saved = self._process_batch(batch, artist_name_fallback)
+
+            for track in tracks_saved:
+                if tracks is not None:
+                    tracks.append(track)
+
+                if track.artist_id is not None:
+                    artist_ids.add(track.artist_id)
+
+                if track.album_id is not None:
+                    album_ids.add(track.album_id)
+
+            processed += len(batch)
+
+            if library is not None:
+                library.add_processed(saved)
+
+        if len(artist_ids) > 0 or len(album_ids) > 0:
+            self.update_aggregates(artist_ids, album_ids)
+
         if database is None:
             self._database.remove()
 
-        queue_len = len(queue)
-
         if stopped:
-            msg = 'Process {0} was stopped, {1} of {2} ({3}%) files processed.'
+            if queue_len is not None:
+                msg = 'Process {0} was stopped, {1} of {2} ({3}%) files processed.'
+            else:
+                msg = 'Process {0} was stopped, {1} files processed.'
         else:
-            msg = 'Process {0} is done processing all {2} files.'
+            msg = 'Process {0} is done processing all {1} files.'
 
-        log(msg.format(self.no, processed, queue_len, round((processed / queue_len) * 100)))
+        log(msg.format(self.no, processed, queue_len,
+                       round((processed / queue_len) * 100) if queue_len else None))
 
-    def process(self, filename, artist_name_fallback=None):
-        hash = LibraryProcess.get_hash(filename)
+    def _init(self, use_opmuse_txt, database, no=-1, user=None, batch_size=1):
+        self.no = no
+        self.user = user
+        self.use_opmuse_txt = use_opmuse_txt
 
-        if self.use_opmuse_txt:
-            opmuse_txt = OpmuseTxt(filename)
+        if database is None:
+            self._database = get_session('scanner')
         else:
-            opmuse_txt = None
+            self._database = database
 
-        try:
-            track = Track(hash)
-            self._database.add(track)
-            self._database.commit()
-        except IntegrityError:
-            self._database.rollback()
-            track = self._database.query(Track).filter_by(hash=hash).one()
+        self.batch_size = batch_size
 
-            if track.scanned:
-                # if this file isnt part of the track's paths then add it.
-                # it might just have moved and we add it here and the other
-                # one will be removed last in the scanning process...
-                if filename not in [path.path for path in track.paths]:
-                    track_path = TrackPath(filename)
-                    track_path.track_id = track.id
+        self._artists = {}
+        self._albums = {}
 
-                    self._database.add(track_path)
+        # existing tracks whose files has changed, updated after each batch
+        self._changed = []
 
-                    self._database.commit()
+        # artists, albums and tracks added in the current batch, they're added
+        # to search once it's committed
+        self._unindexed = []
+
+    def update_aggregates(self, artist_ids, album_ids):
+        """
+        Updates aggregated values of artists and albums and clears the sets.
+        """
 
-                if opmuse_txt is not None:
-                    opmuse_txt.process(self._database, track)
+        library_dao.update_aggregates(artist_ids, album_ids, self._database)
 
-                return track
+        artist_ids.clear()
+        album_ids.clear()
+
+    def process(self, filename, artist_name_fallback=None, parsed=None, batched=False):
+        """
+        parsed
+            stat, hash and metadata as returned by parse_file(), if None they're
+            read from the file.
+
+        batched
+            if True nothing is committed, changes are only flushed and it's up
+            to the caller to commit. artists and albums are looked up in maps
+            kept by this instance instead of relying on IntegrityErrors.
+        """
 
-        metadata = reader.parse(filename)
+        if parsed is not None:
+            stat, hash, metadata = parsed
+        else:
+            stat, hash = LibraryProcess.hash_file(filename)
+            metadata = None
 
-        # change track slug until successful
-        track_slug_index, track.slug = self.get_track_slug(metadata)
+        if self.use_opmuse_txt:
+            opmuse_txt = OpmuseTxt(filename)
+        else:
+            opmuse_txt = None
 
-        i = 0
+        if batched:
+            track = self._database.query(Track).filter_by(hash=hash).first()
 
-        while True:
-            i += 1
+            if track is None:
+                track = Track(hash)
+                self._database.add(track)
+                self._database.flush()
 
+                exists = False
+            else:
+                exists = True
+        else:
             try:
+                track = Track(hash)
+                self._database.add(track)
                 self._database.commit()
-                break
+
+                exists = False
             except IntegrityError:
                 self._database.rollback()
+                track = self._database.query(Track).filter_by(hash=hash).one()
+
+                exists = True
+
+        if exists and track.scanned:
+            # if this file isnt part of the track's paths then add it.
+            # it might just have moved and we add it here and the other
+            # one will be removed last in the scanning process...
+            for track_path in track.paths:
+                if track_path.path == filename:
+                    # the file changed but kept its hash, e.g. its tags was
+                    # edited with library.hash_mode set to "audio". paths
+                    # scanned before fingerprints was stored are just given
+                    # one below.
+                    if (track_path.size is not None and track not in self._changed and
+                            (track_path.size, track_path.mtime, track_path.inode,
+                             track_path.device) != TrackPath.get_fingerprint(stat)):
+                        if metadata is None:
+                            metadata = reader.parse(filename, stat=stat)
+
+                        # e.g. touched, nothing to update
+                        if LibraryProcess._metadata_changed(track, metadata):
+                            self._changed.append(track)
+
+                    break
+            else:
+                track_path = TrackPath(filename)
+                track_path.track_id = track.id
+
+                self._database.add(track_path)
+
+            track_path.set_fingerprint(stat)
 
-                track_slug_index, track.slug = self.get_track_slug(metadata, track_slug_index + i)
+            self._commit(batched)
 
-        artist = None
-        album = None
+            if opmuse_txt is not None:
+                opmuse_txt.process(self._database, track)
+
+            return track
+
+        if metadata is None:
+            metadata = reader.parse(filename, stat=stat)
+
+        self._set_slug(track, self.get_track_slug, metadata, batched)
+
+        artist_id = None
+        album_id = None
 
         if metadata.artist_name is None:
             artist_name = artist_name_fallback
@@ -1487,72 +2228,114 @@ class LibraryProcess:
             artist_name = metadata.artist_name
 
         if artist_name is not None:
-            try:
-                artist = Artist(artist_name)
+            if batched:
+                artist_id = self._get_artist_id(artist_name, metadata)
+            else:
+                try:
+                    artist = Artist(artist_name)
 
-                self._database.add(artist)
-                self._database.commit()
+                    self._database.add(artist)
+                    self._database.commit()
 
-                search.add_artist(artist)
-            except IntegrityError:
-                # we get an IntegrityError if the unique constraint kicks in
-                # in which case the artist already exists so fetch it instead.
-                self._database.rollback()
-                artist = self._database.query(Artist).filter_by(
-                    name=artist_name
-                ).one()
+                    search.add_artist(artist)
+                except IntegrityError:
+                    # we get an IntegrityError if the unique constraint kicks in
+                    # in which case the artist already exists so fetch it instead.
+                    self._database.rollback()
+                    artist = self._database.query(Artist).filter_by(
+                        name=artist_name
+                    ).one()
 
-            # change artist slug until successful
-            artist_slug_index, artist.slug = self.get_artist_slug(metadata)
+                self._set_slug(artist, self.get_artist_slug, metadata)
 
-            i = 0
+                if artist.cover_path is None:
+                    artist.cover_path = metadata.artist_cover_path
+                    self._database.commit()
 
-            while True:
-                i += 1
+                artist_id = artist.id
 
+        if metadata.album_name is not None:
+            if batched:
+                album_id = self._get_album_id(metadata)
+            else:
                 try:
+                    album = Album(metadata.album_name, metadata.date, None, metadata.cover_path, None)
+                    self._database.add(album)
                     self._database.commit()
-                    break
+                    search.add_album(album)
                 except IntegrityError:
                     self._database.rollback()
+                    album = self._database.query(Album).filter_by(
+                        name=metadata.album_name, date=metadata.date
+                    ).one()
 
-                    artist_slug_index, artist.slug = self.get_artist_slug(metadata, artist_slug_index + i)
+                self._set_slug(album, self.get_album_slug, metadata)
 
-        if metadata.album_name is not None:
-            try:
-                album = Album(metadata.album_name, metadata.date, None, metadata.cover_path, None)
-                self._database.add(album)
-                self._database.commit()
-                search.add_album(album)
-            except IntegrityError:
-                self._database.rollback()
-                album = self._database.query(Album).filter_by(
-                    name=metadata.album_name, date=metadata.date
-                ).one()
+                if album.cover_path is None:
+                    album.cover_path = metadata.cover_path
+                    self._database.commit()
 
-            # change album slug until successful
-            album_slug_index, album.slug = self.get_album_slug(metadata)
+                album_id = album.id
 
-            i = 0
+        self._set_values(track, filename, metadata)
 
-            while True:
-                i += 1
+        track.created = metadata.updated
 
-                try:
-                    self._database.commit()
-                    break
-                except IntegrityError:
-                    self._database.rollback()
+        if album_id is not None:
+            track.album_id = album_id
 
-                    album_slug_index, album.slug = self.get_album_slug(metadata, album_slug_index + i)
+        if artist_id is not None:
+            track.artist_id = artist_id
 
-        if album is not None and album.cover_path is None:
-            album.cover_path = metadata.cover_path
-            self._database.commit()
+        track_path = TrackPath(filename)
+        track_path.track_id = track.id
+        track_path.set_fingerprint(stat)
 
-        if artist is not None and artist.cover_path is None:
-            artist.cover_path = metadata.artist_cover_path
-            self._database.commit()
+        self._database.add(track_path)
+
+        track.created_user = self.user
+
+        track.scanned = True
+
+        if opmuse_txt is not None:
+            opmuse_txt.process(self._database, track)
+
+        self._commit(batched)
+
+        if batched:
+            self._unindexed.append(track)
+        else:
+            search.add_track(track)
+
+        return track
+
+    @staticmethod
+    def _metadata_changed(track, metadata):
+        """
+        Returns True if metadata read from track's file differs from what's
+        stored for track.
+        """
+
+        if metadata.artist_name is not None and (track.artist is None or
+                                                 track.artist.name != metadata.artist_name):
+            return True
+
+        if track.album is None:
+            album = (None, None)
+        else:
+            album = (track.album.name, track.album.date)
+
+        if album != (metadata.album_name, metadata.date if metadata.album_name is not None else None):
+            return True
+
+        return ((track.name, track.number, track.disc, track.genre, track.size) !=
+                (metadata.track_name, LibraryProcess.fix_track_number(metadata.track_number), metadata.disc,
+                 metadata.genre, metadata.size))
+
+    def _set_values(self, track, filename, metadata):
+        """
+        Sets track's values read from filename's metadata.
+        """
 
         ext = os.path.splitext(filename)[1].lower()
 
@@ -1580,7 +2363,6 @@ class LibraryProcess:
         track.number = LibraryProcess.fix_track_number(metadata.track_number)
         track.format = format
         track.updated = metadata.updated
-        track.created = metadata.updated
         track.bitrate = metadata.bitrate
         track.sample_rate = metadata.sample_rate
         track.mode = metadata.mode
@@ -1590,6 +2372,7 @@ class LibraryProcess:
 
         if metadata.invalid == ['valid']:
             track.invalid = None
+            track.invalid_msg = None
         else:
             invalid = metadata.invalid
 
@@ -1601,29 +2384,373 @@ class LibraryProcess:
             track.invalid = invalid[0] if len(invalid) > 0 else ''
             track.invalid_msg = metadata.invalid_msg
 
-        if album is not None:
-            track.album_id = album.id
+    def _commit(self, batched):
+        if batched:
+            self._database.flush()
+        else:
+            self._database.commit()
 
-        if artist is not None:
-            track.artist_id = artist.id
+    def _set_slug(self, entity, get_slug, metadata, batched=False):
+        entity.slug = self.allocate_slug(entity, get_slug, metadata)
 
-        track_path = TrackPath(filename)
-        track_path.track_id = track.id
+        if batched:
+            self._database.flush()
+        else:
+            while True:
+                try:
+                    self._database.commit()
+                    break
+                except IntegrityError:
+                    # someone else took the slug between us allocating and
+                    # committing it, e.g. an upload during a scan.
+                    self._database.rollback()
 
-        self._database.add(track_path)
+                    entity.slug = self.allocate_slug(entity, get_slug, metadata)
 
-        track.created_user = self.user
+    def allocate_slug(self, entity, get_slug, metadata):
+        """
+        Returns the first free slug for entity. All slugs prefixed by the
+        unsuffixed slug are fetched in one query and the suffix is picked from
+        those, instead of trying one suffix at a time.
 
-        track.scanned = True
+        entity
+            Track, Album or Artist to allocate slug for
 
-        if opmuse_txt is not None:
-            opmuse_txt.process(self._database, track)
+        get_slug
+            one of get_track_slug, get_album_slug or get_artist_slug
+        """
+
+        Entity = type(entity)
+
+        index, slug = get_slug(metadata)
+
+        prefix = slug
+
+        query = (self._database.query(Entity.slug)
+                 .filter(or_(Entity.slug == prefix, Entity.slug.startswith('%s_' % prefix, autoescape=True))))
+
+        if entity.id is not None:
+            query = query.filter(Entity.id != entity.id)
+
+        taken = set(row.slug for row in query.all())
+
+        def is_taken(slug):
+            if slug == prefix or slug.startswith('%s_' % prefix):
+                return slug in taken
+
+            # suffixed slugs don't always share the prefix, e.g. when the name
+            # is truncated to make room for the suffix, look these up separately
+            query = self._database.query(Entity.id).filter(Entity.slug == slug)
+
+            if entity.id is not None:
+                query = query.filter(Entity.id != entity.id)
+
+            return query.first() is not None
+
+        while is_taken(slug):
+            index, slug = get_slug(metadata, index + 1)
+
+        return slug
+
+    def _get_artist_id(self, artist_name, metadata):
+        """
+        Returns id of artist with this name, adds it if it doesn't exist. Used
+        when batching.
+        """
+
+        if artist_name not in self._artists:
+            artist = self._database.query(Artist).filter_by(name=artist_name).first()
+
+            if artist is None:
+                artist = Artist(artist_name)
+
+                self._database.add(artist)
+                self._database.flush()
+
+                self._set_slug(artist, self.get_artist_slug, metadata, True)
+
+                self._unindexed.append(artist)
+
+            self._artists[artist_name] = [artist.id, artist.cover_path is not None]
+
+        artist_id, has_cover = self._artists[artist_name]
+
+        if not has_cover and metadata.artist_cover_path is not None:
+            (self._database.query(Artist)
+             .filter(Artist.id == artist_id, Artist.cover_path.is_(None))
+             .update({'cover_path': metadata.artist_cover_path}, synchronize_session=False))
+
+            library_changes.record(self._database, Artist, [artist_id], 'update')
+
+            self._artists[artist_name][1] = True
+
+        return artist_id
+
+    def _get_album_id(self, metadata):
+        """
+        Returns id of album with metadata's name and date, adds it if it doesn't
+        exist. Used when batching.
+        """
+
+        key = (metadata.album_name, metadata.date)
+
+        if key not in self._albums:
+            album = self._database.query(Album).filter_by(name=metadata.album_name, date=metadata.date).first()
+
+            if album is None:
+                album = Album(metadata.album_name, metadata.date, None, metadata.cover_path, None)
+
+                self._database.add(album)
+                self._database.flush()
+
+                self._set_slug(album, self.get_album_slug, metadata, True)
+
+                self._unindexed.append(album)
+
+            self._albums[key] = [album.id, album.cover_path is not None]
+
+        album_id, has_cover = self._albums[key]
+
+        if not has_cover and metadata.cover_path is not None:
+            (self._database.query(Album)
+             .filter(Album.id == album_id, Album.cover_path.is_(None))
+             .update({'cover_path': metadata.cover_path}, synchronize_session=False))
+
+            library_changes.record(self._database, Album, [album_id], 'update')
+
+            self._albums[key][1] = True
+
+        return album_id
+
+    def _process_batch(self, batch, artist_name_fallback):
+        """
+        Processes and commits a batch of files in one transaction. If that fails
+        for any reason the files are processed one by one instead. Returns the
+        tracks and the filenames that was saved, files that failed are left out.
+        """
+
+        tracks = []
+        saved = []
+
+        if self.batch_size > 1:
+            try:
+                for filename, parsed in batch:
+                    tracks.append(self.process(filename, artist_name_fallback, parsed, batched=True))
+
+                self._database.commit()
+            except:
+                log('Failed processing batch of %d files, processing them one by one.' % len(batch),
+                    traceback=True)
+
+                self._database.rollback()
+
+                # the maps might contain ids that was rolled back
+                self._artists.clear()
+                self._albums.clear()
+
+                tracks = []
+                self._changed = []
+                self._unindexed = []
+            else:
+                self._add_unindexed()
+
+                self._update_changed()
+
+                track_futures.resolve_tracks(tracks)
+
+                return tracks, [filename for filename, parsed in batch]
+
+        for filename, parsed in batch:
+            try:
+                tracks.append(self.process(filename, artist_name_fallback, parsed))
+            except:
+                log('Failed processing %s' % filename.decode('utf8', 'replace'), traceback=True)
+            else:
+                saved.append(filename)
+
+        self._update_changed()
+
+        track_futures.resolve_tracks(tracks)
+
+        return tracks, saved
+
+    def _add_unindexed(self):
+        """
+        Adds artists, albums and tracks of the committed batch to search.
+        """
+
+        unindexed = self._unindexed
+        self._unindexed = []
+
+        for entity in unindexed:
+            if isinstance(entity, Artist):
+                search.add_artist(entity)
+            elif isinstance(entity, Album):
+                search.add_album(entity)
+            else:
+                search.add_track(entity)
+
+    def _update_changed(self):
+        """
+        Updates existing tracks whose files changed while processing.
+        """
+
+        if len(self._changed) == 0:
+            return
+
+        changed = self._changed
+        self._changed = []
+
+        try:
+            self.update(changed)
+        except:
+            log('Failed updating %d changed tracks.' % len(changed), traceback=True)
+
+            self._database.rollback()
+
+            self._unindexed = []
+
+        # the maps might contain artists and albums that was renamed or removed
+        self._artists.clear()
+        self._albums.clear()
+
+    def update(self, tracks):
+        """
+        Updates existing tracks from their files, e.g. after their tags has
+        been edited, instead of adding them anew. Artists and albums that only
+        has tracks among these are renamed rather than replaced and those left
+        without tracks are removed.
+        """
+
+        track_ids = set(track.id for track in tracks)
+
+        old_artists = set(track.artist for track in tracks if track.artist is not None)
+        old_albums = set(track.album for track in tracks if track.album is not None)
+
+        renamable = set()
+
+        for Entity, column, entities in ((Artist, Track.artist_id, old_artists),
+                                         (Album, Track.album_id, old_albums)):
+            if len(entities) == 0:
+                continue
+
+            shared = set(row[0] for row in (self._database.query(column)
+                                            .filter(column.in_([entity.id for entity in entities]),
+                                                    Track.id.notin_(track_ids))
+                                            .distinct()))
+
+            renamable.update((Entity, entity.id) for entity in entities if entity.id not in shared)
+
+        for track in tracks:
+            self._update_track(track, renamable)
 
         self._database.commit()
 
-        search.add_track(track)
+        self._add_unindexed()
 
-        return track
+        artist_ids = set(artist.id for artist in old_artists)
+        album_ids = set(album.id for album in old_albums)
+
+        for track in tracks:
+            if track.artist_id is not None:
+                artist_ids.add(track.artist_id)
+
+            if track.album_id is not None:
+                album_ids.add(track.album_id)
+
+        for album in old_albums:
+            if self._database.query(Track.id).filter(Track.album_id == album.id).first() is None:
+                album_ids.discard(album.id)
+                library_dao.delete_album(album, self._database)
+
+        for artist in old_artists:
+            if self._database.query(Track.id).filter(Track.artist_id == artist.id).first() is None:
+                artist_ids.discard(artist.id)
+                library_dao.delete_artist(artist, self._database)
+
+        self.update_aggregates(artist_ids, album_ids)
+
+    def _update_track(self, track, renamable):
+        """
+        Updates track from its files, renaming its artist or album if they're
+        in renamable and no artist or album with the new name exists.
+        """
+
+        metadata = None
+
+        for track_path in track.paths:
+            stat, hash = LibraryProcess.hash_file(track_path.path)
+
+            track_path.set_fingerprint(stat)
+
+            if metadata is not None:
+                continue
+
+            metadata = reader.parse(track_path.path, stat=stat)
+
+            # keep the old hash if the file now is identical to another track
+            if self._database.query(Track.id).filter(Track.hash == hash, Track.id != track.id).first() is None:
+                track.hash = hash
+
+            self._set_values(track, track_path.path, metadata)
+
+        if metadata is None:
+            return
+
+        artist_id = None
+
+        if metadata.artist_name is not None:
+            artist = track.artist
+
+            # rename the old artist instead of adding a new one, unless
+            # there already is one with the new name
+            if (artist is not None and (Artist, artist.id) in renamable and
+                    artist.name != metadata.artist_name and
+                    self._database.query(Artist.id).filter_by(name=metadata.artist_name).first() is None):
+                self._artists.pop(artist.name, None)
+
+                artist.name = metadata.artist_name
+
+                self._database.flush()
+
+                self._set_slug(artist, self.get_artist_slug, metadata, True)
+
+                self._unindexed.append(artist)
+
+            artist_id = self._get_artist_id(metadata.artist_name, metadata)
+
+            renamable.discard((Artist, artist_id))
+
+        album_id = None
+
+        if metadata.album_name is not None:
+            album = track.album
+
+            if (album is not None and (Album, album.id) in renamable and
+                    (album.name != metadata.album_name or album.date != metadata.date) and
+                    self._database.query(Album.id).filter_by(name=metadata.album_name,
+                                                             date=metadata.date).first() is None):
+                self._albums.pop((album.name, album.date), None)
+
+                album.name = metadata.album_name
+                album.date = metadata.date
+
+                self._database.flush()
+
+                self._set_slug(album, self.get_album_slug, metadata, True)
+
+                self._unindexed.append(album)
+
+            album_id = self._get_album_id(metadata)
+
+            renamable.discard((Album, album_id))
+
+        track.artist = self._database.query(Artist).get(artist_id) if artist_id is not None else None
+        track.album = self._database.query(Album).get(album_id) if album_id is not None else None
+
+        self._set_slug(track, self.get_track_slug, metadata, True)
+
+        self._unindexed.append(track)
 
     @staticmethod
     def fix_track_number(number):
@@ -1707,118 +2834,381 @@ class LibraryProcess:
 
     @staticmethod
     def get_hash(filename):
-        import mmh3
+        return LibraryProcess.hash_file(filename)[1]
 
-        byte_size = 1024 * 128
+    @staticmethod
+    def get_hash_mode():
+        """
+        Returns library.hash_mode, how files are identified. Either "file" or
+        "audio", see hash_file().
+        """
 
-        with open(filename, "rb", 0) as f:
-            # fetch first 128k and last 128k to get a reasonably secure
-            # unique set of bytes from this file. also because id3 tags
-            # might be located at the end or the beginning of a file,
-            # we want to be able to detect changes to them
+        config = cherrypy.config.get('opmuse')
 
-            if os.path.getsize(filename) < byte_size * 2:
-                bytes = f.read()
-            else:
-                begin_bytes = f.read(byte_size)
-                f.seek(-byte_size, io.SEEK_END)
-                end_bytes = f.read(byte_size)
-                bytes = begin_bytes + end_bytes
+        if config is not None and config.get('library.hash_mode') is not None:
+            return config.get('library.hash_mode')
 
-            return base64.b64encode(mmh3.hash_bytes(bytes))
+        return 'file'
 
+    @staticmethod
+    def hash_file(filename, mode=None):
+        """
+        Returns stat and hash of file. The stat is read from the same file
+        descriptor as the hash and the hash is looked up in hash_cache first.
 
-class LibraryDao:
+        mode
+            "file" hashes the beginning and end of the file, "audio" the
+            beginning and end of the audio data so tags can change without
+            changing the hash. Defaults to library.hash_mode.
+        """
 
-    def get_listened_tracks_by_timestmap(self, timestamp):
-        return (get_database().query(ListenedTrack).order_by(ListenedTrack.timestamp.desc())
-                .filter(ListenedTrack.timestamp > timestamp).all())
+        import mmh3
 
-    def get_listened_tracks(self, limit):
-        return get_database().query(ListenedTrack).order_by(ListenedTrack.timestamp.desc()).limit(limit).all()
+        if mode is None:
+            mode = LibraryProcess.get_hash_mode()
 
-    def get_listened_track_by_artist_name(self, user_id, artist_name):
-        try:
-            return (get_database().query(ListenedTrack)
-                    .filter(ListenedTrack.user_id == user_id, ListenedTrack.artist_name == artist_name)
-                    .order_by(ListenedTrack.timestamp.desc()).limit(1).one())
-        except NoResultFound:
-            return None
+        if mode == 'audio':
+            cache = audio_hash_cache
+        elif mode == 'file':
+            cache = hash_cache
+        else:
+            raise ValueError('Unknown hash mode %s.' % mode)
 
-    def get_listened_tuples_by_artist_name_for_users(self, artist_name):
-        try:
-            return (get_database().query(ListenedTrack.user_id, func.max(ListenedTrack.timestamp))
-                    .filter(ListenedTrack.artist_name == artist_name)
-                    .group_by(ListenedTrack.user_id)
-                    .order_by(ListenedTrack.timestamp.desc()).all())
-        except NoResultFound:
-            return None
+        byte_size = 1024 * 128
+
+        fd = os.open(filename, os.O_RDONLY)
 
-    def get_listened_artist_name_count(self, user_id, start_date=None, end_date=None, limit=None):
         try:
-            query = (get_database().query(ListenedTrack.artist_name, func.count(ListenedTrack.id).label('count'))
-                     .filter(ListenedTrack.user_id == user_id)
-                     .group_by(ListenedTrack.artist_name)
-                     .order_by(text('count DESC')))
+            stat = os.fstat(fd)
 
-            if start_date is not None:
-                query = query.filter(ListenedTrack.timestamp > int(start_date.timestamp()))
+            hash = cache.get(stat)
 
-            if end_date is not None:
-                query = query.filter(ListenedTrack.timestamp < int(end_date.timestamp()))
+            if hash is not None:
+                return stat, hash
 
-            if limit is not None:
-                query = query.limit(limit)
+            if mode == 'audio':
+                start, end = LibraryProcess.get_audio_range(fd, stat.st_size)
+            else:
+                # fetch first 128k and last 128k to get a reasonably secure
+                # unique set of bytes from this file. also because id3 tags
+                # might be located at the end or the beginning of a file,
+                # we want to be able to detect changes to them
+                start, end = 0, stat.st_size
+
+            if end - start < byte_size * 2:
+                bytes = os.pread(fd, end - start, start)
+            else:
+                if hasattr(os, 'posix_fadvise'):
+                    # have the kernel start reading both ends right away
+                    os.posix_fadvise(fd, start, byte_size, os.POSIX_FADV_WILLNEED)
+                    os.posix_fadvise(fd, end - byte_size, byte_size, os.POSIX_FADV_WILLNEED)
 
-            return query.all()
-        except NoResultFound:
-            return None
+                bytes = os.pread(fd, byte_size, start) + os.pread(fd, byte_size, end - byte_size)
+        finally:
+            os.close(fd)
 
-    def get_listened_tuples_by_artist_name_and_album_name_for_users(self, artist_name, album_name):
-        try:
-            return (get_database().query(ListenedTrack.user_id, func.max(ListenedTrack.timestamp))
-                    .filter(ListenedTrack.artist_name == artist_name, ListenedTrack.album_name == album_name)
-                    .group_by(ListenedTrack.user_id)
-                    .order_by(ListenedTrack.timestamp.desc()).all())
-        except NoResultFound:
-            return None
+        hash = base64.b64encode(mmh3.hash_bytes(bytes))
 
-    def get_listened_track_by_artist_name_and_album_name(self, user_id, artist_name, album_name):
-        try:
-            return (get_database().query(ListenedTrack)
-                    .filter(ListenedTrack.user_id == user_id, ListenedTrack.artist_name == artist_name,
-                            ListenedTrack.album_name == album_name)
-                    .order_by(ListenedTrack.timestamp.desc()).limit(1).one())
-        except NoResultFound:
-            return None
+        cache.set(stat, hash)
 
-    def get_listened_tracks_count(self, user_id):
-        return (get_database().query(func.count(ListenedTrack.id))
-                .filter(ListenedTrack.user_id == user_id).scalar())
+        return stat, hash
 
-    def get_listened_track_max_timestamp(self, user_id):
-        return (get_database().query(func.max(ListenedTrack.timestamp))
-                .filter(ListenedTrack.user_id == user_id).scalar())
+    @staticmethod
+    def get_audio_range(fd, size):
+        """
+        Returns start and end offset of the audio data in file, skipping id3v2
+        tags and flac metadata blocks at the start and id3v1 and apev2 tags at
+        the end. Formats keeping tags elsewhere, e.g. ogg and mp4, get the
+        whole file.
+        """
 
-    def add_listened_track(self, user_id, name, artist_name, album_name, timestamp):
-        listened_track = ListenedTrack(user_id, name, artist_name, album_name, timestamp)
+        start = 0
+        end = size
 
-        get_database().add(listened_track)
-        get_database().commit()
+        while True:
+            header = os.pread(fd, 10, start)
 
-    def delete_listened_tracks(self, user_id):
-        return (get_database().query(ListenedTrack)
-                .filter(ListenedTrack.user_id == user_id).delete())
+            if len(header) < 10 or header[:3] != b'ID3':
+                break
 
-    def delete_track(self, track, database=None):
-        if database is None:
-            database = get_database()
+            # tag size is a syncsafe integer and doesn't include the header
+            # nor the footer
+            tag_size = 0
 
-        album = track.album
-        artist = track.artist
+            for byte in header[6:10]:
+                tag_size = (tag_size << 7) | (byte & 0x7f)
 
-        database.delete(track)
-        database.commit()
+            start += 10 + tag_size + (10 if header[5] & 0x10 else 0)
+
+        if os.pread(fd, 4, start) == b'fLaC':
+            offset = start + 4
+
+            while True:
+                header = os.pread(fd, 4, offset)
+
+                if len(header) < 4:
+                    break
+
+                offset += 4 + int.from_bytes(header[1:4], 'big')
+
+                if header[0] & 0x80:
+                    start = offset
+                    break
+
+        if end - start >= 128 and os.pread(fd, 3, end - 128) == b'TAG':
+            end -= 128
+
+        if end - start >= 32:
+            footer = os.pread(fd, 32, end - 32)
+
+            if footer[:8] == b'APETAGEX':
+                # tag size includes the footer but not the header
+                end -= int.from_bytes(footer[12:16], 'little')
+
+                if int.from_bytes(footer[20:24], 'little') & 0x80000000:
+                    end -= 32
+
+        if end <= start:
+            return 0, size
+
+        return start, end
+
+
+class LibraryUpdate(LibraryProcess):
+    """
+    Updates existing tracks with update() without processing a queue, e.g.
+    after their tags has been edited.
+    """
+
+    def __init__(self, use_opmuse_txt, database=None):
+        self._init(use_opmuse_txt, database)
+
+
+class FileCache:
+    """
+    Persistent cache of values computed from files, stored in files.db in
+    cache.path and keyed by device, inode, size and mtime. Makes rescans,
+    moves and duplicate checks skip reading files that haven't changed.
+    """
+
+    def __init__(self, table):
+        """
+        table
+            name of table in files.db to keep the values in
+        """
+
+        self.table = table
+        self._path = None
+        self._local = threading.local()
+
+    @property
+    def path(self):
+        if self._path is None:
+            config = cherrypy.config.get('opmuse')
+
+            if config is not None and config.get('cache.path') is not None:
+                self._path = os.path.join(config.get('cache.path'), 'files.db')
+
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        if path != self._path:
+            self._path = path
+            self._local = threading.local()
+
+    def get(self, stat):
+        connection = self._get_connection()
+
+        if connection is None:
+            return None
+
+        try:
+            row = connection.execute(('SELECT value FROM %s WHERE device = ? AND inode = ? AND size = ? AND mtime = ?' %
+                                      self.table),
+                                     (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)).fetchone()
+        except sqlite3.Error:
+            log('Failed reading %s cache.' % self.table, traceback=True)
+            return None
+
+        return row[0] if row is not None else None
+
+    def set(self, stat, value):
+        connection = self._get_connection()
+
+        if connection is None:
+            return
+
+        try:
+            # only the latest value of an inode is kept
+            connection.execute(('INSERT OR REPLACE INTO %s (device, inode, size, mtime, value) VALUES (?, ?, ?, ?, ?)' %
+                                self.table),
+                               (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, value))
+        except sqlite3.Error:
+            log('Failed writing %s cache.' % self.table, traceback=True)
+
+    def copy(self, stat, new_stat):
+        """
+        Copies the value of a file to a copy of it, e.g. when it has been moved
+        to another filesystem.
+        """
+
+        value = self.get(stat)
+
+        if value is not None:
+            self.set(new_stat, value)
+
+    def _get_connection(self):
+        if self.path is None:
+            return None
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            try:
+                connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+                # it's just a cache, durability isn't important
+                connection.execute('PRAGMA journal_mode = WAL')
+                connection.execute('PRAGMA synchronous = OFF')
+                connection.execute(('CREATE TABLE IF NOT EXISTS %s (device INTEGER, inode INTEGER, size INTEGER, ' +
+                                    'mtime INTEGER, value BLOB, PRIMARY KEY (device, inode))') % self.table)
+            except sqlite3.Error:
+                log('Failed opening %s cache %s.' % (self.table, self.path), traceback=True)
+                return None
+
+            self._local.connection = connection
+
+        return connection
+
+
+hash_cache = FileCache('hashes')
+
+audio_hash_cache = FileCache('audio_hashes')
+
+metadata_cache = FileCache('metadata')
+
+
+def parse_file(filename, cache_path=None, hash_mode=None):
+    """
+    Reads everything LibraryProcess needs from a file. Used by the scanner's
+    process pool so it must not touch the database.
+
+    cache_path
+        path of the hash and metadata caches' database, the pool's processes
+        don't have opmuse's config so it's passed along.
+
+    hash_mode
+        library.hash_mode, passed along for the same reason.
+    """
+
+    if cache_path is not None:
+        hash_cache.path = cache_path
+        audio_hash_cache.path = cache_path
+        metadata_cache.path = cache_path
+
+    stat, hash = LibraryProcess.hash_file(filename, hash_mode)
+
+    return filename, stat, hash, reader.parse(filename, stat=stat)
+
+
+class LibraryDao:
+    AGGREGATE_CHUNK_SIZE = 500
+
+    # number of files to write tags to in parallel when editing
+    TAG_WORKERS = 4
+
+    @read_only
+    def get_listened_tracks_by_timestmap(self, timestamp):
+        return (get_database().query(ListenedTrack).order_by(ListenedTrack.timestamp.desc())
+                .filter(ListenedTrack.timestamp > timestamp).all())
+
+    def get_listened_tracks(self, limit):
+        return get_database().query(ListenedTrack).order_by(ListenedTrack.timestamp.desc()).limit(limit).all()
+
+    def get_listened_track_by_artist_name(self, user_id, artist_name):
+        try:
+            return (get_database().query(ListenedTrack)
+                    .filter(ListenedTrack.user_id == user_id, ListenedTrack.artist_name == artist_name)
+                    .order_by(ListenedTrack.timestamp.desc()).limit(1).one())
+        except NoResultFound:
+            return None
+
+    def get_listened_tuples_by_artist_name_for_users(self, artist_name):
+        try:
+            return (get_database().query(ListenedTrack.user_id, func.max(ListenedTrack.timestamp))
+                    .filter(ListenedTrack.artist_name == artist_name)
+                    .group_by(ListenedTrack.user_id)
+                    .order_by(ListenedTrack.timestamp.desc()).all())
+        except NoResultFound:
+            return None
+
+    @read_only
+    def get_listened_artist_name_count(self, user_id, start_date=None, end_date=None, limit=None):
+        try:
+            query = (get_database().query(ListenedTrack.artist_name, func.count(ListenedTrack.id).label('count'))
+                     .filter(ListenedTrack.user_id == user_id)
+                     .group_by(ListenedTrack.artist_name)
+                     .order_by(text('count DESC')))
+
+            if start_date is not None:
+                query = query.filter(ListenedTrack.timestamp > int(start_date.timestamp()))
+
+            if end_date is not None:
+                query = query.filter(ListenedTrack.timestamp < int(end_date.timestamp()))
+
+            if limit is not None:
+                query = query.limit(limit)
+
+            return query.all()
+        except NoResultFound:
+            return None
+
+    def get_listened_tuples_by_artist_name_and_album_name_for_users(self, artist_name, album_name):
+        try:
+            return (get_database().query(ListenedTrack.user_id, func.max(ListenedTrack.timestamp))
+                    .filter(ListenedTrack.artist_name == artist_name, ListenedTrack.album_name == album_name)
+                    .group_by(ListenedTrack.user_id)
+                    .order_by(ListenedTrack.timestamp.desc()).all())
+        except NoResultFound:
+            return None
+
+    def get_listened_track_by_artist_name_and_album_name(self, user_id, artist_name, album_name):
+        try:
+            return (get_database().query(ListenedTrack)
+                    .filter(ListenedTrack.user_id == user_id, ListenedTrack.artist_name == artist_name,
+                            ListenedTrack.album_name == album_name)
+                    .order_by(ListenedTrack.timestamp.desc()).limit(1).one())
+        except NoResultFound:
+            return None
+
+    def get_listened_tracks_count(self, user_id):
+        return (get_database().query(func.count(ListenedTrack.id))
+                .filter(ListenedTrack.user_id == user_id).scalar())
+
+    def get_listened_track_max_timestamp(self, user_id):
+        return (get_database().query(func.max(ListenedTrack.timestamp))
+                .filter(ListenedTrack.user_id == user_id).scalar())
+
+    def add_listened_track(self, user_id, name, artist_name, album_name, timestamp):
+        listened_track = ListenedTrack(user_id, name, artist_name, album_name, timestamp)
+
+        get_database().add(listened_track)
+        get_database().commit()
+
+    def delete_listened_tracks(self, user_id):
+        return (get_database().query(ListenedTrack)
+                .filter(ListenedTrack.user_id == user_id).delete())
+
+    def delete_track(self, track, database=None):
+        if database is None:
+            database = get_database()
+
+        album = track.album
+        artist = track.artist
+
+        database.delete(track)
+        database.commit()
 
         search.delete_track(track)
 
@@ -1829,6 +3219,9 @@ class LibraryDao:
 
             if len(album.tracks) == 0:
                 self.delete_album(album, database)
+            else:
+                self.update_aggregates([], [album.id], database)
+                database.expire(album)
 
         if artist is not None and len(artist.albums) > 0:
             database.expire(artist, ['albums'])
@@ -1836,6 +3229,132 @@ class LibraryDao:
             if len(artist.albums) == 0:
                 self.delete_artist(artist, database)
 
+    def update_aggregates(self, artist_ids, album_ids, database=None):
+        """
+        Updates aggregated values of artists and albums from their tracks.
+
+        Each entity type is updated with one statement per chunk of ids, in id
+        order so parallel writers lock rows in the same order.
+        """
+
+        if database is None:
+            database = get_database()
+
+        for Entity, ids, column in ((Artist, artist_ids, Track.artist_id),
+                                    (Album, album_ids, Track.album_id)):
+            table = Entity.__table__
+
+            def aggregate(value):
+                return select([value]).where(column == table.c.id).as_scalar()
+
+            values = {
+                'updated': aggregate(func.max(Track.updated)),
+                'created': aggregate(func.max(Track.created)),
+            }
+
+            if Entity is Album:
+                values.update({
+                    'track_count': aggregate(func.count(Track.id)),
+                    'duration': aggregate(func.sum(Track.duration)),
+                    'disc_count': aggregate(func.count(distinct(Track.disc))),
+                    'artist_count': aggregate(func.count(distinct(Track.artist_id))),
+                    'format': aggregate(func.max(Track.format)),
+                    'low_quality': exists().where(and_(column == table.c.id, Track.low_quality)),
+                    'invalid': aggregate(func.group_concat(distinct(Track.invalid))),
+                })
+
+            for chunk in chunks(sorted(ids), LibraryDao.AGGREGATE_CHUNK_SIZE):
+                statement = table.update().where(table.c.id.in_(chunk)).values(values)
+
+                # try 10 times when we get a deadlock and then give up
+                for i in range(0, 10):
+                    try:
+                        database.execute(statement)
+                        library_changes.record(database, Entity, chunk, 'update')
+                        database.commit()
+                        break
+                    except ProgrammingError:
+                        database.rollback()
+
+                        if i == 9:
+                            log("Failed updating aggregated values.", traceback=True)
+                            break
+
+                        time.sleep(.1)
+
+    def delete_tracks_by_ids(self, ids, database=None):
+        """
+        Bulk version of delete_track(), also removes albums and artists that
+        are left without tracks.
+        """
+
+        from opmuse.queues import Queue
+
+        if database is None:
+            database = get_database()
+
+        album_ids = set()
+        artist_ids = set()
+
+        for chunk in chunks(ids, Library.DELETE_CHUNK_SIZE):
+            for album_id, artist_id in (database.query(Track.album_id, Track.artist_id)
+                                        .filter(Track.id.in_(chunk))):
+                if album_id is not None:
+                    album_ids.add(album_id)
+
+                if artist_id is not None:
+                    artist_ids.add(artist_id)
+
+            database.query(Queue).filter(Queue.track_id.in_(chunk)).delete(synchronize_session=False)
+            database.query(TrackPath).filter(TrackPath.track_id.in_(chunk)).delete(synchronize_session=False)
+            database.query(Track).filter(Track.id.in_(chunk)).delete(synchronize_session=False)
+
+            library_changes.record(database, Track, chunk, 'delete')
+
+        database.commit()
+
+        for id in ids:
+            search.delete_track_id(id)
+
+        old_album_ids = []
+
+        for chunk in chunks(list(album_ids), Library.DELETE_CHUNK_SIZE):
+            chunk = [id for id, in database.query(Album.id).filter(Album.id.in_(chunk), ~Album.tracks.any())]
+
+            if len(chunk) == 0:
+                continue
+
+            database.query(UserAndAlbum).filter(UserAndAlbum.album_id.in_(chunk)).delete(synchronize_session=False)
+            database.query(Album).filter(Album.id.in_(chunk)).delete(synchronize_session=False)
+
+            library_changes.record(database, Album, chunk, 'delete')
+
+            old_album_ids.extend(chunk)
+
+        old_artist_ids = []
+
+        for chunk in chunks(list(artist_ids), Library.DELETE_CHUNK_SIZE):
+            chunk = [id for id, in database.query(Artist.id).filter(Artist.id.in_(chunk), ~Artist.tracks.any())]
+
+            if len(chunk) == 0:
+                continue
+
+            database.query(Artist).filter(Artist.id.in_(chunk)).delete(synchronize_session=False)
+
+            library_changes.record(database, Artist, chunk, 'delete')
+
+            old_artist_ids.extend(chunk)
+
+        database.commit()
+
+        self.update_aggregates(artist_ids - set(old_artist_ids), album_ids - set(old_album_ids), database)
+
+        for id in old_album_ids:
+            search.delete_album_id(id)
+
+        for id in old_artist_ids:
+            search.delete_artist_id(id)
+
     def delete_album(self, album, database=None):
         if database is None:
             database = get_database()
@@ -1856,10 +3375,7 @@ class LibraryDao:
 
     @memoize
     def get_track(self, id):
-        try:
-            return get_database().query(Track).filter_by(id=id).one()
-        except NoResultFound:
-            pass
+        return entity_cache.get(Track, id)
 
     def get_track_ids_by_album_id(self, album_id):
         results = get_database().execute(select([Track.id]).where(Track.album_id == album_id))
@@ -1896,6 +3412,7 @@ class LibraryDao:
         except NoResultFound:
             return
 
+    @read_only
     def get_albums_by_created_user(self, user_id, limit=10):
         return (get_database().query(Album)
                 .join(Track, Album.id == Track.album_id)
@@ -1915,76 +3432,156 @@ class LibraryDao:
             return
 
     def update_tracks_tags(self, tracks, move=False):
-        filenames = []
+        """
+        Writes tags to the tracks' files in parallel and updates the tracks,
+        their artists and albums in place instead of removing and adding them
+        again, so they keep their ids and e.g. queues are left alone.
+
+        tracks
+            list of dicts with id, artist, album, track, date, number and disc
+
+        move
+            will move files into their place according to fs.structure
+        """
+
         messages = []
 
-        for _track in tracks:
-            id = _track['id']
-            artist_name = _track['artist']
-            album_name = _track['album']
-            track_name = _track['track']
-            date = _track['date']
-            number = _track['number']
-            disc = _track['disc']
+        values = dict((int(_track['id']), _track) for _track in tracks)
 
-            try:
-                track = get_database().query(Track).filter_by(id=id).one()
-            except NoResultFound:
-                continue
+        tracks = (get_database().query(Track)
+                  .filter(Track.id.in_(list(values.keys())))
+                  .order_by(Track.id).all())
 
-            for path in track.paths:
-                try:
-                    tag = reader.get_mutagen_tag(path.path)
-                except Exception as error:
-                    messages.append(('danger', "Failed to get tag for <strong>%s</strong> (%s)." %
-                                    (path.path.decode('utf8', 'replace'), error)))
-                    break
+        jobs = []
 
+        for track in tracks:
+            for path in track.paths:
                 cherrypy.engine.library_watchdog.add_ignores(path.path)
 
-                filenames.append(path.path)
+                jobs.append((track.id, path.path, values[track.id]))
 
-                tag['artist'] = artist_name
-                tag['album'] = album_name
-                tag['title'] = track_name
+        failed = set()
 
-                if number is not None and number != '':
-                    tag['tracknumber'] = number
+        with ThreadPoolExecutor(max_workers=LibraryDao.TAG_WORKERS) as executor:
+            for (id, filename, _track), error in zip(jobs, executor.map(LibraryDao._save_tag, jobs)):
+                if error is not None:
+                    messages.append(('danger', "Failed to save tag for <strong>%s</strong> (%s)." %
+                                    (filename.decode('utf8', 'replace'), error)))
+                    failed.add(id)
 
-                if date is not None and date != '':
-                    tag['date'] = date
+        tracks = [track for track in tracks if track.id not in failed]
 
-                if disc is not None and disc != '':
-                    tag['discnumber'] = disc
+        if len(tracks) == 0:
+            return [], messages
 
-                tag.save()
-            else:
-                self.delete_track(track)
+        LibraryUpdate(self.get_library_opmuse_txt(), get_database()).update(tracks)
 
-        tracks, add_files_messages = self.add_files(filenames, move)
+        if move:
+            old_dirs = set()
+            moved_dirs = set()
 
-        return tracks, messages + add_files_messages
+            for track in tracks:
+                for track_path in track.paths:
+                    moved = self._move_file(track_path.path, messages)
 
-    def get_invalid_track_count(self):
-        return (get_database().query(func.count(Track.id))
-                .filter(text("invalid is not null"), Track.scanned).scalar())
+                    if moved is None:
+                        continue
 
-    def get_album_count(self):
-        return get_database().query(func.count(Album.id)).scalar()
+                    path, old_dirname, dirname = moved
 
-    def get_artist_count(self):
-        return get_database().query(func.count(Artist.id)).scalar()
+                    if old_dirname is None:
+                        continue
 
-    def get_track_duration(self):
-        duration = (get_database().query(func.sum(Track.duration))
-                    .filter(Track.scanned).scalar())
+                    track_path.path = path
+                    track_path.set_fingerprint(os.stat(path))
 
-        if duration is None:
-            return 0
-        else:
-            return duration
+                    old_dirs.add(old_dirname)
+                    moved_dirs.add((old_dirname, dirname))
 
-    def get_track_size(self):
+            get_database().commit()
+
+            moves = self._move_other_files(moved_dirs, messages)
+
+            # covers of the albums and artists might have been moved along
+            for from_path, to_path in moves:
+                for Entity in (Album, Artist):
+                    ids = [id for id, in get_database().query(Entity.id).filter(Entity.cover_path == from_path)]
+
+                    if len(ids) == 0:
+                        continue
+
+                    (get_database().query(Entity)
+                     .filter(Entity.id.in_(ids))
+                     .update({'cover_path': to_path}, synchronize_session=False))
+
+                    library_changes.record(get_database(), Entity, ids, 'update')
+
+            self.remove_empty_dirs(old_dirs)
+
+            get_database().commit()
+
+            # look for covers for ones still without, e.g. ones that were added
+            if len(moves) > 0:
+                self.update_covers(set(os.path.dirname(to_path) for from_path, to_path in moves))
+
+                get_database().commit()
+
+        return tracks, messages
+
+    @staticmethod
+    def _save_tag(job):
+        """
+        Writes tag values to a file. Returns the error if it failed, run in
+        parallel by update_tracks_tags().
+        """
+
+        id, filename, _track = job
+
+        try:
+            tag = reader.get_mutagen_tag(filename)
+
+            tag['artist'] = _track['artist']
+            tag['album'] = _track['album']
+            tag['title'] = _track['track']
+
+            if _track['number'] is not None and _track['number'] != '':
+                tag['tracknumber'] = _track['number']
+
+            if _track['date'] is not None and _track['date'] != '':
+                tag['date'] = _track['date']
+
+            if _track['disc'] is not None and _track['disc'] != '':
+                tag['discnumber'] = _track['disc']
+
+            tag.save()
+        except Exception as error:
+            return error
+
+    @read_only
+    def get_invalid_track_count(self):
+        return (get_database().query(func.count(Track.id))
+                .filter(text("invalid is not null"), Track.scanned).scalar())
+
+    @read_only
+    def get_album_count(self):
+        return get_database().query(func.count(Album.id)).scalar()
+
+    @read_only
+    def get_artist_count(self):
+        return get_database().query(func.count(Artist.id)).scalar()
+
+    @read_only
+    def get_track_duration(self):
+        duration = (get_database().query(func.sum(Track.duration))
+                    .filter(Track.scanned).scalar())
+
+        if duration is None:
+            return 0
+        else:
+            return duration
+
+    @read_only
+    def get_track_size(self):
         size = (get_database().query(func.sum(Track.size))
                 .filter(Track.scanned).scalar())
 
@@ -1993,10 +3590,12 @@ class LibraryDao:
         else:
             return size
 
+    @read_only
     def get_track_count(self):
         return (get_database().query(func.count(Track.id))
                 .filter(Track.scanned).scalar())
 
+    @read_only
     def get_track_path_count(self):
         return (get_database().query(func.count(TrackPath.id))
                 .join(Track, Track.id == TrackPath.track_id)
@@ -2013,358 +3612,1097 @@ class LibraryDao:
                 .order_by(Track.number)
                 .order_by(Track.name).all())
 
-    def get_albums(self):
-        return get_database().query(Album).all()
+    def get_albums(self):
+        return get_database().query(Album).all()
+
+    def get_artists(self):
+        return get_database().query(Artist).all()
+
+    def get_tracks(self):
+        return get_database().query(Track).all()
+
+    def add_files(self, filenames, move=False, remove_dirs=True,
+                  artist_name_override=None, artist_name_fallback=None, user=None, parsed=None):
+        """
+        Processes files and adds them as tracks with artists albums etc.
+
+        move
+            will move a file into its place according to fs.structure
+
+        remove_dirs
+            when files has moved this will remove empty dirs that are left behind
+
+        artist_name_override
+            This override's the artist name for the fs structure (e.g. what
+            path/dir it will reside in)
+
+        artist_name_fallback
+            This provides a fallback for the artist name for both the fs
+            structure and the track's entity.
+
+        user
+            The user that added these tracks, will be used for created_user.
+
+        parsed
+            dict of filenames and their stat, hash and metadata as returned by
+            parse_file(), these files aren't read again. the metadata of moved
+            files is read again as covers are looked for in their new dir.
+        """
+
+        if parsed is None:
+            parsed = {}
+
+        paths = []
+        messages = []
+        old_dirs = set()
+        moved_dirs = set()
+
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower()[1:] not in Library.SUPPORTED:
+                continue
+
+            if move:
+                moved = self._move_file(filename, messages, artist_name_override, artist_name_fallback)
+
+                if moved is None:
+                    continue
+
+                path, old_dirname, dirname = moved
+
+                if old_dirname is not None:
+                    old_dirs.add(old_dirname)
+                    moved_dirs.add((old_dirname, dirname))
+            else:
+                path = filename
+
+            if filename not in parsed:
+                paths.append(path)
+            elif path == filename:
+                paths.append((path, ) + parsed[filename])
+            else:
+                stat, hash, metadata = parsed[filename]
+                paths.append((path, os.stat(path), hash, None))
+
+        if len(paths) == 0:
+            return [], messages
+
+        tracks = []
+
+        LibraryProcess(self.get_library_opmuse_txt(), paths, get_database(), 0, tracks,
+                       user=user, artist_name_fallback=artist_name_fallback)
+
+        moves = self._move_other_files(moved_dirs, messages)
+
+        # dirs that got files moved into them after their tracks were processed
+        cover_dirs = set(os.path.dirname(to_path) for from_path, to_path in moves)
+
+        if remove_dirs:
+            self.remove_empty_dirs(old_dirs)
+
+        # update covers again after "other files" have been moved
+        if len(cover_dirs) > 0:
+            self.update_covers(cover_dirs)
+
+        get_database().commit()
+
+        return tracks, messages
+
+    def _move_file(self, filename, messages, artist_name_override=None, artist_name_fallback=None):
+        """
+        Moves a file into its place according to fs.structure. Returns a tuple
+        of its new path and the dirs it was moved from and to, dirs are None if
+        it already was in place, or None if it couldn't be moved.
+        """
+
+        library_path = self.get_library_path()
+
+        metadata = reader.parse_mutagen(filename)
+
+        structure_parser = MetadataStructureParser(metadata, filename,
+                                                   {'artist': artist_name_override},
+                                                   {'artist': artist_name_fallback})
+
+        dirname = structure_parser.get_path(absolute=True)
+        old_dirname = os.path.dirname(filename)
+
+        filename_basename = os.path.basename(filename)
+        path = os.path.join(dirname, filename_basename)
+        filename_basename = filename_basename.decode('utf8', 'replace')
+
+        if dirname is None:
+            messages.append(('danger', '<strong>%s</strong>: Couldn\'t find appropriate path.' %
+                            filename_basename))
+            return None
+
+        if os.path.exists(dirname):
+            if not os.path.isdir(dirname):
+                dirname = dirname[len(library_path) - 1:]
+                messages.append(('danger',
+                                ('<strong>%s</strong>: File\'s directory <strong>%s</strong> exists ' +
+                                 'and is not a directory.') %
+                                 (filename_basename, dirname.decode('utf8', 'replace'))))
+                return None
+        else:
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno == 17:  # "File exists"
+                    # if another thread (like in a parallel upload type scenario)
+                    # already created it, we just ignore this error
+                    pass
+                else:
+                    raise e
+
+        if path == filename:
+            return filename, None, None
+
+        if os.path.exists(path):
+            path_hash = LibraryProcess.get_hash(path)
+            filename_hash = LibraryProcess.get_hash(filename)
+
+            path = path[len(library_path) - 1:].decode('utf8', 'replace')
+
+            if path_hash != filename_hash:
+                messages.append(('danger', ('<strong>%s</strong>: A file already exists at ' +
+                                            '<strong>%s</strong> and it\'s not the same file, ' +
+                                            'you might want to investigate.') % (filename_basename, path)))
+            else:
+                messages.append(('warning', ('<strong>%s</strong>: A file already exists at ' +
+                                             '<strong>%s</strong> but it\'s the exact same file, ' +
+                                             'so don\'t worry.') % (filename_basename, path)))
+
+            return None
+
+        cherrypy.engine.library_watchdog.add_ignores([filename, path])
+
+        opmuse_txt = os.path.join(dirname, b'opmuse.txt')
+        old_opmuse_txt = os.path.join(old_dirname, b'opmuse.txt')
+
+        if os.path.exists(old_opmuse_txt) and not os.path.exists(opmuse_txt):
+            shutil.copy(old_opmuse_txt, opmuse_txt)
+
+        stat = os.stat(filename)
+
+        shutil.move(filename, path)
+
+        new_stat = os.stat(path)
+
+        # moved to another filesystem, keep what we know about the file
+        if (new_stat.st_dev, new_stat.st_ino) != (stat.st_dev, stat.st_ino):
+            for file_cache in (hash_cache, audio_hash_cache, metadata_cache):
+                file_cache.copy(stat, new_stat)
+
+        return path, old_dirname, dirname
+
+    def _move_other_files(self, moved_dirs, messages):
+        """
+        Moves non-track files along with tracks that has been moved if there's
+        no tracks left in the dir they were moved from, i.e. album covers and
+        such. Returns a list of (from, to) tuples of moved files.
+        """
+
+        moves = []
+
+        for from_dir, to_dir in moved_dirs:
+            tracks_left = get_database().query(TrackPath).filter(TrackPath.dir == from_dir).count()
+
+            if tracks_left == 0:
+                for from_file in os.listdir(from_dir):
+                    from_path = os.path.join(from_dir, from_file)
+                    to_path = os.path.join(to_dir, from_file)
+
+                    # if the "file" to be moved is a dir check if it contains
+                    # any tracks and if it does, dont move it.
+                    #
+                    # this might happen when tracks from one dir moves into two
+                    # subdirs of that dir.
+                    if os.path.isdir(from_path):
+                        tracks_left = get_database().query(TrackPath).filter(TrackPath.dir == from_path).count()
+
+                        if tracks_left > 0:
+                            continue
+
+                    if os.path.exists(to_path):
+                        messages.append(('info', '<strong>%s</strong>: The file <strong>%s</strong> already exists.' %
+                                        (from_file.decode('utf8', 'replace'), to_path.decode('utf8', 'replace'))))
+                    else:
+                        shutil.move(from_path, to_path)
+                        moves.append((from_path, to_path))
+
+        return moves
+
+    def update_covers(self, dirs):
+        """
+        Looks for covers for albums and artists without one that has tracks in
+        dirs. Each dir is only listed once.
+        """
+
+        for Entity, fallback_match in ((Album, FsParser.COVER_MATCH), (Artist, [])):
+            entities = (get_database().query(TrackPath.dir, Entity)
+                        .join(Track, Track.id == TrackPath.track_id)
+                        .join(Entity, Entity.id == (Track.album_id if Entity is Album else Track.artist_id))
+                        .filter(TrackPath.dir.in_(list(dirs)), Entity.cover_path.is_(None))
+                        .order_by(TrackPath.dir))
+
+            for dir, entity in entities:
+                if entity.cover_path is not None:
+                    continue
+
+                slug = None
+
+                if entity.name is not None:
+                    slug = LibraryProcess.slugify(entity.name)[1]
+
+                entity.cover_path = reader.fs_parser.match_cover(dir, slug, fallback_match)
+
+    def remove_empty_dirs(self, dirs):
+        new_dirs = set()
+
+        for dir in dirs:
+            if not os.path.exists(dir):
+                continue
+
+            files = os.listdir(dir)
+
+            opmuse_txt = os.path.join(dir, b'opmuse.txt')
+
+            # remove empty dirs or dirs only containing a opmuse.txt, as
+            # they are worthless on their own
+            if len(files) == 0 or len(files) == 1 and b'opmuse.txt' in files:
+                if os.path.exists(opmuse_txt):
+                    os.remove(opmuse_txt)
+
+                os.rmdir(dir)
+                new_dirs.add(os.path.dirname(dir))
+            elif len(files) > 1:
+                # remove "leftover" opmuse.txt file
+                only_files = []
+
+                for file in files:
+                    if not os.path.isdir(os.path.join(dir, file)):
+                        only_files.append(file)
+
+                if len(only_files) == 1 and b'opmuse.txt' in only_files:
+                    os.remove(opmuse_txt)
+
+        if len(new_dirs) > 0:
+            self.remove_empty_dirs(new_dirs)
+
+    @memoize
+    def get_album(self, id):
+        return entity_cache.get(Album, id)
+
+    def get_album_by_slug(self, slug):
+        try:
+            return get_database().query(Album).filter_by(slug=slug).one()
+        except NoResultFound:
+            pass
+
+    @memoize
+    def get_artist(self, id):
+        return entity_cache.get(Artist, id)
+
+    def get_artist_by_slug(self, slug):
+        try:
+            return get_database().query(Artist).filter_by(slug=slug).one()
+        except NoResultFound:
+            pass
+
+    def get_track_by_slug(self, slug):
+        try:
+            return get_database().query(Track).filter_by(slug=slug).one()
+        except NoResultFound:
+            pass
+
+    def remove_paths(self, paths, remove=True):
+        dirs = set()
+        tracks = set()
+
+        for path in paths:
+            try:
+                track_path = get_database().query(TrackPath).filter_by(path=path).one()
+            except NoResultFound:
+                continue
+
+            dirs.add(os.path.dirname(path))
+
+            if remove:
+                cherrypy.engine.library_watchdog.add_ignores(path)
+                os.remove(path)
+
+            tracks.add(track_path.track)
+
+            get_database().delete(track_path)
+
+        get_database().commit()
+
+        for track in tracks:
+            path_count = get_database().query(TrackPath).filter_by(track_id=track.id).count()
+
+            if path_count == 0:
+                self.delete_track(track)
+
+        get_database().commit()
+
+        self.remove_empty_dirs(dirs)
+
+    def move_paths(self, moves):
+        """
+        Updates paths of tracks that has been moved, without reprocessing
+        them. Returns new paths of files that wasn't in the library.
+
+        moves
+            list of (src, dest) tuples
+        """
+
+        unknown = []
+        tracks = set()
+        replaced = set()
+
+        for src, dest in moves:
+            track_path = get_database().query(TrackPath).filter_by(path=src).first()
+
+            if track_path is None:
+                unknown.append(dest)
+                continue
+
+            # the file was moved over another file we already know about
+            for dest_path in get_database().query(TrackPath).filter_by(path=dest):
+                replaced.add(dest_path.track)
+                get_database().delete(dest_path)
+
+            get_database().flush()
+
+            track_path.path = dest
+
+            try:
+                track_path.set_fingerprint(os.stat(dest))
+            except FileNotFoundError:
+                pass
+
+            tracks.add(track_path.track)
+
+        get_database().commit()
+
+        for track in replaced:
+            path_count = get_database().query(TrackPath).filter_by(track_id=track.id).count()
+
+            if path_count == 0:
+                self.delete_track(track)
+
+        get_database().commit()
+
+        for track in tracks:
+            search.update_track(track)
+
+        return unknown
+
+    def move_dirs(self, moves):
+        """
+        Rewrites paths of all tracks and covers in dirs that has been moved.
+
+        moves
+            list of (src, dest) tuples
+        """
+
+        for src, dest in moves:
+            src = os.path.join(src, b'')
+            dest = os.path.join(dest, b'')
+
+            for Entity, column, cached in ((TrackPath, TrackPath.path, TrackPath.track_id),
+                                           (Album, Album.cover_path, Album.id),
+                                           (Artist, Artist.cover_path, Artist.id)):
+                for id, path, cached_id in (get_database().query(Entity.id, column, cached)
+                                            .filter(func.substr(column, 1, len(src)) == src)):
+                    values = {column: dest + path[len(src):]}
+
+                    # what TrackPath's path validator would've done
+                    if Entity is TrackPath:
+                        values[TrackPath.dir] = os.path.dirname(values[column])
+                        values[TrackPath.filename] = os.path.basename(values[column])
+                        values[TrackPath.modified] = datetime.datetime.utcnow()
+
+                    (get_database().query(Entity).filter(Entity.id == id)
+                     .update(values, synchronize_session=False))
+
+                    library_changes.record(get_database(), Track if Entity is TrackPath else Entity, [cached_id],
+                                           'update')
+
+        get_database().commit()
+
+    def remove(self, id):
+        track = get_database().query(Track).filter_by(id=id).one()
+
+        dirs = set()
+
+        for path in track.paths:
+            dirs.add(os.path.dirname(path.path))
+            cherrypy.engine.library_watchdog.add_ignores(path.path)
+            os.remove(path.path)
+
+        album = track.album
+        artist = track.artist
+
+        self.delete_track(track)
+
+        self.remove_empty_dirs(dirs)
+
+        if album is not None and len(album.tracks) == 0:
+            album = None
+
+        if artist is not None and len(artist.albums) == 0:
+            artist = None
+
+        return artist, album
+
+    def get_random_tracks(self, limit):
+        return self._get_random_entity(Track, limit)
+
+    def get_random_artists(self, limit):
+        return self._get_random_entity(Artist, limit)
+
+    def get_random_albums(self, limit):
+        return self._get_random_entity(Album, limit)
+
+    def _get_random_entity(self, Entity, limit):
+        max_id = get_database().query(func.max(Entity.id)).one()[0]
+
+        ids = []
+
+        for i in range(0, limit * 10):
+            ids.append(random.randrange(1, max_id))
+
+        entities = (get_database()
+                    .query(Entity)
+                    .filter(Entity.id.in_(ids))
+                    .order_by(func.rand())
+                    .limit(limit)
+                    .all())
+
+        if len(entities) < limit:
+            entities += self._get_random_entity(Entity, limit - len(entities))
+
+        return entities
+
+
+library_dao = LibraryDao()
+
+
+class TrackFutures:
+    """
+    Futures of tracks by file name that are resolved with the track's id as
+    soon as LibraryProcess has added a file with that name. Lets e.g. covers
+    uploaded along with tracks wait for them without polling.
+    """
+
+    # seconds before an unresolved future fails with a TimeoutError
+    MAX_AGE = 3600
+
+    def __init__(self):
+        # file name => list of (time added, future)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """
+        Returns a future that's resolved when a track with a file named
+        filename, a basename, exists.
+        """
+
+        future = Future()
+
+        self.expire()
+
+        with self._lock:
+            self._futures.setdefault(filename, []).append((time.time(), future))
+
+        # it might have been added before we started waiting
+        track = library_dao.get_track_by_filename(filename)
+
+        if track is not None:
+            self.resolve(filename, track.id)
+
+        return future
+
+    def resolve(self, filename, track_id):
+        with self._lock:
+            futures = self._futures.pop(filename, [])
+
+        for added, future in futures:
+            future.set_result(track_id)
+
+    def resolve_tracks(self, tracks):
+        """
+        Resolves futures of the files of tracks, call after they're committed.
+        """
+
+        if not self.waiting():
+            return
+
+        for track in tracks:
+            for track_path in track.paths:
+                self.resolve(track_path.filename, track.id)
+
+    def waiting(self):
+        return len(self._futures) > 0
+
+    def expire(self):
+        now = time.time()
+
+        expired = []
+
+        with self._lock:
+            for filename, futures in list(self._futures.items()):
+                for item in list(futures):
+                    if now - item[0] > TrackFutures.MAX_AGE:
+                        futures.remove(item)
+                        expired.append(item[1])
+
+                if len(futures) == 0:
+                    del self._futures[filename]
+
+        for future in expired:
+            future.set_exception(TimeoutError())
+
+
+track_futures = TrackFutures()
+
+
+class TrackFuturesCron(BackgroundTaskCron):
+    """
+    Fails futures that are past TrackFutures.MAX_AGE even when there are no
+    new uploads, so their callbacks clean up after them.
+    """
+
+    def priority(self):
+        return -10
+
+    def expression(self):
+        return '*/5 * * * *'
+
+    def run(self):
+        track_futures.expire()
+
+
+class EntityCache:
+    """
+    Process wide cache of tracks, with their paths, albums and artists by id.
+    Entities are kept as detached copies of their loaded columns and merged
+    into the current session when asked for, which doesn't query the database.
+    Albums and artists of cached tracks are merged too so the track's artist and
+    album relationships are loaded from the session instead of the database.
+
+    Entries are invalidated when an entity is flushed, again when that
+    session commits or rolls back, and by invalidate() for bulk updates and
+    deletes, which sqlalchemy doesn't know what rows they touch.
+    """
+
+    # how many entities to keep, least recently used are dropped first
+    MAX_SIZE = 50000
+
+    ENTITIES = (Track, Album, Artist)
+
+    def __init__(self):
+        self._entities = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by invalidations, an entity loaded while it changed isn't kept
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, Entity, id):
+        """
+        Returns entity with id, or None if there is none.
+        """
+
+        entities = self.get_many(Entity, [id])
+
+        return entities[0] if len(entities) > 0 else None
+
+    def get_many(self, Entity, ids):
+        """
+        Returns entities of ids that exist, in the same order.
+        """
+
+        database = get_database()
+
+        # what's been read from the replica might be behind, don't keep it
+        replica = get_replica(database) is not None
+
+        with self._lock:
+            generation = self._generation
+
+        entities = {}
+        missing = []
+
+        for id in ids:
+            if id in entities:
+                continue
+
+            with self._lock:
+                snapshot = self._entities.get((Entity, id))
+
+                if snapshot is not None:
+                    self._entities.move_to_end((Entity, id))
+
+            key = database.identity_key(Entity, id)
+
+            # don't overwrite something the session might've changed
+            if key in database.identity_map:
+                entity = entities[id] = database.identity_map[key]
+
+                if snapshot is None and not replica and not inspect(entity).modified:
+                    self._set(entity, generation)
+
+                continue
+
+            if snapshot is None:
+                missing.append(id)
+                continue
+
+            entity = entities[id] = database.merge(snapshot, load=False)
+
+            # paths aren't cascaded by merge
+            if Entity is Track:
+                set_committed_value(entity, 'paths', [database.merge(path, load=False) for path in snapshot.paths])
+
+        with self._lock:
+            self.hits += len(ids) - len(missing)
+            self.misses += len(missing)
+
+        if len(missing) > 0:
+            query = database.query(Entity)
+
+            if Entity is Track:
+                query = query.options(joinedload(Track.paths))
+
+            # albums and artists joined in are from the primary too, unless
+            # they were already in the session
+            if Entity is Track and replica:
+                known = set(database.identity_map.keys())
+
+            # misses are read from the primary so they're safe to keep
+            with on_primary():
+                for chunk in chunks(missing, Library.DELETE_CHUNK_SIZE):
+                    for entity in query.filter(Entity.id.in_(chunk)):
+                        entities[entity.id] = entity
+                        self._set(entity, generation)
+
+                        if Entity is Track and replica:
+                            for related in (entity.album, entity.artist):
+                                if related is not None and inspect(related).key not in known:
+                                    self._set(related, generation)
+
+        if Entity is Track:
+            tracks = entities.values()
+
+            albums = self.get_many(Album, [track.album_id for track in tracks if track.album_id is not None])
+            artists = self.get_many(Artist, [track.artist_id for track in tracks if track.artist_id is not None])
+
+            albums = {album.id: album for album in albums}
+            artists = {artist.id: artist for artist in artists}
+
+            # set them on the tracks, the session only keeps weak references
+            for track in tracks:
+                state = inspect(track)
+
+                if 'album' not in state.dict:
+                    set_committed_value(track, 'album', albums.get(track.album_id))
+
+                if 'artist' not in state.dict:
+                    set_committed_value(track, 'artist', artists.get(track.artist_id))
+
+        return [entities[id] for id in ids if id in entities]
+
+    def invalidate(self, Entity, ids=None, database=None):
+        """
+        Drops entities of ids from the cache, all of Entity's if ids is None.
+        If database is given they're dropped again when it commits or rolls
+        back, in case someone cached them while it was changing them.
+        """
+
+        if database is not None:
+            database.info.setdefault('entity_cache', set()).add((Entity, None if ids is None else tuple(ids)))
+
+        with self._lock:
+            self._generation += 1
+
+            if ids is None:
+                for key in [key for key in self._entities.keys() if key[0] is Entity]:
+                    del self._entities[key]
+            else:
+                for id in ids:
+                    self._entities.pop((Entity, id), None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entities.clear()
+
+    def size(self):
+        return len(self._entities)
+
+    def _set(self, entity, generation):
+        snapshot = EntityCache._snapshot(entity)
 
-    def get_artists(self):
-        return get_database().query(Artist).all()
+        if isinstance(entity, Track):
+            set_committed_value(snapshot, 'paths', [EntityCache._snapshot(path) for path in entity.paths])
 
-    def get_tracks(self):
-        return get_database().query(Track).all()
+        with self._lock:
+            if generation != self._generation:
+                return
 
-    def add_files(self, filenames, move=False, remove_dirs=True,
-                  artist_name_override=None, artist_name_fallback=None, user=None):
-        """
-        Processes files and adds them as tracks with artists albums etc.
+            self._entities[(entity.__class__, entity.id)] = snapshot
 
-        move
-            will move a file into its place according to fs.structure
+            while len(self._entities) > EntityCache.MAX_SIZE:
+                self._entities.popitem(last=False)
 
-        remove_dirs
-            when files has moved this will remove empty dirs that are left behind
+    @staticmethod
+    def _snapshot(entity):
+        """
+        Returns a detached copy of entity's loaded columns.
+        """
 
-        artist_name_override
-            This override's the artist name for the fs structure (e.g. what
-            path/dir it will reside in)
+        state = inspect(entity)
 
-        artist_name_fallback
-            This provides a fallback for the artist name for both the fs
-            structure and the track's entity.
+        snapshot = state.mapper.class_manager.new_instance()
 
-        user
-            The user that added these tracks, will be used for created_user.
+        for prop in state.mapper.column_attrs:
+            if prop.key in state.dict:
+                set_committed_value(snapshot, prop.key, state.dict[prop.key])
 
-        """
+        make_transient_to_detached(snapshot)
 
-        paths = []
-        messages = []
-        old_dirs = set()
-        moved_dirs = set()
+        return snapshot
 
-        for filename in filenames:
-            if os.path.splitext(filename)[1].lower()[1:] not in Library.SUPPORTED:
-                continue
+    @staticmethod
+    @event.listens_for(Session, 'after_commit')
+    @event.listens_for(Session, 'after_rollback')
+    def _after_transaction(session):
+        for Entity, ids in session.info.pop('entity_cache', ()):
+            entity_cache.invalidate(Entity, ids)
 
-            if move:
-                library_path = self.get_library_path()
 
-                metadata = reader.parse_mutagen(filename)
+entity_cache = EntityCache()
 
-                structure_parser = MetadataStructureParser(metadata, filename,
-                                                           {'artist': artist_name_override},
-                                                           {'artist': artist_name_fallback})
 
-                dirname = structure_parser.get_path(absolute=True)
-                old_dirname = os.path.dirname(filename)
+class LibraryChanges:
+    """
+    Append-only log of changes to tracks, albums and artists, written in the
+    same transaction as the change. Whatever made the change, e.g. the
+    scanner, the watchdog, uploads or edits, it's in here. Compare
+    get_generation() with what it was before to know if the library changed,
+    and get_changes() tells what changed.
+    """
 
-                filename_basename = os.path.basename(filename)
-                path = os.path.join(dirname, filename_basename)
-                filename_basename = filename_basename.decode('utf8', 'replace')
+    ENTITIES = (Track, Album, Artist)
 
-                if dirname is None:
-                    messages.append(('danger', '<strong>%s</strong>: Couldn\'t find appropriate path.' %
-                                    filename_basename))
-                    continue
+    OPERATIONS = ('add', 'update', 'delete')
 
-                if os.path.exists(dirname):
-                    if not os.path.isdir(dirname):
-                        dirname = dirname[len(library_path) - 1:]
-                        messages.append(('danger',
-                                        ('<strong>%s</strong>: File\'s directory <strong>%s</strong> exists ' +
-                                         'and is not a directory.') %
-                                         (filename_basename, dirname.decode('utf8', 'replace'))))
-                        continue
-                else:
-                    try:
-                        os.makedirs(dirname)
-                    except OSError as e:
-                        if e.errno == 17:  # "File exists"
-                            # if another thread (like in a parallel upload type scenario)
-                            # already created it, we just ignore this error
-                            pass
-                        else:
-                            raise e
+    # seconds a missing id below the latest change is waited for before it's
+    # taken for a rolled back transaction and the generation moves past it
+    GAP_TIMEOUT = 30
 
-                if path != filename:
-                    if os.path.exists(path):
-                        path_hash = LibraryProcess.get_hash(path)
-                        filename_hash = LibraryProcess.get_hash(filename)
+    # how many changes before the latest to look for gaps in on startup
+    WINDOW = 1000
 
-                        path = path[len(library_path) - 1:].decode('utf8', 'replace')
+    # days to keep changes for when library.changes.max_age isn't set
+    MAX_AGE = 30
 
-                        if path_hash != filename_hash:
-                            messages.append(('danger', ('<strong>%s</strong>: A file already exists at ' +
-                                                        '<strong>%s</strong> and it\'s not the same file, ' +
-                                                        'you might want to investigate.') % (filename_basename, path)))
-                        else:
-                            messages.append(('warning', ('<strong>%s</strong>: A file already exists at ' +
-                                                         '<strong>%s</strong> but it\'s the exact same file, ' +
-                                                         'so don\'t worry.') % (filename_basename, path)))
+    def __init__(self):
+        # every change up to this id is committed
+        self._watermark = None
+        # missing id => time first seen missing
+        self._gaps = {}
+        self._lock = threading.Lock()
 
-                        continue
+    def record(self, database, Entity, ids, operation):
+        """
+        Records that entities of ids were added, updated or deleted and drops
+        them from entity_cache. They're written when database commits, once
+        per entity and transaction. The ORM's changes are recorded on flush,
+        this is for bulk updates and deletes that bypass it.
+        """
 
-                    cherrypy.engine.library_watchdog.add_ignores([filename, path])
+        ids = [id for id in ids if id is not None]
 
-                    opmuse_txt = os.path.join(dirname, b'opmuse.txt')
-                    old_opmuse_txt = os.path.join(old_dirname, b'opmuse.txt')
+        entity_cache.invalidate(Entity, ids, database)
 
-                    if os.path.exists(old_opmuse_txt) and not os.path.exists(opmuse_txt):
-                        shutil.copy(old_opmuse_txt, opmuse_txt)
+        if len(ids) == 0:
+            return
 
-                    shutil.move(filename, path)
+        changes = database.info.setdefault('library_changes', {})
+        changes.setdefault((Entity, operation), set()).update(ids)
 
-                    old_dirs.add(old_dirname)
-                    moved_dirs.add((old_dirname, dirname))
+    def get_generation(self, database=None):
+        """
+        Returns the id up to which every change is committed, 0 if there's
+        none. Concurrent transactions can commit their changes out of id
+        order, a change that's missing below a committed one holds the
+        generation back until it's committed or GAP_TIMEOUT has passed.
+        """
 
-                    paths.append(path)
-                else:
-                    paths.append(filename)
-            else:
-                paths.append(filename)
+        with self._lock, self._connect(database) as connection:
+            table = LibraryChange.__table__
 
-        if len(paths) == 0:
-            return [], messages
+            if self._watermark is None:
+                latest = connection.execute(select([func.max(table.c.id)])).scalar() or 0
+                self._watermark = max(latest - LibraryChanges.WINDOW, 0)
 
-        tracks = []
+            ids = [row[0] for row in connection.execute(select([table.c.id])
+                                                        .where(table.c.id > self._watermark)
+                                                        .order_by(table.c.id))]
 
-        LibraryProcess(self.get_library_opmuse_txt(), paths, get_database(), 0, tracks,
-                       user=user, artist_name_fallback=artist_name_fallback)
+            now = time.time()
 
-        # move non-track files with folder if there's no tracks left in folder
-        # i.e. album covers and such
-        for from_dir, to_dir in moved_dirs:
-            tracks_left = get_database().query(TrackPath).filter(TrackPath.dir == from_dir).count()
+            expected = self._watermark + 1
 
-            if tracks_left == 0:
-                for from_file in os.listdir(from_dir):
-                    from_path = os.path.join(from_dir, from_file)
-                    to_path = os.path.join(to_dir, from_file)
+            for id in ids:
+                while expected < id:
+                    if now - self._gaps.setdefault(expected, now) < LibraryChanges.GAP_TIMEOUT:
+                        break
 
-                    # if the "file" to be moved is a dir check if it contains
-                    # any tracks and if it does, dont move it.
-                    #
-                    # this might happen when tracks from one dir moves into two
-                    # subdirs of that dir.
-                    if os.path.isdir(from_path):
-                        tracks_left = get_database().query(TrackPath).filter(TrackPath.dir == from_path).count()
+                    del self._gaps[expected]
+                    expected += 1
 
-                        if tracks_left > 0:
-                            continue
+                if expected < id:
+                    break
 
-                    if os.path.exists(to_path):
-                        messages.append(('info', '<strong>%s</strong>: The file <strong>%s</strong> already exists.' %
-                                        (filename_basename, to_path.decode('utf8', 'replace'))))
-                    else:
-                        shutil.move(from_path, to_path)
+                expected = id + 1
 
-        if remove_dirs:
-            self.remove_empty_dirs(old_dirs)
+            self._watermark = expected - 1
 
-        # updated covers again after "other files" have been moved
-        for track in tracks:
-            metadata = reader.parse(track.paths[0].path)
+            for id in [id for id in self._gaps if id <= self._watermark]:
+                del self._gaps[id]
 
-            if track.album is not None and track.album.cover_path is None:
-                track.album.cover_path = metadata.cover_path
+            return self._watermark
 
-            if track.artist is not None and track.artist.cover_path is None:
-                track.artist.cover_path = metadata.artist_cover_path
+    def clear(self):
+        """
+        Forgets the generation, e.g. when the database was replaced.
+        """
 
-        get_database().commit()
+        with self._lock:
+            self._watermark = None
+            self._gaps.clear()
 
-        return tracks, messages
+    def get_oldest(self, database=None):
+        """
+        Returns the id of the oldest change that hasn't been trimmed, 0 if
+        there's none.
+        """
 
-    def remove_empty_dirs(self, dirs):
-        new_dirs = set()
+        with self._connect(database) as connection:
+            return connection.execute(select([func.min(LibraryChange.id)])).scalar() or 0
 
-        for dir in dirs:
-            if not os.path.exists(dir):
-                continue
+    def get_changes(self, since, limit=None, until=None, database=None):
+        """
+        Returns committed changes after generation since, and up to generation
+        until if given, oldest first.
+        """
 
-            files = os.listdir(dir)
+        table = LibraryChange.__table__
 
-            opmuse_txt = os.path.join(dir, b'opmuse.txt')
+        query = select([table]).where(table.c.id > since).order_by(table.c.id)
 
-            # remove empty dirs or dirs only containing a opmuse.txt, as
-            # they are worthless on their own
-            if len(files) == 0 or len(files) == 1 and b'opmuse.txt' in files:
-                if os.path.exists(opmuse_txt):
-                    os.remove(opmuse_txt)
+        if until is not None:
+            query = query.where(table.c.id <= until)
 
-                os.rmdir(dir)
-                new_dirs.add(os.path.dirname(dir))
-            elif len(files) > 1:
-                # remove "leftover" opmuse.txt file
-                only_files = []
+        if limit is not None:
+            query = query.limit(limit)
 
-                for file in files:
-                    if not os.path.isdir(os.path.join(dir, file)):
-                        only_files.append(file)
+        with self._connect(database) as connection:
+            return connection.execute(query).fetchall()
 
-                if len(only_files) == 1 and b'opmuse.txt' in only_files:
-                    os.remove(opmuse_txt)
+    def trim(self, max_age, database=None):
+        """
+        Removes changes older than max_age days. The latest change is always
+        kept so the generation never goes back, which sqlite would reuse the
+        ids of.
+        """
 
-        if len(new_dirs) > 0:
-            self.remove_empty_dirs(new_dirs)
+        if database is None:
+            database = get_database()
 
-    @memoize
-    def get_album(self, id):
-        try:
-            return get_database().query(Album).filter_by(id=id).one()
-        except NoResultFound:
-            pass
+        generation = database.query(func.max(LibraryChange.id)).scalar()
 
-    def get_album_by_slug(self, slug):
-        try:
-            return get_database().query(Album).filter_by(slug=slug).one()
-        except NoResultFound:
-            pass
+        if generation is None:
+            return 0
 
-    @memoize
-    def get_artist(self, id):
-        try:
-            return get_database().query(Artist).filter_by(id=id).one()
-        except NoResultFound:
-            pass
+        created = datetime.datetime.utcnow() - datetime.timedelta(days=max_age)
 
-    def get_artist_by_slug(self, slug):
-        try:
-            return get_database().query(Artist).filter_by(slug=slug).one()
-        except NoResultFound:
-            pass
+        count = (database.query(LibraryChange)
+                 .filter(LibraryChange.created < created, LibraryChange.id < generation)
+                 .delete(synchronize_session=False))
 
-    def get_track_by_slug(self, slug):
-        try:
-            return get_database().query(Track).filter_by(slug=slug).one()
-        except NoResultFound:
-            pass
+        database.commit()
 
-    def remove_paths(self, paths, remove=True):
-        dirs = set()
-        tracks = set()
+        return count
 
-        for path in paths:
-            try:
-                track_path = get_database().query(TrackPath).filter_by(path=path).one()
-            except NoResultFound:
-                continue
+    @contextlib.contextmanager
+    def _connect(self, database):
+        """
+        Yields a connection to the primary that doesn't see uncommitted changes,
+        which sessions do as they're READ UNCOMMITTED.
+        """
 
-            dirs.add(os.path.dirname(path))
+        if database is None:
+            database = get_database()
 
-            if remove:
-                cherrypy.engine.library_watchdog.add_ignores(path)
-                os.remove(path)
+        engine = database.get_bind()
 
-            tracks.add(track_path.track)
+        # sqlite has no READ COMMITTED but uncommitted reads only happen
+        # with a shared cache, which isn't used
+        isolation_level = 'SERIALIZABLE' if engine.dialect.name == 'sqlite' else 'READ COMMITTED'
 
-            get_database().delete(track_path)
+        with engine.connect() as connection:
+            yield connection.execution_options(isolation_level=isolation_level)
 
-        get_database().commit()
+    @staticmethod
+    @event.listens_for(Session, 'after_flush')
+    def _after_flush(session, flush_context):
+        changes = collections.defaultdict(set)
 
-        for track in tracks:
-            path_count = get_database().query(TrackPath).filter_by(track_id=track.id).count()
+        for entity in session.new:
+            if isinstance(entity, LibraryChanges.ENTITIES):
+                changes[(entity.__class__, 'add')].add(entity.id)
 
-            if path_count == 0:
-                self.delete_track(track)
+        for entity in session.deleted:
+            if isinstance(entity, LibraryChanges.ENTITIES):
+                changes[(entity.__class__, 'delete')].add(entity.id)
 
-        get_database().commit()
+        for entity in session.dirty | session.new | session.deleted:
+            if isinstance(entity, TrackPath):
+                changes[(Track, 'update')].add(entity.track_id)
+            elif isinstance(entity, LibraryChanges.ENTITIES) and session.is_modified(entity):
+                changes[(entity.__class__, 'update')].add(entity.id)
 
-        self.remove_empty_dirs(dirs)
+        for (Entity, operation), ids in changes.items():
+            library_changes.record(session, Entity, sorted(ids), operation)
 
-    def remove(self, id):
-        track = get_database().query(Track).filter_by(id=id).one()
+    @staticmethod
+    @event.listens_for(Session, 'before_commit')
+    def _before_commit(session):
+        # commit flushes after before_commit, do it first so it's recorded
+        session.flush()
 
-        dirs = set()
+        changes = session.info.pop('library_changes', None)
 
-        for path in track.paths:
-            dirs.add(os.path.dirname(path.path))
-            cherrypy.engine.library_watchdog.add_ignores(path.path)
-            os.remove(path.path)
+        if changes is None:
+            return
 
-        album = track.album
-        artist = track.artist
+        now = datetime.datetime.utcnow()
 
-        self.delete_track(track)
+        rows = []
 
-        self.remove_empty_dirs(dirs)
+        for Entity in LibraryChanges.ENTITIES:
+            added = changes.get((Entity, 'add'), set())
+            deleted = changes.get((Entity, 'delete'), set())
 
-        if album is not None and len(album.tracks) == 0:
-            album = None
+            for operation in LibraryChanges.OPERATIONS:
+                ids = changes.get((Entity, operation), set())
 
-        if artist is not None and len(artist.albums) == 0:
-            artist = None
+                # an added or deleted entity isn't also updated, and one that's
+                # both added and deleted never was
+                if operation == 'update':
+                    ids = ids - added - deleted
+                elif operation == 'add':
+                    ids = ids - deleted
+                else:
+                    ids = ids - added
 
-        return artist, album
+                rows.extend({
+                    'entity': Entity.__name__.lower(),
+                    'entity_id': id,
+                    'operation': operation,
+                    'created': now
+                } for id in sorted(ids))
 
-    def get_random_tracks(self, limit):
-        return self._get_random_entity(Track, limit)
+        if len(rows) > 0:
+            session.execute(LibraryChange.__table__.insert(), rows)
 
-    def get_random_artists(self, limit):
-        return self._get_random_entity(Artist, limit)
+    @staticmethod
+    @event.listens_for(Session, 'after_transaction_end')
+    def _after_transaction_end(session, transaction):
+        # rolled back or closed without committing
+        if transaction.parent is None:
+            session.info.pop('library_changes', None)
 
-    def get_random_albums(self, limit):
-        return self._get_random_entity(Album, limit)
 
-    def _get_random_entity(self, Entity, limit):
-        max_id = get_database().query(func.max(Entity.id)).one()[0]
+library_changes = LibraryChanges()
 
-        ids = []
 
-        for i in range(0, limit * 10):
-            ids.append(random.randrange(1, max_id))
+class LibraryChangesCron(BackgroundTaskCron):
+    """
+    Trims changes older than library.changes.max_age days.
+    """
 
-        entities = (get_database()
-                    .query(Entity)
-                    .filter(Entity.id.in_(ids))
-                    .order_by(func.rand())
-                    .limit(limit)
-                    .all())
+    def priority(self):
+        return -10
 
-        if len(entities) < limit:
-            entities += self._get_random_entity(Entity, limit - len(entities))
+    def expression(self):
+        return '30 4 * * *'
 
-        return entities
+    def run(self):
+        config = cherrypy.tree.apps[''].config['opmuse']
 
+        count = library_changes.trim(config.get('library.changes.max_age', LibraryChanges.MAX_AGE))
 
-library_dao = LibraryDao()
+        if count > 0:
+            log('Trimmed %d library changes.' % count)
 
 
 class WatchdogEventHandler(FileSystemEventHandler):
-    def __init__(self):
+    """
+    Collects file system events and hands them out once they've settled, i.e.
+    when neither the file nor its directory has had any events for
+    settle_time seconds. This way a file being written, or a directory being
+    copied, is processed once and in one go.
+    """
+
+    def __init__(self, settle_time=5):
         FileSystemEventHandler.__init__(self)
 
         log("Watchdog watching for changes.")
 
-        self.added = set()
-        self.removed = set()
+        self.settle_time = settle_time
+
+        # path => "added" or "removed"
+        self.changed = {}
+        # dest path => src path
+        self.moved = {}
+        # dest dir => src dir
+        self.moved_dirs = {}
+        # path or dir => time of last event
+        self.times = {}
 
         self.ignores = set()
 
+        self._lock = threading.Lock()
+
     def on_moved(self, event):
         FileSystemEventHandler.on_moved(self, event)
 
-        if event.is_directory:
-            return
+        with self._lock:
+            if event.is_directory:
+                self._move_dir(event.src_path, event.dest_path)
+                return
+
+            src_supported = not self.ignore(event.src_path) and Library.is_supported(event.src_path)
+            dest_supported = not self.ignore(event.dest_path) and Library.is_supported(event.dest_path)
 
-        if not self.ignore(event.src_path) and Library.is_supported(event.src_path):
-            self.removed.add(event.src_path)
+            if src_supported and dest_supported:
+                self._move(event.src_path, event.dest_path)
 
-            debug('Watchdog, removed %s' % event.src_path)
+                debug('Watchdog, moved %s to %s' % (event.src_path, event.dest_path))
+            elif src_supported:
+                self._change(event.src_path, 'removed')
 
-        if not self.ignore(event.dest_path) and Library.is_supported(event.dest_path):
-            self.added.add(event.dest_path)
+                debug('Watchdog, removed %s' % event.src_path)
+            elif dest_supported:
+                self._change(event.dest_path, 'added')
 
-            debug('Watchdog, created %s' % event.dest_path)
+                debug('Watchdog, created %s' % event.dest_path)
 
     def on_created(self, event):
         FileSystemEventHandler.on_created(self, event)
@@ -2372,7 +4710,8 @@ class WatchdogEventHandler(FileSystemEventHandler):
         if event.is_directory or self.ignore(event.src_path) or not Library.is_supported(event.src_path):
             return
 
-        self.added.add(event.src_path)
+        with self._lock:
+            self._change(event.src_path, 'added')
 
         debug('Watchdog, created %s' % event.src_path)
 
@@ -2382,7 +4721,8 @@ class WatchdogEventHandler(FileSystemEventHandler):
         if event.is_directory or self.ignore(event.src_path) or not Library.is_supported(event.src_path):
             return
 
-        self.removed.add(event.src_path)
+        with self._lock:
+            self._change(event.src_path, 'removed')
 
         debug('Watchdog, removed %s' % event.src_path)
 
@@ -2392,15 +4732,49 @@ class WatchdogEventHandler(FileSystemEventHandler):
         if event.is_directory or self.ignore(event.src_path) or not Library.is_supported(event.src_path):
             return
 
-        self.added.add(event.src_path)
+        with self._lock:
+            self._change(event.src_path, 'added')
 
         debug('Watchdog, modified %s' % event.src_path)
 
-    def pop_added(self):
-        return self._pop_set(self.added)
+    def pop_settled(self):
+        """
+        Returns settled events as moved dirs, moved files, removed files and
+        added files. Moved dirs and files are lists of (src, dest) tuples.
+        """
+
+        now = time.time()
+
+        moved_dirs = []
+        moved = []
+        removed = []
+        added = []
+
+        with self._lock:
+            for dest, src in list(self.moved_dirs.items()):
+                if self._settled(dest, now):
+                    moved_dirs.append((src, dest))
+                    del self.moved_dirs[dest]
+
+            for dest, src in list(self.moved.items()):
+                if self._settled(dest, now):
+                    moved.append((src, dest))
+                    del self.moved[dest]
+
+            for path, change in list(self.changed.items()):
+                if self._settled(path, now):
+                    if change == 'added':
+                        added.append(path)
+                    else:
+                        removed.append(path)
+
+                    del self.changed[path]
+
+            for path, event_time in list(self.times.items()):
+                if now - event_time >= self.settle_time:
+                    del self.times[path]
 
-    def pop_removed(self):
-        return self._pop_set(self.removed)
+        return moved_dirs, moved, removed, added
 
     def ignore(self, ignore):
         try:
@@ -2417,21 +4791,62 @@ class WatchdogEventHandler(FileSystemEventHandler):
         for ignore in ignores:
             self.ignores.add(ignore)
 
-    @staticmethod
-    def _pop_set(collection):
-        result = []
+    def _settled(self, path, now):
+        for key in (path, os.path.dirname(path)):
+            if key in self.times and now - self.times[key] < self.settle_time:
+                return False
 
-        if len(collection) == 0:
-            return result
+        return True
 
-        while True:
-            try:
-                file = collection.pop()
-                result.append(file)
-            except KeyError:
-                break
+    def _touch(self, path):
+        now = time.time()
+
+        self.times[path] = now
+        self.times[os.path.dirname(path)] = now
+
+    def _change(self, path, change):
+        self.changed[path] = change
+
+        self._touch(path)
+
+    def _move(self, src, dest):
+        self._touch(dest)
 
-        return result
+        # part of a dir move we already know about
+        for dest_dir, src_dir in self.moved_dirs.items():
+            if (src.startswith(os.path.join(src_dir, b'')) and
+                    dest == os.path.join(dest_dir, src[len(src_dir) + 1:])):
+                return
+
+        # never made it to the library under its old name, e.g. a file being
+        # renamed after it's been written so just add it under its new name
+        if self.changed.get(src) == 'added':
+            del self.changed[src]
+            self.changed[dest] = 'added'
+            return
+
+        self.changed.pop(dest, None)
+
+        # moved again before settling, keep the original src
+        src = self.moved.pop(src, src)
+
+        self.moved[dest] = src
+
+    def _move_dir(self, src, dest):
+        self._touch(dest)
+
+        src = self.moved_dirs.pop(src, src)
+
+        self.moved_dirs[dest] = src
+
+        src_prefix = os.path.join(src, b'')
+
+        # pending events in the old dir are moved along with it
+        for path in [path for path in self.changed if path.startswith(src_prefix)]:
+            self.changed[os.path.join(dest, path[len(src_prefix):])] = self.changed.pop(path)
+
+        for path in [path for path in self.moved if path.startswith(src_prefix)]:
+            self.moved[os.path.join(dest, path[len(src_prefix):])] = self.moved.pop(path)
 
 
 class LibraryWatchdogPlugin(SimplePlugin):
@@ -2447,8 +4862,10 @@ class LibraryWatchdogPlugin(SimplePlugin):
 
         config = cherrypy.tree.apps[''].config['opmuse']
 
-        def run(self, library_path):
-            self.event_handler = WatchdogEventHandler()
+        settle_time = config.get('library.watchdog.settle_time', 5)
+
+        def run(self, library_path, settle_time):
+            self.event_handler = WatchdogEventHandler(settle_time)
 
             observer = Observer()
             observer.schedule(self.event_handler, library_path, recursive=True)
@@ -2456,16 +4873,23 @@ class LibraryWatchdogPlugin(SimplePlugin):
 
             while self.running:
                 try:
-                    database_data.database = get_session()
+                    database_data.database = get_session('scanner')
 
-                    removed = self.event_handler.pop_removed()
+                    moved_dirs, moved, removed, added = self.event_handler.pop_settled()
+
+                    if len(moved_dirs) > 0:
+                        log("Watchdog moving %d dirs." % len(moved_dirs))
+                        library_dao.move_dirs(moved_dirs)
+
+                    if len(moved) > 0:
+                        log("Watchdog moving %d files." % len(moved))
+                        # files we didn't know about under their old name are added instead
+                        added += library_dao.move_paths(moved)
 
                     if len(removed) > 0:
                         log("Watchdog removing %d files." % len(removed))
                         library_dao.remove_paths(removed, remove=False)
 
-                    added = self.event_handler.pop_added()
-
                     if len(added) > 0:
                         log("Watchdog adding %d files." % len(added))
                         tracks, add_files_messages = library_dao.add_files(added, move=False, remove_dirs=False)
@@ -2479,7 +4903,7 @@ class LibraryWatchdogPlugin(SimplePlugin):
                         database_data.database.remove()
                         database_data.database = None
 
-                    time.sleep(5)
+                    time.sleep(1)
                 except:
                     log("Watchdog failed adding files.", traceback=True)
             else:
@@ -2490,7 +4914,7 @@ class LibraryWatchdogPlugin(SimplePlugin):
         self.thread = Thread(
             name="LibraryWatchdog",
             target=run,
-            args=(self, os.path.abspath(config['library.path']).encode('utf8'))
+            args=(self, os.path.abspath(config['library.path']).encode('utf8'), settle_time)
         )
 
         self.thread.start()
@@ -2526,14 +4950,20 @@ class LibraryPlugin(SimplePlugin):
         else:
             use_opmuse_txt = True
 
-        def run(self, library_path, use_opmuse_txt):
-            self.library = Library(library_path, use_opmuse_txt)
+        incremental = config.get('library.incremental', True)
+        prune_dirs = config.get('library.prune_dirs', False)
+        device_concurrency = config.get('library.device_concurrency')
+
+        def run(self, library_path, use_opmuse_txt, incremental, prune_dirs, device_concurrency):
+            self.library = Library(library_path, use_opmuse_txt, incremental, prune_dirs=prune_dirs,
+                                   device_concurrency=device_concurrency)
             self.library.start()
 
         self.thread = Thread(
             name="Library",
             target=run,
-            args=(self, os.path.abspath(config['library.path']), use_opmuse_txt)
+            args=(self, os.path.abspath(config['library.path']), use_opmuse_txt, incremental, prune_dirs,
+                  device_concurrency)
         )
 
         self.thread.start()
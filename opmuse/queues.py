@@ -19,12 +19,12 @@ import cherrypy
 import math
 import random
 from sqlalchemy import Column, String, Integer, ForeignKey, Boolean, or_, and_
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, lazyload
 from sqlalchemy.sql import func, text
 from sqlalchemy.orm.exc import NoResultFound, ObjectDeletedError
 from opmuse.database import Base, get_database
 from opmuse.security import User
-from opmuse.library import Track, Artist, Album, library_dao
+from opmuse.library import Track, Artist, Album, library_dao, entity_cache
 from opmuse.cache import cache
 from opmuse.ws import ws
 from opmuse.utils import memoize
@@ -294,9 +294,14 @@ class QueueDao:
 
         info = current_queues = None
 
-        query = get_database().query(Queue).filter_by(user_id=user_id).order_by(Queue.index)
+        # tracks are merged from the entity cache into the session instead of
+        # being joined in, queue.track then finds them without a query
+        all_queues = (get_database().query(Queue).options(lazyload(Queue.track))
+                      .filter_by(user_id=user_id).order_by(Queue.index).all())
 
-        for index, queue in enumerate(query.all()):
+        entity_cache.get_many(Track, [queue.track_id for queue in all_queues])
+
+        for index, queue in enumerate(all_queues):
             if (index == 0 or
                     queue.track.album is not None and album is not None and album.id != queue.track.album.id or
                     queue.track.album is None and album is not None or
@@ -168,31 +168,31 @@ class WriteHandler:
 
 class Search:
     def delete_track(self, track):
-        write_handler = write_handlers["Track"]
+        self.delete_track_id(track.id)
 
-        if write_handler is None:
-            log("Write handler for Track isn't initialized")
-            return
+    def delete_album(self, album):
+        self.delete_album_id(album.id)
 
-        write_handler.delete_document(track.id)
+    def delete_artist(self, artist):
+        self.delete_artist_id(artist.id)
 
-    def delete_album(self, album):
-        write_handler = write_handlers["Album"]
+    def delete_track_id(self, id):
+        self._delete_document("Track", id)
 
-        if write_handler is None:
-            log("Write handler for Album isn't initialized")
-            return
+    def delete_album_id(self, id):
+        self._delete_document("Album", id)
 
-        write_handler.delete_document(album.id)
+    def delete_artist_id(self, id):
+        self._delete_document("Artist", id)
 
-    def delete_artist(self, artist):
-        write_handler = write_handlers["Artist"]
+    def _delete_document(self, index_name, id):
+        write_handler = write_handlers[index_name]
 
         if write_handler is None:
-            log("Write handler for Artist isn't initialized")
+            log("Write handler for %s isn't initialized" % index_name)
             return
 
-        write_handler.delete_document(artist.id)
+        write_handler.delete_document(id)
 
     def add_track(self, track):
         write_handler = write_handlers["Track"]
@@ -209,6 +209,10 @@ class Search:
 
         write_handler.update_document(str(track.id), name=track.name, slug=track.slug, filename=filename)
 
+    def update_track(self, track):
+        # documents are replaced by id, so this is the same as adding it
+        self.add_track(track)
+
     def add_album(self, album):
         write_handler = write_handlers["Album"]
 
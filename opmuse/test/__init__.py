@@ -16,11 +16,15 @@
 # along with opmuse.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import atexit
+import shutil
+import tempfile
 import cherrypy
 import re
 from os.path import join, abspath, dirname
 from opmuse.boot import configure
 from opmuse.database import get_raw_session
+from opmuse.library import entity_cache, library_changes, hash_cache, audio_hash_cache, metadata_cache
 from opmuse.test.fixtures import run_fixtures
 
 test_config_file = join(abspath(dirname(__file__)), '..', '..', 'config', 'opmuse.test.ini')
@@ -30,15 +34,38 @@ def remove_db():
     # we assume it's a sqlite dsn
     db_path = cherrypy.tree.apps[''].config['opmuse']['database.url'][10:]
 
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    # along with its WAL, a stale one would be replayed into the new database
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def use_temp_cache():
+    """
+    Points cache.path at a new temp dir so e.g. hashes and metadata cached by
+    one test, or test run, isn't used by the next.
+    """
+
+    cache_path = tempfile.mkdtemp(prefix='opmuse-cache-')
+
+    atexit.register(shutil.rmtree, cache_path, True)
+
+    cherrypy.config['opmuse']['cache.path'] = cache_path
+
+    for file_cache in (hash_cache, audio_hash_cache, metadata_cache):
+        file_cache.path = None
 
 
 def setup_db(self):
     configure(config_file=test_config_file, environment='production')
+    use_temp_cache()
 
     remove_db()
 
+    # ids are reused by the new database
+    entity_cache.clear()
+    library_changes.clear()
+
     self.session = get_raw_session(create_all=True)
 
     run_fixtures(self.session)
@@ -57,9 +84,13 @@ try:
         @staticmethod
         def _opmuse_setup_server():
             configure(config_file=test_config_file, environment='production')
+            use_temp_cache()
 
             remove_db()
 
+            entity_cache.clear()
+            library_changes.clear()
+
             session = get_raw_session(create_all=True)
             run_fixtures(session)
             session.close()
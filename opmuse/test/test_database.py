@@ -0,0 +1,137 @@
+# Copyright 2012-2015 Mattias Fliesberg
+#
+# This file is part of opmuse.
+#
+# opmuse is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# opmuse is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with opmuse.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import cherrypy
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+from opmuse.bgtask import SqliteMaintenanceCron
+from opmuse.database import get_engine, sqlite_writer_lock, database_data, read_only, RoutingSession
+from opmuse.library import Artist, library_dao
+from . import setup_db, teardown_db
+
+
+class TestDatabase:
+    def setup_method(self):
+        setup_db(self)
+
+    def teardown_method(self):
+        teardown_db(self)
+
+    def test_sqlite_pragmas(self):
+        assert self.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert self.session.execute('PRAGMA synchronous').scalar() == 1
+
+    def test_sqlite_writer_timeout(self, monkeypatch):
+        config = cherrypy.tree.apps[''].config['opmuse']
+
+        monkeypatch.setitem(config, 'database.sqlite.pragmas', {'busy_timeout': 5000})
+
+        engine = get_engine()
+        connection = engine.raw_connection()
+
+        try:
+            assert connection.connection.writer_timeout == 5
+        finally:
+            connection.close()
+            engine.dispose()
+
+    def test_sqlite_single_writer(self):
+        engine = get_engine(role='web')
+
+        artist_count = self.session.query(Artist).count()
+
+        errors = []
+
+        def write(number):
+            session = sessionmaker(bind=engine)()
+
+            try:
+                for index in range(10):
+                    session.add(Artist('Writer %d %d' % (number, index)))
+                    session.flush()
+
+                session.commit()
+            except Exception as error:
+                errors.append(error)
+            finally:
+                session.close()
+
+        threads = [threading.Thread(target=write, args=(number, )) for number in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        # readers aren't blocked by the writers
+        assert self.session.query(Artist).count() >= 0
+
+        for thread in threads:
+            thread.join()
+
+        engine.dispose()
+
+        assert errors == []
+        assert self.session.query(Artist).count() == artist_count + 40
+        assert not sqlite_writer_lock.locked()
+
+    def test_sqlite_maintenance(self):
+        database_data.database = self.session
+
+        try:
+            SqliteMaintenanceCron().run()
+        finally:
+            database_data.database = None
+
+        assert not sqlite_writer_lock.locked()
+
+    def test_replica_routing(self):
+        primary = get_engine()
+        replica = get_engine()
+
+        session = RoutingSession(bind=primary, replica=replica)
+
+        database_data.database = session
+
+        try:
+            statement = select([Artist.__table__])
+
+            assert session.get_bind(clause=statement) is primary
+
+            @read_only
+            def get_bind():
+                return session.get_bind(clause=statement)
+
+            assert get_bind() is replica
+            assert session.get_bind(clause=statement) is primary
+
+            session.info['replica'] = True
+
+            assert session.get_bind(clause=statement) is replica
+            assert library_dao.get_artist_count() == 0
+
+            session.add(Artist('Replica'))
+            session.flush()
+
+            # reads its own writes from now on
+            assert session.get_bind(clause=statement) is primary
+            assert get_bind() is primary
+            assert library_dao.get_artist_count() == 1
+        finally:
+            database_data.database = None
+            session.close()
+            primary.dispose()
+            replica.dispose()
@@ -0,0 +1,74 @@
+# Copyright 2012-2015 Mattias Fliesberg
+#
+# This file is part of opmuse.
+#
+# opmuse is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# opmuse is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with opmuse.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+from zipfile import ZipFile
+from opmuse.database import database_data
+from opmuse.ingest import ingest
+from opmuse.library import Track, LibraryProcess
+from . import setup_db, teardown_db
+
+sample_library_path = os.path.join(os.path.dirname(__file__), "../../sample_library")
+
+
+class TestIngest:
+    def setup_method(self):
+        setup_db(self)
+
+    def teardown_method(self):
+        teardown_db(self)
+
+    def test_zip(self, monkeypatch):
+        tempdir = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        try:
+            archive_path = os.path.join(tempdir, "sample.zip")
+
+            with ZipFile(archive_path, "w") as archive:
+                archive.write(os.path.join(sample_library_path, "sample.mp3"), "album/sample.mp3")
+                archive.write(os.path.join(sample_library_path, "sample.ogg"), "album/sample.ogg")
+                archive.writestr("__MACOSX/album/._sample.mp3", b"")
+
+            extract_path = os.path.join(tempdir, "extracted")
+
+            files = ingest.extract(archive_path, extract_path)
+
+            # the files are hashed by the pool, not again when they're added
+            def hash_file(filename, hash_mode=None):
+                raise Exception("Hashed again")
+
+            monkeypatch.setattr(LibraryProcess, 'hash_file', staticmethod(hash_file))
+
+            tracks, messages = ingest.add("sample.zip", files, move=False)
+
+            assert messages == []
+            assert sorted(track.paths[0].path for track in tracks) == [
+                os.path.join(extract_path, "album", "sample.mp3").encode(),
+                os.path.join(extract_path, "album", "sample.ogg").encode()
+            ]
+
+            assert self.session.query(Track).count() == 2
+
+            assert not os.path.exists(os.path.join(extract_path, "__MACOSX"))
+        finally:
+            ingest.stop()
+            database_data.database = None
+            shutil.rmtree(tempdir)
@@ -16,15 +16,34 @@
 # along with opmuse.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-from opmuse.library import Library, Artist
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+import cherrypy
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileMovedEvent, DirMovedEvent
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from opmuse.database import database_data, get_raw_session, get_engine, RoutingSession
+from opmuse.search import search
+from opmuse.library import (Library, LibraryProcess, FileMetadata, Artist, Album, Track, TrackPath, reader,
+                            hash_cache, metadata_cache, library_dao, WatchdogEventHandler, ScanCheckpoint,
+                            LibraryDir, track_futures, entity_cache, library_changes, LibraryUpdate,
+                            TrackFutures, TrackFuturesCron, LibraryChange,
+                            LibraryChanges)
 from . import setup_db, teardown_db
 
+sample_library_path = os.path.join(os.path.dirname(__file__), "../../sample_library")
 
-def library_start():
-    library = Library(os.path.join(os.path.dirname(__file__), "../../sample_library"),
-                      use_opmuse_txt=False)
+
+def library_start(incremental=True, path=sample_library_path, prune_dirs=False):
+    library = Library(path, use_opmuse_txt=False, incremental=incremental, prune_dirs=prune_dirs)
     library.start()
 
+    return library
+
 
 class TestLibrary:
     def setup_method(self):
@@ -48,3 +67,1046 @@ class TestLibrary:
         assert artists[1].name == "opmuse mp3"
         assert artists[1].albums[0].name == "opmuse mp3"
         assert artists[1].albums[0].tracks[0].name == "opmuse mp3"
+
+    def test_incremental(self):
+        library = library_start()
+
+        assert library.files_found == 2
+        assert library.files_unchanged == 0
+
+        for track_path in self.session.query(TrackPath).all():
+            stat = os.stat(track_path.path)
+            assert (track_path.size, track_path.mtime) == (stat.st_size, stat.st_mtime_ns)
+
+        library = library_start()
+
+        assert library.files_unchanged == 2
+        assert library.processed == 2
+
+        library = library_start(incremental=False)
+
+        assert library.files_unchanged == 0
+        assert self.session.query(Artist).count() == 2
+
+    def test_removed_files(self):
+        library_path = tempfile.mkdtemp()
+
+        try:
+            for filename in os.listdir(sample_library_path):
+                shutil.copy(os.path.join(sample_library_path, filename), library_path)
+
+            library_start(path=library_path)
+
+            assert self.session.query(Track).count() == 2
+
+            os.remove(os.path.join(library_path, "sample.mp3"))
+
+            library_start(path=library_path)
+
+            assert self.session.query(TrackPath).count() == 1
+            assert self.session.query(Track).count() == 1
+            assert self.session.query(Album).count() == 1
+
+            artists = self.session.query(Artist).all()
+
+            assert len(artists) == 1
+            assert artists[0].name == "opmuse"
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_cover_match(self):
+        library_path = tempfile.mkdtemp()
+
+        try:
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            metadata = reader.parse(track_path)
+
+            assert metadata.cover_path is None
+            assert metadata.artist_cover_path is None
+
+            cover_path = os.path.join(library_path, "cover.jpg").encode()
+            open(cover_path, "w").close()
+
+            metadata = reader.parse(track_path)
+
+            assert metadata.cover_path == cover_path
+            assert metadata.artist_cover_path is None
+
+            # album and artist are both named "opmuse mp3"
+            slug_cover_path = os.path.join(library_path, "opmuse_mp3.jpg").encode()
+            open(slug_cover_path, "w").close()
+
+            metadata = reader.parse(track_path)
+
+            assert metadata.cover_path == slug_cover_path
+            assert metadata.artist_cover_path == slug_cover_path
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_allocate_slug(self):
+        process = LibraryUpdate(False, self.session)
+
+        metadata = FileMetadata(*(["Intro"] + [None] * 16))
+
+        for slug in ("intro", "intro_1", "intro_2", "intro_extended", "library"):
+            artist = Artist(slug)
+            artist.slug = slug
+            self.session.add(artist)
+
+        self.session.commit()
+
+        artist = Artist("Intro (new)")
+        self.session.add(artist)
+        self.session.commit()
+
+        assert process.allocate_slug(artist, process.get_artist_slug, metadata) == "intro_3"
+
+        # an entity doesn't conflict with its own slug
+        artist = self.session.query(Artist).filter_by(slug="intro_1").one()
+
+        assert process.allocate_slug(artist, process.get_artist_slug, metadata) == "intro_1"
+
+        # reserved words get suffixed which doesn't share the unsuffixed prefix
+        metadata.artist_name = "Library"
+
+        assert process.allocate_slug(Artist("x"), process.get_artist_slug, metadata) == "library_1"
+
+    def test_aggregates(self):
+        library_start()
+
+        for artist in self.session.query(Artist).all():
+            assert artist.updated is not None
+            assert artist.updated == artist._updated
+            assert artist.created == artist._created
+
+        for album in self.session.query(Album).all():
+            assert album.updated is not None
+            assert album.updated == album._updated
+            assert album.created == album._created
+
+    def test_album_stats(self):
+        library_start()
+
+        album = self.session.query(Album).filter_by(name="opmuse mp3").one()
+
+        assert album.track_count == 1
+        assert album.disc_count == 0
+        assert album.artist_count == 1
+        assert album.format == "audio/mp3"
+        assert album.duration == album.tracks[0].duration
+        assert album.low_quality == album.tracks[0].low_quality
+        assert album.invalid == ([album.tracks[0].invalid] if album.tracks[0].invalid is not None else None)
+
+    def test_hash_cache(self):
+        library_path = tempfile.mkdtemp()
+
+        old_path = hash_cache.path
+
+        try:
+            hash_cache.path = os.path.join(library_path, "files.db")
+
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            stat, hash = LibraryProcess.hash_file(track_path)
+
+            assert hash_cache.get(stat) == hash
+
+            # a moved file keeps its inode so the hash is reused
+            moved_path = os.path.join(library_path, "moved.mp3").encode()
+            os.rename(track_path, moved_path)
+
+            assert LibraryProcess.get_hash(moved_path) == hash
+
+            # a modified file gets a new hash
+            with open(moved_path, "ab") as f:
+                f.write(b"opmuse")
+
+            stat, new_hash = LibraryProcess.hash_file(moved_path)
+
+            assert new_hash != hash
+            assert hash_cache.get(stat) == new_hash
+        finally:
+            hash_cache.path = old_path
+            shutil.rmtree(library_path)
+
+    def test_audio_hash(self):
+        library_path = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        config = cherrypy.config.get('opmuse')
+
+        try:
+            config['library.hash_mode'] = 'audio'
+
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            stat, file_hash = LibraryProcess.hash_file(track_path, 'file')
+            stat, audio_hash = LibraryProcess.hash_file(track_path)
+
+            library_start(path=library_path)
+
+            track = self.session.query(Track).one()
+
+            track_id = track.id
+
+            assert track.hash == audio_hash
+
+            # edit tags so they don't fit in the old tag's padding
+            tag = reader.get_mutagen_tag(track_path)
+            tag['title'] = 'edited track' * 1000
+            tag.save()
+
+            assert LibraryProcess.hash_file(track_path, 'file')[1] != file_hash
+            assert LibraryProcess.hash_file(track_path)[1] == audio_hash
+
+            # the scanner updates the track instead of adding a new one, the
+            # dir's mtime didn't change so it must not be incremental
+            library_start(incremental=False, path=library_path)
+
+            self.session.expire_all()
+
+            track = self.session.query(Track).one()
+
+            assert track.id == track_id
+            assert track.name == 'edited track' * 1000
+        finally:
+            config.pop('library.hash_mode')
+            database_data.database = None
+            shutil.rmtree(library_path)
+
+    def test_fingerprint_unchanged(self, monkeypatch):
+        library_path = tempfile.mkdtemp()
+
+        updated = []
+
+        monkeypatch.setattr(LibraryProcess, 'update', lambda self, tracks: updated.extend(tracks))
+
+        try:
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            library_start(path=library_path)
+
+            # touched, the fingerprint differs but the hash and tags doesn't
+            stat = os.stat(track_path)
+            os.utime(track_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+            library = library_start(path=library_path)
+
+            assert library.files_unchanged == 0
+            assert updated == []
+
+            self.session.expire_all()
+
+            assert self.session.query(TrackPath.mtime).scalar() == os.stat(track_path).st_mtime_ns
+
+            # scanned before fingerprints was stored
+            self.session.query(TrackPath).update({
+                'size': None, 'mtime': None, 'inode': None, 'device': None
+            }, synchronize_session=False)
+            self.session.commit()
+
+            library_start(path=library_path)
+
+            assert updated == []
+
+            self.session.expire_all()
+
+            assert self.session.query(TrackPath.size).scalar() == os.stat(track_path).st_size
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_watchdog_events(self):
+        handler = WatchdogEventHandler(settle_time=60)
+
+        handler.on_created(FileCreatedEvent(b"/library/a/1.mp3"))
+        handler.on_modified(FileModifiedEvent(b"/library/a/1.mp3"))
+        handler.on_moved(FileMovedEvent(b"/library/a/1.mp3", b"/library/a/2.mp3"))
+
+        # nothing has settled yet
+        assert handler.pop_settled() == ([], [], [], [])
+
+        handler.settle_time = 0
+
+        # the file was never added under its old name so it's just added
+        assert handler.pop_settled() == ([], [], [], [b"/library/a/2.mp3"])
+
+        handler.on_moved(FileMovedEvent(b"/library/b/1.mp3", b"/library/b/2.mp3"))
+        handler.on_moved(FileMovedEvent(b"/library/b/2.mp3", b"/library/b/3.mp3"))
+        handler.on_moved(DirMovedEvent(b"/library/c", b"/library/d"))
+        handler.on_moved(FileMovedEvent(b"/library/c/1.mp3", b"/library/d/1.mp3"))
+
+        assert handler.pop_settled() == ([(b"/library/c", b"/library/d")],
+                                         [(b"/library/b/1.mp3", b"/library/b/3.mp3")], [], [])
+
+    def test_move_paths(self):
+        library_path = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        try:
+            os.mkdir(os.path.join(library_path, "a"))
+
+            track_path = os.path.join(library_path, "a", "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            library_start(path=library_path)
+
+            track_id = self.session.query(Track.id).one()[0]
+
+            moved_path = os.path.join(library_path, "a", "moved.mp3").encode()
+            os.rename(track_path, moved_path)
+
+            assert library_dao.move_paths([(track_path, moved_path), (b"/unknown.mp3", b"/new.mp3")]) == [b"/new.mp3"]
+
+            dir_path = os.path.join(library_path, "b").encode()
+            os.rename(os.path.dirname(moved_path), dir_path)
+
+            library_dao.move_dirs([(os.path.dirname(moved_path), dir_path)])
+
+            self.session.expire_all()
+
+            track_path = self.session.query(TrackPath).one()
+
+            assert track_path.track_id == track_id
+            assert track_path.path == os.path.join(dir_path, b"moved.mp3")
+            assert track_path.dir == dir_path
+            assert track_path.filename == b"moved.mp3"
+        finally:
+            database_data.database = None
+            shutil.rmtree(library_path)
+
+    def _record_search(self, monkeypatch):
+        """
+        Returns a list that gets the (type, id, name) of everything added to
+        search.
+        """
+
+        indexed = []
+
+        for name in ('artist', 'album', 'track'):
+            def add(entity, name=name):
+                indexed.append((name, entity.id, entity.name))
+
+            monkeypatch.setattr(search, 'add_%s' % name, add)
+
+        return indexed
+
+    def _committed(self):
+        committed = []
+
+        for name, Entity in (('artist', Artist), ('album', Album), ('track', Track)):
+            committed.extend((name, id, entity_name) for id, entity_name in self.session.query(Entity.id, Entity.name))
+
+        return sorted(committed)
+
+    def test_search_batched(self, monkeypatch):
+        indexed = self._record_search(monkeypatch)
+
+        library_start()
+
+        assert sorted(indexed) == self._committed()
+
+    def test_search_batch_rollback(self, monkeypatch):
+        indexed = self._record_search(monkeypatch)
+
+        _get_album_id = LibraryProcess._get_album_id
+
+        def get_album_id(self, metadata):
+            # fails the batch after its artists has been added
+            _get_album_id(self, metadata)
+            raise Exception("Failing batch")
+
+        monkeypatch.setattr(LibraryProcess, '_get_album_id', get_album_id)
+
+        library_start()
+
+        # nothing of the rolled back batch, everything of the files that was
+        # processed one by one
+        assert sorted(indexed) == self._committed()
+        assert self.session.query(Track).count() == 2
+
+    def test_update_covers(self):
+        library_path = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        try:
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            library_start(path=library_path)
+
+            album = self.session.query(Album).one()
+            artist = self.session.query(Artist).one()
+
+            assert album.cover_path is None
+            assert artist.cover_path is None
+
+            # album and artist are both named "opmuse mp3"
+            cover_path = os.path.join(library_path, "cover.jpg").encode()
+            open(cover_path, "w").close()
+            slug_cover_path = os.path.join(library_path, "opmuse_mp3.jpg").encode()
+            open(slug_cover_path, "w").close()
+
+            library_dao.update_covers([library_path.encode()])
+
+            assert album.cover_path == slug_cover_path
+            assert artist.cover_path == slug_cover_path
+        finally:
+            database_data.database = None
+            shutil.rmtree(library_path)
+
+    def test_update_tracks_tags(self):
+        library_path = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        try:
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            library_start(path=library_path)
+
+            track = self.session.query(Track).one()
+
+            track_id, artist_id, album_id, hash = track.id, track.artist_id, track.album_id, track.hash
+
+            tracks, messages = library_dao.update_tracks_tags([{
+                'id': str(track_id), 'artist': 'edited artist', 'album': 'edited album',
+                'track': 'edited track', 'date': '', 'number': '', 'disc': ''
+            }])
+
+            assert messages == []
+
+            self.session.expire_all()
+
+            track = self.session.query(Track).one()
+
+            # the track, artist and album are updated in place
+            assert track.id == track_id
+            assert track.name == 'edited track'
+            assert track.slug == 'edited_artist_edited_album_edited_track'
+            assert track.hash != hash
+            assert track.artist.id == artist_id
+            assert track.artist.name == 'edited artist'
+            assert track.album.id == album_id
+            assert track.album.name == 'edited album'
+            assert track.album.track_count == 1
+
+            assert track.paths[0].mtime == os.stat(track_path).st_mtime_ns
+        finally:
+            database_data.database = None
+            shutil.rmtree(library_path)
+
+    def test_update_tracks_tags_existing(self, monkeypatch):
+        library_path = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        try:
+            for filename in ("sample.mp3", "sample.ogg"):
+                shutil.copy(os.path.join(sample_library_path, filename), os.path.join(library_path, filename))
+
+            library_start(path=library_path)
+
+            artist = self.session.query(Artist).filter_by(slug="opmuse").one()
+            album = artist.albums[0]
+            track = self.session.query(Track).filter_by(slug="opmuse_mp3_opmuse_mp3_opmuse_mp3").one()
+
+            artist_id, album_id, track_id = artist.id, album.id, track.id
+
+            indexed = self._record_search(monkeypatch)
+
+            # the artist and album of the other track are used instead of
+            # renaming these, they're removed as there's no tracks left
+            tracks, messages = library_dao.update_tracks_tags([{
+                'id': str(track_id), 'artist': 'opmuse', 'album': 'opmuse',
+                'track': 'edited track', 'date': album.date or '', 'number': '', 'disc': ''
+            }])
+
+            assert messages == []
+
+            self.session.expire_all()
+
+            track = self.session.query(Track).get(track_id)
+
+            assert track.artist_id == artist_id
+            assert track.album_id == album_id
+            assert self.session.query(Artist).count() == 1
+            assert self.session.query(Album).count() == 1
+            assert indexed == [('track', track_id, 'edited track')]
+        finally:
+            database_data.database = None
+            shutil.rmtree(library_path)
+
+    def test_track_futures(self):
+        library_path = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        try:
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            future = track_futures.get(b"sample.mp3")
+
+            assert not future.done()
+
+            tracks, messages = library_dao.add_files([track_path])
+
+            assert future.result(timeout=0) == tracks[0].id
+            assert not track_futures.waiting()
+
+            # already added tracks resolve right away
+            assert track_futures.get(b"sample.mp3").result(timeout=0) == tracks[0].id
+        finally:
+            database_data.database = None
+            shutil.rmtree(library_path)
+
+    def test_track_futures_cron(self, monkeypatch):
+        database_data.database = self.session
+
+        try:
+            future = track_futures.get(b"missing.mp3")
+
+            TrackFuturesCron().run()
+
+            assert not future.done()
+
+            monkeypatch.setattr(TrackFutures, 'MAX_AGE', -1)
+
+            TrackFuturesCron().run()
+
+            assert isinstance(future.exception(timeout=0), TimeoutError)
+            assert not track_futures.waiting()
+        finally:
+            database_data.database = None
+
+    def test_entity_cache(self):
+        library_start()
+
+        track_id = self.session.query(Track.id).filter_by(name="opmuse mp3").scalar()
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def get_track():
+            session = get_raw_session()
+            database_data.database = session
+
+            try:
+                track = library_dao.get_track(track_id)
+
+                return track, track.artist.name, track.album.name, [path.path for path in track.paths]
+            finally:
+                database_data.database = None
+                session.close()
+
+        track, artist_name, album_name, paths = get_track()
+
+        assert (artist_name, album_name) == ("opmuse mp3", "opmuse mp3")
+        assert len(paths) == 1
+
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+
+        try:
+            # served from memory, relationships included
+            assert get_track()[1:] == (artist_name, album_name, paths)
+            assert [statement for statement in statements if not statement.startswith('PRAGMA')] == []
+
+            # changing it through the orm invalidates it on flush and commit
+            self.session.query(Track).get(track_id).name = "renamed"
+            self.session.commit()
+
+            assert get_track()[0].name == "renamed"
+
+            # so does deleting it in bulk
+            database_data.database = self.session
+            library_dao.delete_tracks_by_ids([track_id], self.session)
+            database_data.database = None
+
+            session = get_raw_session()
+            database_data.database = session
+
+            try:
+                assert library_dao.get_track(track_id) is None
+            finally:
+                database_data.database = None
+                session.close()
+        finally:
+            event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+    def test_entity_cache_replica(self):
+        library_start()
+
+        track_id = self.session.query(Track.id).filter_by(name="opmuse mp3").scalar()
+
+        primary = get_engine()
+        replica = get_engine()
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith('PRAGMA'):
+                statements.append(statement)
+
+        event.listen(replica, 'before_cursor_execute', before_cursor_execute)
+
+        session = RoutingSession(bind=primary, replica=replica)
+        session.info['replica'] = True
+
+        database_data.database = session
+
+        try:
+            # what's been read from the replica isn't kept
+            entities = [session.query(Entity).all() for Entity in (Track, Album, Artist)]
+
+            assert len(statements) == 3
+
+            library_dao.get_track(track_id)
+
+            assert entity_cache.size() == 0
+
+            del entities
+            session.expunge_all()
+            del statements[:]
+
+            # misses are read from the primary and kept
+            assert library_dao.get_track(track_id).id == track_id
+            assert statements == []
+            assert entity_cache.size() == 3
+
+            # which doesn't stick to the session
+            assert library_dao.get_artist_count() == 2
+            assert len(statements) == 1
+        finally:
+            database_data.database = None
+            session.close()
+            primary.dispose()
+            replica.dispose()
+
+    def test_library_changes(self):
+        database_data.database = self.session
+
+        try:
+            assert library_changes.get_generation() == 0
+
+            library_start()
+
+            generation = library_changes.get_generation()
+
+            changes = library_changes.get_changes(0)
+
+            assert generation == changes[-1].id
+
+            # each entity is added once however many times it's flushed, then
+            # albums and artists are updated with their aggregated values
+            assert sorted((change.entity, change.operation) for change in changes) == sorted(
+                [('track', 'add')] * 2 + [('album', 'add'), ('album', 'update'), ('artist', 'add'),
+                                          ('artist', 'update')] * 2)
+
+            added = set((change.entity, change.entity_id) for change in changes if change.operation == 'add')
+
+            for Entity in (Track, Album, Artist):
+                for id, in self.session.query(Entity.id):
+                    assert (Entity.__name__.lower(), id) in added
+
+            # nothing changed, nothing recorded
+            library_start()
+
+            assert library_changes.get_generation() == generation
+
+            track = self.session.query(Track).filter_by(name="opmuse mp3").one()
+            track.name = "renamed"
+            self.session.commit()
+
+            changes = library_changes.get_changes(generation)
+
+            assert [(change.entity, change.entity_id, change.operation) for change in changes] == [
+                ('track', track.id, 'update')
+            ]
+
+            generation = library_changes.get_generation()
+            track_id = track.id
+
+            library_dao.delete_tracks_by_ids([track_id], self.session)
+
+            changes = library_changes.get_changes(generation)
+
+            assert ('track', track_id, 'delete') in [(change.entity, change.entity_id, change.operation)
+                                                     for change in changes]
+            assert set(change.entity for change in changes) == {'track', 'album', 'artist'}
+        finally:
+            database_data.database = None
+
+    def test_library_changes_committed(self):
+        database_data.database = self.session
+
+        try:
+            self.session.add(Artist('Uncommitted'))
+            self.session.flush()
+
+            # changes are written when the transaction commits
+            assert self.session.query(LibraryChange).count() == 0
+            assert library_changes.get_generation() == 0
+
+            self.session.commit()
+
+            generation = library_changes.get_generation()
+
+            assert generation > 0
+            assert [change.entity for change in library_changes.get_changes(0)] == ['artist']
+        finally:
+            database_data.database = None
+
+    def test_library_changes_gap(self, monkeypatch):
+        database_data.database = self.session
+
+        try:
+            self.session.add(Artist('Artist'))
+            self.session.commit()
+
+            generation = library_changes.get_generation()
+
+            # a change committed after one that's still in flight
+            self.session.execute(LibraryChange.__table__.insert(), {
+                'id': generation + 2, 'entity': 'artist', 'entity_id': 1, 'operation': 'update',
+                'created': datetime.datetime.utcnow()
+            })
+            self.session.commit()
+
+            assert library_changes.get_generation() == generation
+            assert library_changes.get_changes(generation, until=generation) == []
+
+            # it's given up on as rolled back eventually
+            monkeypatch.setattr(LibraryChanges, 'GAP_TIMEOUT', 0)
+
+            assert library_changes.get_generation() == generation + 2
+        finally:
+            database_data.database = None
+
+    def test_library_changes_trim(self):
+        database_data.database = self.session
+
+        try:
+            assert library_changes.trim(30) == 0
+
+            library_start()
+
+            generation = library_changes.get_generation()
+
+            assert library_changes.trim(30) == 0
+
+            (self.session.query(LibraryChange)
+             .update({'created': datetime.datetime.utcnow() - datetime.timedelta(days=31)},
+                     synchronize_session=False))
+            self.session.commit()
+
+            # the latest change is kept so the generation doesn't go back
+            assert library_changes.trim(30) > 0
+            assert library_changes.get_generation() == generation
+            assert library_changes.get_oldest() == generation
+        finally:
+            database_data.database = None
+
+    def test_move_paths_replace(self, monkeypatch):
+        library_path = tempfile.mkdtemp()
+
+        database_data.database = self.session
+
+        updated = []
+
+        monkeypatch.setattr(search, 'update_track', lambda track: updated.append(track.id))
+
+        try:
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+            replaced_path = os.path.join(library_path, "sample.ogg").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+            shutil.copy(os.path.join(sample_library_path, "sample.ogg"), replaced_path)
+
+            library_start(path=library_path)
+
+            assert self.session.query(Track).count() == 2
+
+            track_id = self.session.query(TrackPath.track_id).filter_by(path=track_path).one()[0]
+
+            os.replace(track_path, replaced_path)
+
+            assert library_dao.move_paths([(track_path, replaced_path)]) == []
+
+            self.session.expire_all()
+
+            track_path = self.session.query(TrackPath).one()
+
+            assert track_path.track_id == track_id
+            assert track_path.path == replaced_path
+            assert self.session.query(Track).one().id == track_id
+            assert updated == [track_id]
+        finally:
+            database_data.database = None
+            shutil.rmtree(library_path)
+
+    def _many_files(self, count):
+        library_path = tempfile.mkdtemp()
+
+        for index in range(count):
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"),
+                        os.path.join(library_path, "sample%d.mp3" % index))
+
+        return library_path
+
+    def test_stop(self, monkeypatch):
+        library_path = self._many_files(10)
+
+        monkeypatch.setattr(Library, 'BATCH_SIZE', 2)
+
+        library = Library(library_path, use_opmuse_txt=False, workers=1)
+
+        _process_batch = LibraryProcess._process_batch
+
+        def process_batch(self, batch, artist_name_fallback):
+            result = _process_batch(self, batch, artist_name_fallback)
+
+            # what stop() does, without waiting for ourselves
+            library.running = False
+
+            return result
+
+        monkeypatch.setattr(LibraryProcess, '_process_batch', process_batch)
+
+        try:
+            library.start()
+
+            assert not library.scanning
+            assert 0 < library.processed < 10
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_writer_died(self, monkeypatch):
+        library_path = self._many_files(10)
+
+        monkeypatch.setattr(Library, 'BATCH_SIZE', 2)
+
+        def process_batch(self, batch, artist_name_fallback):
+            raise Exception("Writer died")
+
+        monkeypatch.setattr(LibraryProcess, '_process_batch', process_batch)
+
+        library = Library(library_path, use_opmuse_txt=False, workers=1)
+
+        thread = threading.Thread(target=library.start)
+
+        try:
+            thread.start()
+            thread.join(timeout=60)
+
+            # the walker would wait for the writer forever
+            assert not thread.is_alive()
+            assert not library.scanning
+        finally:
+            library.running = False
+            thread.join()
+            shutil.rmtree(library_path)
+
+    def test_checkpoint(self):
+        library_path = tempfile.mkdtemp()
+
+        try:
+            for dir in ("a", "b"):
+                os.mkdir(os.path.join(library_path, dir))
+                shutil.copy(os.path.join(sample_library_path, "sample.mp3"), os.path.join(library_path, dir))
+
+            path = os.path.abspath(library_path.encode())
+
+            # a previous scan got through dir "a" before it was stopped
+            checkpoint = ScanCheckpoint(path)
+            checkpoint.found(os.path.join(path, b"a"), 1)
+            checkpoint.found(os.path.join(path, b"b"), 1)
+            checkpoint.processed([os.path.join(path, b"a", b"sample.mp3")])
+            checkpoint.save()
+
+            assert checkpoint.completed == {os.path.join(path, b"a")}
+
+            library = library_start(path=library_path)
+
+            assert library.checkpoint.resumed == 1
+            assert library.processed == 2
+
+            # only the file in "b" was processed
+            assert [track_path.path for track_path in self.session.query(TrackPath).all()] == [
+                os.path.join(path, b"b", b"sample.mp3")
+            ]
+
+            # the scan finished so there's nothing to resume next time
+            assert not os.path.exists(checkpoint.path)
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_checkpoint_stale(self):
+        library_path = tempfile.mkdtemp()
+
+        try:
+            for dir in ("a", "b"):
+                os.mkdir(os.path.join(library_path, dir))
+
+            path = os.path.abspath(library_path.encode())
+
+            checkpoint = ScanCheckpoint(path)
+            checkpoint.found(os.path.join(path, b"a"), 0)
+            checkpoint.found(os.path.join(path, b"b"), 0)
+            checkpoint.save()
+
+            # "b" was changed after the checkpoint was saved
+            os.utime(os.path.join(path, b"b"), (time.time() + 10, time.time() + 10))
+
+            resumed = ScanCheckpoint(path, checkpoint.path)
+            resumed.load()
+
+            assert resumed.resumed == 2
+            assert resumed.is_completed(os.path.join(path, b"a"), os.stat(os.path.join(path, b"a")).st_mtime_ns)
+            assert not resumed.is_completed(os.path.join(path, b"b"), os.stat(os.path.join(path, b"b")).st_mtime_ns)
+
+            # too old to resume from
+            with open(checkpoint.path, 'r') as f:
+                data = json.load(f)
+
+            data['updated'] -= ScanCheckpoint.MAX_AGE + 1
+
+            with open(checkpoint.path, 'w') as f:
+                json.dump(data, f)
+
+            expired = ScanCheckpoint(path, checkpoint.path)
+            expired.load()
+
+            assert expired.resumed == 0
+            assert not expired.is_completed(os.path.join(path, b"a"))
+
+            checkpoint.remove()
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_prune_dirs(self):
+        library_path = tempfile.mkdtemp()
+
+        try:
+            for dir in ("a", "b"):
+                os.mkdir(os.path.join(library_path, dir))
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), os.path.join(library_path, "a"))
+
+            library_start(path=library_path, prune_dirs=True)
+
+            path = os.path.abspath(library_path.encode())
+
+            library_dir = self.session.query(LibraryDir).filter_by(path=path).one()
+
+            assert library_dir.subdirs == [b"a", b"b"]
+
+            library = library_start(path=library_path, prune_dirs=True)
+
+            assert library.files_found == 1
+            assert library.files_unchanged == 1
+
+            # adding a file changes the dir's mtime so it's listed again
+            shutil.copy(os.path.join(sample_library_path, "sample.ogg"), os.path.join(library_path, "b"))
+
+            library = library_start(path=library_path, prune_dirs=True)
+
+            assert library.files_found == 2
+            assert library.files_unchanged == 1
+            assert self.session.query(Track).count() == 2
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_prune_dirs_failed(self, monkeypatch):
+        library_path = tempfile.mkdtemp()
+
+        def process(self, filename, artist_name_fallback=None, parsed=None, batched=False):
+            raise Exception("Failed")
+
+        try:
+            os.mkdir(os.path.join(library_path, "a"))
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), os.path.join(library_path, "a"))
+
+            with monkeypatch.context() as context:
+                context.setattr(LibraryProcess, 'process', process)
+
+                library = library_start(path=library_path, prune_dirs=True)
+
+            assert library.processed == 0
+
+            path = os.path.abspath(library_path.encode())
+
+            # the dir with the failed file is listed again next time
+            assert self.session.query(LibraryDir).filter_by(path=os.path.join(path, b"a")).count() == 0
+
+            library = library_start(path=library_path, prune_dirs=True)
+
+            assert library.processed == 1
+            assert self.session.query(Track).count() == 1
+        finally:
+            shutil.rmtree(library_path)
+
+    def test_device_concurrency(self):
+        library = Library(sample_library_path, use_opmuse_txt=False, device_concurrency=4)
+
+        assert library._get_device_concurrency() == (4, {})
+
+        library = Library(sample_library_path, use_opmuse_txt=False,
+                          device_concurrency={sample_library_path: 8, "/does/not/exist": 1})
+
+        assert library._get_device_concurrency() == (Library.DEVICE_CONCURRENCY,
+                                                     {os.stat(sample_library_path).st_dev: 8})
+
+        library = Library(sample_library_path, use_opmuse_txt=False, device_concurrency=1)
+        library.start()
+
+        assert library.files_found == 2
+        assert self.session.query(Track).count() == 2
+
+    def test_metadata_cache(self):
+        library_path = tempfile.mkdtemp()
+
+        old_path = metadata_cache.path
+
+        try:
+            metadata_cache.path = os.path.join(library_path, "files.db")
+
+            track_path = os.path.join(library_path, "sample.mp3").encode()
+
+            shutil.copy(os.path.join(sample_library_path, "sample.mp3"), track_path)
+
+            metadata = reader.parse(track_path)
+
+            assert metadata.track_name == "opmuse mp3"
+            assert metadata_cache.get(os.stat(track_path)) is not None
+
+            # covers are still looked up when the tags come from the cache
+            cover_path = os.path.join(library_path, "cover.jpg").encode()
+            open(cover_path, "w").close()
+
+            metadata = reader.parse(track_path)
+
+            assert metadata.track_name == "opmuse mp3"
+            assert metadata.cover_path == cover_path
+        finally:
+            metadata_cache.path = old_path
+            shutil.rmtree(library_path)
@@ -183,5 +183,13 @@ def memoize(func):
     return wrapper
 
 
+def chunks(items, size):
+    """
+        Yields successive lists of at most size items from items.
+    """
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
 multi_headers_tool = cherrypy.Tool('on_end_resource', multi_headers)
 error_handler_tool = cherrypy.Tool('before_error_response', error_handler_log)